@@ -0,0 +1,402 @@
+"""JSON read API, version 1, mounted at /api/v1.
+
+Endpoints return {"data": ...}. Listings are keyset paginated like the
+HTML pages: pass a page's "next_cursor" back as `before` for the next
+page; it's null on the last one. `limit` sets the page size.
+
+    GET /api/v1/timeline                  the logged-in user's home feed
+    GET /api/v1/trending                  messages with the most recent likes
+    GET /api/v1/users?ids=1,2,3           several users at once
+    GET /api/v1/users/<id>
+    GET /api/v1/users/<id>/messages
+    GET /api/v1/users/<id>/likes          messages the user liked
+    GET /api/v1/users/<id>/following
+    GET /api/v1/users/<id>/followers
+    GET /api/v1/messages?ids=1,2,3        several messages at once
+    GET /api/v1/messages/<id>
+
+`fields` picks what each item includes, e.g. `fields=id,text,user.username`
+for messages. Users have USER_FIELDS; messages have MESSAGE_FIELDS plus
+`user.<field>` for any of their author's fields (`user` alone gives the
+author's default fields). Only the columns asked for are read.
+
+Each listing costs two queries however many fields are asked for (plus
+a primary key lookup that the user exists): one that pages through the
+ids on the listing's index, and one that reads the fields of those ids,
+with counts, the viewer's likes and follows, and the authors all as
+subqueries or a join in the same SELECT. Following, followers and
+trending pages come from in-memory lists instead, so they're the second
+query alone, as are the batch and single item endpoints.
+
+Requests are authenticated by the logged-in session, like the pages.
+"""
+
+from datetime import datetime
+
+from flask import Blueprint, g, jsonify, request
+from sqlalchemy import exists, func, select
+from werkzeug.exceptions import BadRequest, HTTPException
+
+from follow_graph import follow_graph
+from models import db, User, Message, Follow, Like, TimelineEntry
+from pagination import paginate_by_key, paginate_by_timestamp
+from trending import trending
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+MAX_BATCH_IDS = 100
+
+USER_FIELDS = (
+    'id', 'username', 'image_url', 'header_image_url', 'bio', 'location',
+    'message_count', 'following_count', 'follower_count', 'like_count',
+    'following',
+)
+DEFAULT_USER_FIELDS = ('id', 'username', 'image_url')
+
+MESSAGE_FIELDS = (
+    'id', 'text', 'timestamp', 'user_id', 'like_count', 'liked', 'user',
+)
+DEFAULT_MESSAGE_FIELDS = ('id', 'text', 'timestamp', 'user_id')
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+@api.before_request
+def require_login():
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    return jsonify(error=error.description), error.code
+
+
+##############################################################################
+# Field selection
+
+
+def user_columns(viewer_id):
+    """Column expressions for each of USER_FIELDS, for `viewer_id`."""
+
+    columns = {
+        name: getattr(User, name)
+        for name in USER_FIELDS if name != 'following'
+    }
+    columns['following'] = (
+        exists()
+        .where(Follow.user_following_id == viewer_id,
+               Follow.user_being_followed_id == User.id))
+
+    return columns
+
+
+def message_columns(viewer_id):
+    """Column expressions for each of MESSAGE_FIELDS but `user`, for
+    `viewer_id`.
+    """
+
+    columns = {
+        name: getattr(Message, name)
+        for name in ('id', 'text', 'timestamp', 'user_id')
+    }
+    columns['like_count'] = (
+        select(func.count())
+        .where(Like.message_id == Message.id)
+        .scalar_subquery())
+    columns['liked'] = (
+        exists()
+        .where(Like.user_id == viewer_id, Like.message_id == Message.id))
+
+    return columns
+
+
+def parse_fields(allowed, default, nested=()):
+    """Return the fields asked for in the `fields` parameter, or `default`.
+
+    Names in `nested` may also be given as "name.<field>".
+    Raises BadRequest for unknown fields.
+    """
+
+    fields = request.args.get('fields')
+    if not fields:
+        return list(default)
+
+    names = []
+
+    for name in fields.split(','):
+        name = name.strip()
+        prefix = name.partition('.')[0]
+        if name not in allowed and not (prefix in nested and '.' in name):
+            raise BadRequest(f"Unknown field: {name}")
+        if name not in names:
+            names.append(name)
+
+    return names
+
+
+def as_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def fetch_users(ids, fields):
+    """Return dicts of `fields` for the active users in `ids`, in the order
+    of `ids`, with one query.
+    """
+
+    if not ids:
+        return []
+
+    columns = user_columns(g.user.id)
+
+    rows = db.session.execute(
+        select(User.id.label('_id'),
+               *[columns[name].label(name) for name in fields])
+        .where(User.id.in_(ids), User.deactivated_at.is_(None))
+    ).mappings().all()
+
+    by_id = {
+        row['_id']: {name: as_json(row[name]) for name in fields}
+        for row in rows
+    }
+
+    return [by_id[id] for id in ids if id in by_id]
+
+
+def fetch_messages(ids, fields):
+    """Return dicts of `fields` for the messages in `ids`, in the order of
+    `ids`, with one query. Messages by deactivated authors are left out.
+    """
+
+    if not ids:
+        return []
+
+    columns = message_columns(g.user.id)
+    selected = [Message.id.label('_id')]
+    user_fields = []
+
+    for name in fields:
+        if name == 'user':
+            user_fields.extend(
+                f for f in DEFAULT_USER_FIELDS if f not in user_fields)
+        elif name.startswith('user.'):
+            field = name.partition('.')[2]
+            if field not in USER_FIELDS:
+                raise BadRequest(f"Unknown field: {name}")
+            if field not in user_fields:
+                user_fields.append(field)
+        else:
+            selected.append(columns[name].label(name))
+
+    query = (select(*selected)
+             .join(User, User.id == Message.user_id)
+             .where(Message.id.in_(ids), User.deactivated_at.is_(None)))
+
+    if user_fields:
+        author_columns = user_columns(g.user.id)
+        query = query.add_columns(*[author_columns[name].label(f"user.{name}")
+                                    for name in user_fields])
+
+    by_id = {}
+
+    for row in db.session.execute(query).mappings():
+        item = {
+            name: as_json(row[name])
+            for name in fields if name != 'user' and '.' not in name
+        }
+        if user_fields:
+            item['user'] = {
+                name: as_json(row[f"user.{name}"]) for name in user_fields
+            }
+        by_id[row['_id']] = item
+
+    return [by_id[id] for id in ids if id in by_id]
+
+
+##############################################################################
+# Request parameters
+
+
+def parse_ids():
+    """Return the distinct ids in the `ids` parameter, in order."""
+
+    try:
+        ids = [int(id) for id in request.args.get('ids', '').split(',') if id]
+    except ValueError:
+        raise BadRequest("ids must be a comma-separated list of integers.")
+
+    if not ids:
+        raise BadRequest("ids is required.")
+
+    if len(ids) > MAX_BATCH_IDS:
+        raise BadRequest(f"At most {MAX_BATCH_IDS} ids at a time.")
+
+    return list(dict.fromkeys(ids))
+
+
+def parse_limit():
+    """Return the page size in the `limit` parameter."""
+
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise BadRequest("limit must be an integer.")
+
+    if not 1 <= limit <= MAX_LIMIT:
+        raise BadRequest(f"limit must be between 1 and {MAX_LIMIT}.")
+
+    return limit
+
+
+def page_response(page, fetch, fields):
+    return jsonify(data=fetch(page.items, fields),
+                   next_cursor=page.next_cursor)
+
+
+def get_active_user_id(user_id):
+    """Return `user_id` if that user exists and is active, else 404."""
+
+    return db.first_or_404(
+        select(User.id)
+        .where(User.id == user_id, User.deactivated_at.is_(None)))
+
+
+##############################################################################
+# Users
+
+
+@api.get('/users')
+def users():
+    """Users by id: ?ids=1,2,3."""
+
+    fields = parse_fields(USER_FIELDS, DEFAULT_USER_FIELDS)
+    return jsonify(data=fetch_users(parse_ids(), fields))
+
+
+@api.get('/users/<int:user_id>')
+def user(user_id):
+    """One user."""
+
+    fields = parse_fields(USER_FIELDS, DEFAULT_USER_FIELDS)
+    users = fetch_users([user_id], fields)
+
+    if not users:
+        return jsonify(error="No such user."), 404
+
+    return jsonify(data=users[0])
+
+
+@api.get('/users/<int:user_id>/following')
+def following(user_id):
+    """The users a user follows, most recently joined first."""
+
+    fields = parse_fields(USER_FIELDS, DEFAULT_USER_FIELDS)
+    user_id = get_active_user_id(user_id)
+
+    page = follow_graph.graph().following_page(
+        user_id, request.args.get('before'), parse_limit())
+
+    return page_response(page, fetch_users, fields)
+
+
+@api.get('/users/<int:user_id>/followers')
+def followers(user_id):
+    """The users following a user, most recently joined first."""
+
+    fields = parse_fields(USER_FIELDS, DEFAULT_USER_FIELDS)
+    user_id = get_active_user_id(user_id)
+
+    page = follow_graph.graph().followers_page(
+        user_id, request.args.get('before'), parse_limit())
+
+    return page_response(page, fetch_users, fields)
+
+
+##############################################################################
+# Messages
+
+
+@api.get('/messages')
+def messages():
+    """Messages by id: ?ids=1,2,3."""
+
+    fields = parse_fields(MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS, ('user',))
+    return jsonify(data=fetch_messages(parse_ids(), fields))
+
+
+@api.get('/messages/<int:message_id>')
+def message(message_id):
+    """One message."""
+
+    fields = parse_fields(MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS, ('user',))
+    messages = fetch_messages([message_id], fields)
+
+    if not messages:
+        return jsonify(error="No such message."), 404
+
+    return jsonify(data=messages[0])
+
+
+@api.get('/timeline')
+def timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    fields = parse_fields(MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS, ('user',))
+
+    page = paginate_by_timestamp(
+        db.session.query(TimelineEntry.message_id)
+        .filter(TimelineEntry.user_id == g.user.id),
+        TimelineEntry.timestamp,
+        TimelineEntry.message_id,
+        request.args.get('before'),
+        parse_limit(),
+    )
+
+    return page_response(page, fetch_messages, fields)
+
+
+@api.get('/trending')
+def trending_messages():
+    """Trending messages, highest decayed like score first."""
+
+    fields = parse_fields(MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS, ('user',))
+    page = trending.page(request.args.get('before'), parse_limit())
+
+    return page_response(page, fetch_messages, fields)
+
+
+@api.get('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    fields = parse_fields(MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS, ('user',))
+    user_id = get_active_user_id(user_id)
+
+    page = paginate_by_timestamp(
+        db.session.query(Message.id).filter(Message.user_id == user_id),
+        Message.timestamp,
+        Message.id,
+        request.args.get('before'),
+        parse_limit(),
+    )
+
+    return page_response(page, fetch_messages, fields)
+
+
+@api.get('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """The messages a user has liked, keyed on message id."""
+
+    fields = parse_fields(MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS, ('user',))
+    user_id = get_active_user_id(user_id)
+
+    page = paginate_by_key(
+        db.session.query(Like.message_id).filter(Like.user_id == user_id),
+        Like.message_id,
+        request.args.get('before'),
+        parse_limit(),
+    )
+
+    return page_response(page, fetch_messages, fields)
@@ -1,27 +1,212 @@
 import os
+import signal
+from contextlib import closing
+from datetime import datetime
+
+import click
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, url_for,
+    jsonify, stream_template)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_migrate import Migrate
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from jinja2 import pass_context
+from markupsafe import Markup
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import Unauthorized
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import NotFound, Unauthorized
+from wtforms import ValidationError
 
 from forms import UserAddForm, LoginForm, MessageForm, CsrfForm, EditUserForm
-from models import db, connect_db, User, Message, Like
+from models import (
+    db, connect_db, User, Message, Like, Follow, TimelineEntry, Suggestion,
+    MessageScore)
+from current_user import CurrentUser, SnapshotCache
+from deletion import (
+    delete_account, purge_deactivated,
+    DEFAULT_BATCH_SIZE, DEFAULT_INLINE_MAX_ROWS)
+from passwords import hasher
+from metrics import metrics
+from caching import init_caching, no_store, render_conditional
+from follow_graph import follow_graph
+from fragments import FragmentCache, fill, slot
+from jobs import jobs
+from api import api
+from pagination import (
+    StreamedPage, decode_timestamp_cursor, encode_timestamp_cursor,
+    paginate_by_key)
+from routing import ReadReplicas, TimedQueuePool
+from suggestions import refresh_suggestions, SUGGESTIONS_PER_USER
+from timeline_stream import timeline_stream
+from trending import trending
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
+SIDEBAR_SUGGESTIONS = 5
+STREAM_CHUNK_BYTES = 4096
+STREAM_FLUSH = "<!-- flush -->"
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
 
 app = Flask(__name__)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 app.config['SQLALCHEMY_ECHO'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': TimedQueuePool,
+    'pool_logging_name': 'primary',
+    'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 10)),
+    'pool_timeout': float(os.environ.get('DATABASE_POOL_TIMEOUT', 30)),
+    'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1',
+}
+app.config['DATABASE_REPLICA_URLS'] = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url
+]
+app.config['REPLICA_LAG_SECONDS'] = float(
+    os.environ.get('REPLICA_LAG_SECONDS', 5))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+app.config['MESSAGES_PER_PAGE'] = 100
+app.config['USERS_PER_PAGE'] = 60
+app.config['CURRENT_USER_CACHE_SIZE'] = 10000
+app.config['CURRENT_USER_CACHE_TTL'] = 30
+app.config['FRAGMENT_CACHE_BYTES'] = 32 * 1024 * 1024
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['SLOW_REQUEST_SECONDS'] = float(
+    os.environ.get('SLOW_REQUEST_SECONDS', 0.5))
+
+# /metrics (see metrics.py) is served to these addresses, and to scrapes
+# with an "Authorization: Bearer <METRICS_TOKEN>" header.
+app.config['METRICS_ALLOWED_IPS'] = [
+    ip for ip in
+    os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+    if ip
+]
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Stream list pages (profiles, likes, follows, the user list): send the
+# page header before reading the list, then rows as they're fetched.
+# Streamed pages have no ETag, so they're never answered with a 304.
+app.config['STREAM_LIST_PAGES'] = (
+    os.environ.get('STREAM_LIST_PAGES', '0') == '1')
+
+# Deleted accounts are purged this many rows per transaction; accounts with
+# more messages, follows, followers and likes than DELETE_INLINE_MAX_ROWS
+# are purged in the background.
+app.config['DELETE_BATCH_SIZE'] = int(
+    os.environ.get('DELETE_BATCH_SIZE', DEFAULT_BATCH_SIZE))
+app.config['DELETE_INLINE_MAX_ROWS'] = int(
+    os.environ.get('DELETE_INLINE_MAX_ROWS', DEFAULT_INLINE_MAX_ROWS))
+
+# Background jobs (see jobs.py): how often an idle worker polls, when a
+# running job is presumed abandoned, and the first retry delay.
+app.config['JOB_POLL_SECONDS'] = float(os.environ.get('JOB_POLL_SECONDS', 1))
+app.config['JOB_TIMEOUT_SECONDS'] = int(
+    os.environ.get('JOB_TIMEOUT_SECONDS', 15 * 60))
+app.config['JOB_RETRY_BACKOFF_SECONDS'] = float(
+    os.environ.get('JOB_RETRY_BACKOFF_SECONDS', 10))
+
+# Each process reloads its follow graph (see follow_graph.py) this often.
+app.config['FOLLOW_GRAPH_TTL'] = float(
+    os.environ.get('FOLLOW_GRAPH_TTL', 60))
+
+# /trending lists the top TRENDING_SIZE messages by decayed likes, as read
+# by each process every TRENDING_REFRESH_SECONDS (see trending.py).
+app.config['TRENDING_SIZE'] = int(os.environ.get('TRENDING_SIZE', 500))
+app.config['TRENDING_REFRESH_SECONDS'] = float(
+    os.environ.get('TRENDING_REFRESH_SECONDS', 30))
+
+# Push new messages to open home timelines (see timeline_stream.py). Each
+# stream is closed after TIMELINE_STREAM_SECONDS, when the browser
+# reconnects, and sends a comment every TIMELINE_KEEPALIVE_SECONDS.
+app.config['LIVE_TIMELINE'] = os.environ.get('LIVE_TIMELINE', '0') == '1'
+app.config['TIMELINE_STREAM_SECONDS'] = float(
+    os.environ.get('TIMELINE_STREAM_SECONDS', 300))
+app.config['TIMELINE_KEEPALIVE_SECONDS'] = float(
+    os.environ.get('TIMELINE_KEEPALIVE_SECONDS', 15))
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+migrate = Migrate(app, db, directory=MIGRATIONS_DIR)
+read_replicas = ReadReplicas(db)
+read_replicas.init_app(app)
+hasher.init_app(app)
+jobs.init_app(app)
+follow_graph.init_app(app)
+trending.init_app(app)
+timeline_stream.init_app(app)
+
+current_users = SnapshotCache(
+    app.config['CURRENT_USER_CACHE_SIZE'],
+    app.config['CURRENT_USER_CACHE_TTL'],
+)
+current_users.invalidate_on_commit()
+
+message_cards = FragmentCache(app.config['FRAGMENT_CACHE_BYTES'])
+
+init_caching(app)
+
+app.register_blueprint(api)
+
+metrics.init_app(app)
+metrics.gauge(
+    'warbler_password_hash_queue_depth',
+    "Password hashes and checks waiting for or running on the pool.",
+    lambda: hasher.stats()['queue_depth'])
+metrics.counter(
+    'warbler_password_hash_seconds_total',
+    "Time spent waiting for password hashes and checks.",
+    lambda: hasher.stats()['seconds'])
+metrics.counter(
+    'warbler_current_user_cache_hits_total',
+    "Logged-in user lookups answered from the snapshot cache.",
+    lambda: current_users.hits)
+metrics.counter(
+    'warbler_current_user_cache_misses_total',
+    "Logged-in user lookups that loaded the user from the database.",
+    lambda: current_users.misses)
+metrics.counter(
+    'warbler_fragment_cache_hits_total',
+    "Message cards served from the fragment cache.",
+    lambda: message_cards.hits)
+metrics.counter(
+    'warbler_fragment_cache_misses_total',
+    "Message cards rendered because they weren't cached or had changed.",
+    lambda: message_cards.misses)
+metrics.counter(
+    'warbler_fragment_cache_evictions_total',
+    "Message cards evicted to keep the fragment cache under its size.",
+    lambda: message_cards.evictions)
+metrics.gauge(
+    'warbler_fragment_cache_bytes',
+    "Size of the HTML held in the fragment cache.",
+    lambda: message_cards.size)
+job_counts = metrics.per_scrape(jobs.counts)
+metrics.gauge(
+    'warbler_jobs_queued',
+    "Background jobs waiting to run, including retries not yet due.",
+    lambda: job_counts().get('queued', 0))
+metrics.gauge(
+    'warbler_jobs_failed',
+    "Background jobs that used up their attempts.",
+    lambda: job_counts().get('failed', 0))
+metrics.counter(
+    'warbler_follow_graph_loads_total',
+    "Times this process loaded the follow graph from the database.",
+    lambda: follow_graph.loads)
+metrics.gauge(
+    'warbler_timeline_streams',
+    "Live timeline streams open in this process.",
+    lambda: timeline_stream.stream_count)
 
 
 ##############################################################################
@@ -30,10 +215,18 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    The user comes from the snapshot cache; the full row is only loaded
+    if the view needs it. Static files don't need a user at all.
+    """
+
+    if request.endpoint == 'static':
+        return
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        snapshot = current_users.get(session[CURR_USER_KEY])
+        g.user = CurrentUser(snapshot) if snapshot else None
 
     else:
         g.user = None
@@ -43,9 +236,212 @@ def add_user_to_g():
 def add_csrf_form_to_g():
     """Add the csrf form to Flask global."""
 
+    if request.endpoint == 'static':
+        return
+
     g.csrf_form = CsrfForm()
 
 
+def check_json_request():
+    """Return an error response for a JSON endpoint if there's no logged-in
+    user or the X-CSRFToken header isn't valid, else None.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    if app.config.get('WTF_CSRF_ENABLED', True):
+        try:
+            validate_csrf(request.headers.get('X-CSRFToken'))
+        except ValidationError:
+            return jsonify(error="Missing or invalid CSRF token."), 400
+
+    return None
+
+
+def prefetch_message_state(messages):
+    """Batch-load like counts and the current user's likes for `messages`,
+    so rendering them doesn't issue a query per message. A StreamedPage is
+    prefetched a batch at a time as it's read.
+    """
+
+    if isinstance(messages, StreamedPage):
+        messages.prepare = prefetch_message_state
+        return
+
+    Message.prefetch_like_counts(messages)
+    g.user.prefetch_likes(messages)
+
+
+# What each page shows, for the ETags of conditional pages. Anything a
+# template renders about a row must be here, or edits to it won't show
+# until the browser's copy goes stale some other way.
+
+def profile_validators(user):
+    """What users/detail.html shows of `user`."""
+
+    return (
+        user.id,
+        user.username,
+        user.image_url,
+        user.header_image_url,
+        user.bio,
+        user.location,
+        user.message_count,
+        user.following_count,
+        user.follower_count,
+        user.like_count,
+        g.user.is_following(user),
+        g.user.is_followed_by(user),
+    )
+
+
+def message_validators(messages):
+    """What a list of `messages` shows; call after prefetching their
+    likes.
+    """
+
+    return [
+        (message.id,
+         message.user.username,
+         message.user.image_url,
+         message.like_count,
+         g.user.has_liked(message))
+        for message in messages
+    ]
+
+
+def user_card_validators(users):
+    """What a list of user cards shows of `users`."""
+
+    return [
+        (user.id,
+         user.username,
+         user.image_url,
+         user.header_image_url,
+         user.bio,
+         g.user.is_following(user))
+        for user in users
+    ]
+
+
+# Cached message card templates, and the per-viewer templates that fill
+# their slots.
+MESSAGE_CARD_TEMPLATES = ['messages/card.html', 'messages/detail_card.html']
+MESSAGE_CARD_SLOTS = {
+    'like_controls': 'messages/like_controls.html',
+    'follow_controls': 'messages/follow_controls.html',
+}
+
+app.add_template_global(slot)
+
+
+@app.template_global()
+def message_card(message, template='messages/card.html'):
+    """Render `message` with `template`, reusing the viewer-independent
+    HTML from the fragment cache and rendering only the slots.
+    """
+
+    version = (
+        message.text,
+        message.timestamp,
+        message.user.username,
+        message.user.image_url,
+    )
+
+    parts = message_cards.get(
+        (template, message.id),
+        version,
+        lambda: app.jinja_env.get_template(template).render(message=message),
+    )
+
+    return fill(
+        parts,
+        lambda name: app.jinja_env.get_template(
+            MESSAGE_CARD_SLOTS[name]).render(message=message),
+    )
+
+
+@app.template_global()
+def next_page_url(page):
+    """URL of the page after `page`, keeping the current querystring."""
+
+    args = request.args.to_dict()
+    args[page.cursor_param] = page.next_cursor
+
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+def render_list(template, validators=None, **context):
+    """Render a list page: streamed if STREAM_LIST_PAGES, otherwise whole,
+    with an ETag from `validators()` if given (see `render_conditional`).
+    """
+
+    if app.config['STREAM_LIST_PAGES']:
+        return render_streamed(template, **context)
+
+    if validators is None:
+        return render_template(template, **context)
+
+    return render_conditional(template, validators(), **context)
+
+
+def render_streamed(template, **context):
+    """Render `template` while it's sent, in chunks of about
+    STREAM_CHUNK_BYTES, for pages listing StreamedPages. What's rendered
+    is also sent at each `flush()` in the template.
+
+    The headers, with the session cookie, go out before the template is
+    rendered, so it mustn't change the session: the CSRF token is made
+    first, and pages showing flashed messages are rendered whole.
+    """
+
+    if '_flashes' in session:
+        return render_template(template, **context)
+
+    generate_csrf()
+
+    return app.response_class(chunks(
+        stream_template(template, streamed=True, **context),
+        STREAM_CHUNK_BYTES,
+    ))
+
+
+@app.template_global()
+@pass_context
+def flush(context):
+    """Send what a streamed page has rendered so far, e.g. its header
+    before it reads its list. Renders nothing.
+    """
+
+    return Markup(STREAM_FLUSH) if context.get('streamed') else ''
+
+
+def chunks(pieces, size):
+    """Join the strings from `pieces` into chunks of at least `size`, or
+    up to each STREAM_FLUSH, which is left out.
+    """
+
+    with closing(pieces):
+        buffer = []
+        length = 0
+
+        for piece in pieces:
+            if piece == STREAM_FLUSH:
+                length = size
+            else:
+                buffer.append(piece)
+                length += len(piece)
+
+            if length >= size and buffer:
+                yield ''.join(buffer)
+                buffer = []
+                length = 0
+
+        if buffer:
+            yield ''.join(buffer)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -60,6 +456,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@no_store
 def signup():
     """Handle user signup.
 
@@ -98,6 +495,7 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@no_store
 def login():
     """Handle user login and redirect to homepage on success."""
 
@@ -113,6 +511,9 @@ def login():
             flash("Invalid credentials.", 'danger')
             return redirect("/")
 
+        # Save the password hash if authenticate upgraded its cost.
+        db.session.commit()
+
         do_login(user)
         flash(f"Hello, {user.username}!", "success")
         return redirect("/")
@@ -141,7 +542,8 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search users by username,
+    location and bio. Results are paged.
     """
 
     if not g.user:
@@ -149,13 +551,25 @@ def list_users():
         return redirect("/")
 
     search = request.args.get('q')
+    stream = app.config['STREAM_LIST_PAGES']
 
     if not search:
-        users = User.query.all()
+        users = paginate_by_key(
+            User.query.filter(User.deactivated_at.is_(None)),
+            User.id,
+            request.args.get('before'),
+            app.config['USERS_PER_PAGE'],
+            stream,
+        )
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = User.search(
+            search,
+            request.args.get('page'),
+            app.config['USERS_PER_PAGE'],
+            stream,
+        )
 
-    return render_template('users/index.html', users=users)
+    return render_list('users/index.html', users=users)
 
 
 @app.get('/users/<int:user_id>')
@@ -166,9 +580,20 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.get_active_or_404(user_id)
+    messages = user.messages_page(
+        request.args.get('before'),
+        app.config['MESSAGES_PER_PAGE'],
+        app.config['STREAM_LIST_PAGES'],
+    )
+    prefetch_message_state(messages)
 
-    return render_template('users/show.html', user=user)
+    return render_list(
+        'users/show.html',
+        lambda: (profile_validators(user), message_validators(messages)),
+        user=user,
+        messages=messages,
+    )
 
 
 @app.get('/users/<int:user_id>/likes')
@@ -179,9 +604,15 @@ def show_user_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.get_active_or_404(user_id)
+    messages = user.liked_messages_page(
+        request.args.get('before'),
+        app.config['MESSAGES_PER_PAGE'],
+        app.config['STREAM_LIST_PAGES'],
+    )
+    prefetch_message_state(messages)
 
-    return render_template('users/show_likes.html', user=user)
+    return render_list('users/show_likes.html', user=user, messages=messages)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -192,8 +623,19 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.get_active_or_404(user_id)
+    users = load_users(follow_graph.graph().following_page(
+        user.id,
+        request.args.get('before'),
+        app.config['USERS_PER_PAGE'],
+    ), app.config['STREAM_LIST_PAGES'])
+
+    return render_list(
+        'users/following.html',
+        lambda: (profile_validators(user), user_card_validators(users)),
+        user=user,
+        users=users,
+    )
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -204,8 +646,70 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.get_active_or_404(user_id)
+    users = load_users(follow_graph.graph().followers_page(
+        user.id,
+        request.args.get('before'),
+        app.config['USERS_PER_PAGE'],
+    ), app.config['STREAM_LIST_PAGES'])
+
+    return render_list(
+        'users/followers.html',
+        lambda: (profile_validators(user), user_card_validators(users)),
+        user=user,
+        users=users,
+    )
+
+
+def load_users(page, stream=False):
+    """Swap the user ids in `page` for their User rows, in order, with
+    one query. Deleted accounts are left out.
+
+    If `stream`, returns a StreamedPage of them instead; the ids are
+    highest first, so ordering by id keeps their order.
+    """
+
+    query = User.query.filter(
+        User.id.in_(page.items), User.deactivated_at.is_(None))
+
+    if stream:
+        return StreamedPage(
+            query.order_by(User.id.desc()),
+            len(page),
+            next_cursor=page.next_cursor,
+        )
+
+    users = {user.id: user for user in query}
+    page.items = [users[id] for id in page.items if id in users]
+
+    return page
+
+
+@app.get('/users/suggested')
+def show_suggested_users():
+    """Show users the current user might like to follow."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    users = suggested_users(SUGGESTIONS_PER_USER)
+
+    return render_template('users/suggested.html', users=users)
+
+
+def suggested_users(limit):
+    """Return up to `limit` users suggested to the current user, leaving
+    out anyone they've followed since the suggestions were computed.
+    """
+
+    graph = follow_graph.graph()
+
+    return [
+        user
+        for user in Suggestion.users_for(g.user.id, SUGGESTIONS_PER_USER)
+        if not graph.is_following(g.user.id, user.id)
+    ][:limit]
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -220,9 +724,8 @@ def start_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    followed_user = User.get_active_or_404(follow_id)
+    update_following(followed_user.id, True)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -239,14 +742,87 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = User.get_active_or_404(follow_id)
+    update_following(followed_user.id, False)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
+@app.put('/users/<int:user_id>/follow')
+def follow_json(user_id):
+    """Follow a user, if not already following them.
+
+    For scripts: expects the CSRF token in an X-CSRFToken header and
+    returns JSON like {"user_id": 1, "following": true,
+    "follower_count": 10}.
+    """
+
+    return following_response(user_id, True)
+
+
+@app.delete('/users/<int:user_id>/follow')
+def unfollow_json(user_id):
+    """Stop following a user, if following them. Returns JSON as for
+    `follow_json`.
+    """
+
+    return following_response(user_id, False)
+
+
+def update_following(user_id, following):
+    """Follow or unfollow `user_id` as the current user and commit.
+
+    Returns whether anything changed.
+    """
+
+    if following:
+        changed = Follow.add(g.user.id, user_id)
+    else:
+        changed = Follow.remove(g.user.id, user_id)
+
+    if changed:
+        jobs.enqueue('sync_timeline',
+                     follower_id=g.user.id, followed_id=user_id)
+        Suggestion.mark_stale(g.user.id, user_id)
+
+    db.session.commit()
+
+    if changed:
+        follow_graph.record(g.user.id, user_id, following)
+        current_users.invalidate(g.user.id)
+        current_users.invalidate(user_id)
+
+    return changed
+
+
+def following_response(user_id, following):
+    """Make the current user follow or unfollow `user_id`, and return the
+    JSON response for `follow_json` and `unfollow_json`.
+    """
+
+    error = check_json_request()
+    if error:
+        return error
+
+    follower_count = db.session.scalar(
+        select(User.follower_count)
+        .where(User.id == user_id, User.deactivated_at.is_(None)))
+
+    if follower_count is None:
+        return jsonify(error="No such user."), 404
+
+    if update_following(user_id, following):
+        follower_count += 1 if following else -1
+
+    return jsonify(
+        user_id=user_id,
+        following=following,
+        follower_count=follower_count,
+    )
+
+
 @app.route('/users/profile', methods=["GET", "POST"])
+@no_store
 def profile():
     """Update profile for current user."""
 
@@ -294,6 +870,8 @@ def profile():
 def delete_user():
     """Delete user.
 
+    The account is deactivated at once and its rows purged in batches,
+    in the background for users with many messages (see deletion.py).
     Redirect to signup page.
     """
 
@@ -303,12 +881,8 @@ def delete_user():
         return redirect("/")
 
     do_logout()
-
-    for message in g.user.messages:
-        db.session.delete(message)
-
-    db.session.delete(g.user)
-    db.session.commit()
+    delete_account(app, g.user.id)
+    current_users.invalidate(g.user.id)
 
     flash("User successfully deleted.", "success")
     return redirect("/signup")
@@ -318,6 +892,7 @@ def delete_user():
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@no_store
 def add_message():
     """Add a message:
 
@@ -333,6 +908,10 @@ def add_message():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        g.user.message_count = User.message_count + 1
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        timeline_stream.notify(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -348,8 +927,47 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.get_visible_or_404(message_id)
+    prefetch_message_state([msg])
+
+    return render_conditional(
+        'messages/show.html',
+        (message_validators([msg]), g.user.is_following(msg.user)),
+        message=msg,
+    )
+
+
+@app.get('/trending')
+def show_trending():
+    """Show the messages with the most recent likes, a page at a time."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages = load_messages(trending.page(
+        request.args.get('before'),
+        app.config['MESSAGES_PER_PAGE'],
+    ))
+    prefetch_message_state(messages)
+
+    return render_template('trending.html', messages=messages)
+
+
+def load_messages(page):
+    """Swap the message ids in `page` for their Messages, with their
+    authors, in order, with one query.
+    """
+
+    messages = {
+        message.id: message
+        for message in Message.query
+        .options(joinedload(Message.user))
+        .filter(Message.id.in_(page.items))
+    }
+    page.items = [messages[id] for id in page.items if id in messages]
+
+    return page
 
 
 @app.post('/messages/<int:message_id>/like')
@@ -357,15 +975,12 @@ def like_message(message_id):
     """Like a message."""
 
     form = g.csrf_form
-    print(request.form['requesting_url'])
     if not g.user or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
-    g.user.liked_messages.append(message)
-
-    db.session.commit()
+    message = Message.get_visible_or_404(message_id)
+    update_liked(message.id, True)
 
     return redirect(request.form['requesting_url'])
 
@@ -379,12 +994,79 @@ def unlike_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    like = Like.query.get_or_404((g.user.id, message_id))
+    update_liked(message_id, False)
+
+    return redirect(request.form['requesting_url'])
+
+
+@app.put('/messages/<int:message_id>/like')
+def like_json(message_id):
+    """Like a message, if not already liked.
+
+    For scripts: expects the CSRF token in an X-CSRFToken header and
+    returns JSON like {"message_id": 1, "liked": true, "like_count": 3}.
+    """
+
+    return liked_response(message_id, True)
+
+
+@app.delete('/messages/<int:message_id>/like')
+def unlike_json(message_id):
+    """Unlike a message, if liked. Returns JSON as for `like_json`."""
+
+    return liked_response(message_id, False)
+
+
+def update_liked(message_id, liked):
+    """Like or unlike `message_id` as the current user and commit.
+
+    Returns whether anything changed.
+    """
+
+    if liked:
+        changed = Like.add(g.user.id, message_id)
+    else:
+        changed = Like.remove(g.user.id, message_id)
+
+    if changed:
+        Suggestion.mark_stale(g.user.id)
 
-    db.session.delete(like)
     db.session.commit()
 
-    return redirect(request.form['requesting_url'])
+    if changed:
+        current_users.invalidate(g.user.id)
+
+    return changed
+
+
+def liked_response(message_id, liked):
+    """Make the current user like or unlike `message_id`, and return the
+    JSON response for `like_json` and `unlike_json`.
+    """
+
+    error = check_json_request()
+    if error:
+        return error
+
+    like_count = db.session.scalar(
+        select(func.count(Like.user_id))
+        .select_from(Message)
+        .join(User, User.id == Message.user_id)
+        .outerjoin(Like, Like.message_id == Message.id)
+        .where(Message.id == message_id, User.deactivated_at.is_(None))
+        .group_by(Message.id))
+
+    if like_count is None:
+        return jsonify(error="No such message."), 404
+
+    if update_liked(message_id, liked):
+        like_count += 1 if liked else -1
+
+    return jsonify(
+        message_id=message_id,
+        liked=liked,
+        like_count=like_count,
+    )
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -395,21 +1077,110 @@ def delete_message(message_id):
     Redirect to user page on success.
     """
 
-    msg = Message.query.get_or_404(message_id)
+    msg = Message.get_visible_or_404(message_id)
 
     form = g.csrf_form
     if not g.user or g.user.id != msg.user.id or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-
+    msg.remove_from_counts()
     db.session.delete(msg)
     db.session.commit()
 
+    for template in MESSAGE_CARD_TEMPLATES:
+        message_cards.invalidate((template, message_id))
+
     flash("Message successfully deleted.","success")
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Rebuild every user's message/follow/like counters."""
+
+    User.reconcile_counts()
+    db.session.commit()
+    print("User counters reconciled.")
+
+
+@app.cli.command('purge-deactivated')
+def purge_deactivated_users():
+    """Finish purging deleted accounts, e.g. after a restart."""
+
+    count = purge_deactivated(app.config['DELETE_BATCH_SIZE'])
+    print(f"Purged {count} deleted accounts.")
+
+
+@app.cli.command('suggestions')
+@click.option('--all', 'everyone', is_flag=True,
+              help="Recompute every user's suggestions.")
+def refresh_user_suggestions(everyone):
+    """Recompute "who to follow" suggestions for the users whose follows
+    or likes changed since the last run.
+    """
+
+    count = refresh_suggestions(everyone)
+    print(f"Refreshed suggestions for {count} users.")
+
+
+@app.cli.command('trending')
+@click.option('--rebuild', is_flag=True,
+              help="Recompute every score from the likes table.")
+def update_trending(rebuild):
+    """Prune trending scores that have decayed away; run from cron."""
+
+    if rebuild:
+        MessageScore.rebuild()
+        print("Trending scores rebuilt.")
+    else:
+        print(f"Pruned {MessageScore.prune()} trending scores.")
+
+    db.session.commit()
+
+
+@app.cli.command('worker')
+@click.option('--once', is_flag=True,
+              help="Run the jobs that are due, then exit.")
+@click.option('--metrics-port', type=int,
+              help="Serve this worker's metrics on this port.")
+def worker(once, metrics_port):
+    """Run background jobs until stopped (SIGINT or SIGTERM).
+
+    Run as many workers as needed; they share the jobs table safely.
+    """
+
+    if once:
+        print(f"Ran {jobs.run_pending()} jobs.")
+        return
+
+    if metrics_port:
+        metrics.serve(app, metrics_port)
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+
+    try:
+        jobs.work(should_stop=lambda: stopping)
+    except KeyboardInterrupt:
+        pass
+
+
+##############################################################################
+# Background jobs
+
+
+@jobs.job('sync_timeline')
+def sync_timeline(follower_id, followed_id):
+    """Bring a timeline up to date after a follow or unfollow."""
+
+    TimelineEntry.sync(follower_id, followed_id)
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -419,30 +1190,103 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of self & followed_users
+    - logged in: most recent messages of self & followed_users, a page at
+      a time
     """
 
     if g.user:
+        before = request.args.get('before')
+        messages = TimelineEntry.messages_for(
+            g.user.id,
+            before,
+            app.config['MESSAGES_PER_PAGE'],
+        )
+        prefetch_message_state(messages)
+
+        # New messages are announced at the top of the first page.
+        stream_after = None
+        if app.config['LIVE_TIMELINE'] and not before:
+            stream_after = (
+                message_cursor(messages.items[0]) if messages.items
+                else encode_timestamp_cursor(datetime.utcnow(), 0))
+
+        return render_template(
+            'home.html',
+            messages=messages,
+            suggestions=suggested_users(SIDEBAR_SUGGESTIONS),
+            stream_after=stream_after,
+        )
 
-        ids = [user.id for user in g.user.following] + [g.user.id]
+    else:
+        return render_template('home-anon.html')
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
 
-        return render_template('home.html', messages=messages)
+##############################################################################
+# Live timeline
 
-    else:
-        return render_template('home-anon.html')
 
+@app.get('/timeline/stream')
+def stream_timeline():
+    """Stream the ids of new messages on the user's timeline, as
+    server-sent events, starting after the cursor in the Last-Event-ID
+    header (sent on reconnects) or the `after` query arg.
+
+    The stream doesn't touch the database, or the request, once it's open.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    if not app.config['LIVE_TIMELINE']:
+        raise NotFound()
+
+    after = (request.headers.get('Last-Event-ID')
+             or request.args.get('after', ''))
+    decode_timestamp_cursor(after)
 
-@app.after_request
-def add_header(response):
-    """Add non-caching headers on every request."""
+    subscription = timeline_stream.subscribe(g.user.id)
+    missed = TimelineEntry.messages_after(
+        g.user.id, after, app.config['MESSAGES_PER_PAGE'])
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+    response = app.response_class(
+        timeline_stream.events(subscription, reversed(missed)),
+        mimetype='text/event-stream',
+    )
+    response.call_on_close(lambda: timeline_stream.unsubscribe(subscription))
     response.cache_control.no_store = True
+    response.headers['X-Accel-Buffering'] = 'no'
+
+    return response
+
+
+@app.get('/timeline/new')
+@no_store
+def show_new_messages():
+    """Render the cards of the messages on the user's timeline newer than
+    the `after` cursor, newest first, for the homepage to add to the top.
+
+    The newest one's cursor is in the X-Timeline-Cursor header.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    messages = TimelineEntry.messages_after(
+        g.user.id,
+        request.args.get('after', ''),
+        app.config['MESSAGES_PER_PAGE'],
+    )
+    prefetch_message_state(messages)
+
+    response = app.make_response(
+        render_template('messages/cards.html', messages=messages))
+    if messages:
+        response.headers['X-Timeline-Cursor'] = message_cursor(messages[0])
+
     return response
+
+
+def message_cursor(message):
+    """The timeline cursor of `message`."""
+
+    return encode_timestamp_cursor(message.timestamp, message.id)
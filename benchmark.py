@@ -0,0 +1,376 @@
+"""Route-level load benchmark for Warbler.
+
+Seeds a generated dataset of a given size, then drives the main pages and
+the like/follow actions concurrently through Flask test clients, each
+logged in as a different user, and reports per route:
+
+- throughput (requests/sec over the whole run),
+- p50/p95/p99 latency in milliseconds,
+- SQL statements per request.
+
+Run it like:
+
+    python -m benchmark --profile small
+    python -m benchmark --profile medium --workers 16 --requests 5000
+
+It uses its own database (BENCHMARK_DATABASE_URL, default
+postgresql:///warbler_bench), which is dropped and reseeded unless
+--no-seed is passed. Generated CSVs are kept in benchmarks/data/<profile>
+so later runs only reseed.
+
+Results can be saved as a baseline with --save-baseline, which writes
+benchmarks/<profile>.json. Later runs of the same profile are compared
+against it, and the script exits with status 1 if any route got slower or
+issues more statements than the baseline allows.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+os.environ["DATABASE_URL"] = os.environ.get(
+    "BENCHMARK_DATABASE_URL", 'postgresql:///warbler_bench')
+
+from sqlalchemy import event, func, select
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Like, Follow
+from seed import seed
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+BENCHMARK_DIR = 'benchmarks'
+
+# Dataset sizes, passed straight to generator/create_csvs.py.
+PROFILES = {
+    'small': dict(users=1_000, messages=20_000, follows=20_000,
+                  likes=20_000),
+    'medium': dict(users=100_000, messages=2_000_000, follows=2_000_000,
+                   likes=2_000_000),
+    'large': dict(users=1_000_000, messages=20_000_000, follows=20_000_000,
+                  likes=20_000_000),
+}
+
+# Fixed so every run of a profile benchmarks the same data.
+DATA_SEED = 'warbler-benchmark'
+DATA_END_DATE = '2024-01-01'
+
+# How often each scenario is picked. Like and follow each make two
+# requests (do, then undo) so the dataset doesn't drift between runs.
+SCENARIOS = {
+    'home': 30,
+    'search': 10,
+    'profile': 20,
+    'likes': 10,
+    'message': 20,
+    'like': 5,
+    'follow': 5,
+}
+
+# How many ids to sample as targets for the requests.
+SAMPLE_SIZE = 1_000
+
+# A route regresses if its p95 latency grows by more than this fraction
+# of its baseline, or if it issues more statements per request.
+DEFAULT_TOLERANCE = 0.2
+
+
+class StatementCounter:
+    """Counts the SQL statements sent by the current thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, many):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+
+def generate_data(profile):
+    """Generate the CSVs for `profile`, unless they already exist, and
+    return the directory they're in.
+    """
+
+    data_dir = os.path.join(BENCHMARK_DIR, 'data', profile)
+
+    if not os.path.exists(os.path.join(data_dir, 'likes.csv')):
+        os.makedirs(data_dir, exist_ok=True)
+        sizes = PROFILES[profile]
+        subprocess.run(
+            [sys.executable, os.path.join('generator', 'create_csvs.py'),
+             '--out-dir', data_dir,
+             '--seed', DATA_SEED,
+             '--end-date', DATA_END_DATE,
+             *[f'--{name}={size}' for name, size in sizes.items()]],
+            check=True,
+        )
+
+    return data_dir
+
+
+def sample_targets():
+    """Pick the users, messages and search terms the requests will use."""
+
+    user_ids = db.session.scalars(
+        select(User.id).order_by(func.random()).limit(SAMPLE_SIZE)).all()
+    message_ids = db.session.scalars(
+        select(Message.id).order_by(func.random()).limit(SAMPLE_SIZE)).all()
+    usernames = db.session.scalars(
+        select(User.username).where(User.id.in_(user_ids))).all()
+
+    return {
+        'user_ids': user_ids,
+        'message_ids': message_ids,
+        'search_terms': [username[:3] for username in usernames],
+    }
+
+
+def viewer_state(viewer_id, targets):
+    """Which sampled messages and users `viewer_id` can like and follow
+    without hitting an existing like or follow.
+    """
+
+    liked = set(db.session.scalars(
+        select(Like.message_id).where(
+            Like.user_id == viewer_id,
+            Like.message_id.in_(targets['message_ids']))))
+    followed = set(db.session.scalars(
+        select(Follow.user_being_followed_id).where(
+            Follow.user_following_id == viewer_id,
+            Follow.user_being_followed_id.in_(targets['user_ids']))))
+
+    return {
+        'likeable': [id for id in targets['message_ids'] if id not in liked],
+        'followable': [id for id in targets['user_ids']
+                       if id not in followed and id != viewer_id],
+    }
+
+
+def scenario_requests(scenario, rng, targets, state):
+    """Return the (route, method, path, data) requests for one scenario."""
+
+    user_id = rng.choice(targets['user_ids'])
+    message_id = rng.choice(targets['message_ids'])
+
+    if scenario == 'home':
+        return [('/', 'GET', '/', None)]
+
+    if scenario == 'search':
+        term = rng.choice(targets['search_terms'])
+        return [('/users?q=', 'GET', f'/users?q={term}', None)]
+
+    if scenario == 'profile':
+        return [('/users/<id>', 'GET', f'/users/{user_id}', None)]
+
+    if scenario == 'likes':
+        return [('/users/<id>/likes', 'GET', f'/users/{user_id}/likes',
+                 None)]
+
+    if scenario == 'message':
+        return [('/messages/<id>', 'GET', f'/messages/{message_id}', None)]
+
+    if scenario == 'like':
+        message_id = rng.choice(state['likeable'])
+        data = {'requesting_url': '/'}
+        return [
+            ('like', 'POST', f'/messages/{message_id}/like', data),
+            ('unlike', 'POST', f'/messages/{message_id}/like/delete', data),
+        ]
+
+    if scenario == 'follow':
+        user_id = rng.choice(state['followable'])
+        return [
+            ('follow', 'POST', f'/users/follow/{user_id}', None),
+            ('unfollow', 'POST', f'/users/stop-following/{user_id}', None),
+        ]
+
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+def run_worker(worker, viewer_id, state, targets, count, counter, seed):
+    """Make `count` scenarios' worth of requests as `viewer_id`, returning
+    (route, seconds, statements, status) for each request.
+    """
+
+    rng = random.Random(f"{seed}:{worker}")
+    scenarios = rng.choices(
+        list(SCENARIOS), weights=list(SCENARIOS.values()), k=count)
+    results = []
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer_id
+
+        for scenario in scenarios:
+            for route, method, path, data in scenario_requests(
+                    scenario, rng, targets, state):
+                counter.reset()
+                start = time.perf_counter()
+                resp = client.open(path, method=method, data=data)
+                elapsed = time.perf_counter() - start
+                results.append((route, elapsed, counter.count,
+                                resp.status_code))
+
+    return results
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted `values`."""
+
+    rank = max(math.ceil(fraction * len(values)), 1)
+    return values[rank - 1]
+
+
+def summarize(results, wall_seconds):
+    """Aggregate per-request results into per-route statistics."""
+
+    by_route = defaultdict(list)
+    for route, seconds, statements, status in results:
+        by_route[route].append((seconds, statements, status))
+
+    summary = {}
+
+    for route, rows in sorted(by_route.items()):
+        latencies = sorted(seconds * 1000 for seconds, _, _ in rows)
+        summary[route] = {
+            'requests': len(rows),
+            'errors': sum(status >= 400 for _, _, status in rows),
+            'throughput': len(rows) / wall_seconds,
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'statements': max(statements for _, statements, _ in rows),
+        }
+
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    print(f"{'route':<20}{'reqs':>7}{'errs':>6}{'req/s':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'sql':>5}"
+          f"{'p95 vs base':>13}")
+
+    for route, stats in summary.items():
+        change = ''
+        if baseline and route in baseline:
+            before = baseline[route]['p95_ms']
+            change = f"{(stats['p95_ms'] - before) / before:+.0%}"
+
+        print(f"{route:<20}{stats['requests']:>7}{stats['errors']:>6}"
+              f"{stats['throughput']:>9.1f}{stats['p50_ms']:>9.1f}"
+              f"{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+              f"{stats['statements']:>5}{change:>13}")
+
+
+def regressions(summary, baseline, tolerance):
+    """Describe each route that is slower or chattier than `baseline`."""
+
+    found = []
+
+    for route, stats in summary.items():
+        before = baseline.get(route)
+        if before is None:
+            continue
+
+        if stats['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            found.append(f"{route}: p95 {before['p95_ms']:.1f}ms -> "
+                         f"{stats['p95_ms']:.1f}ms")
+        if stats['statements'] > before['statements']:
+            found.append(f"{route}: {before['statements']} -> "
+                         f"{stats['statements']} statements")
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profile', choices=PROFILES, default='small')
+    parser.add_argument('--workers', type=int, default=8,
+                        help="concurrent logged-in clients")
+    parser.add_argument('--requests', type=int, default=2_000,
+                        help="scenarios to run, spread over the workers")
+    parser.add_argument('--warmup', type=int, default=100,
+                        help="scenarios to run before measuring")
+    parser.add_argument('--seed', default='warbler',
+                        help="seed for picking viewers and scenarios")
+    parser.add_argument('--no-seed', action='store_true',
+                        help="reuse the data already in the database")
+    parser.add_argument('--tolerance', type=float,
+                        default=DEFAULT_TOLERANCE)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        seed(generate_data(args.profile))
+
+    targets = sample_targets()
+    viewers = random.Random(args.seed).sample(
+        targets['user_ids'], args.workers)
+    states = [viewer_state(viewer_id, targets) for viewer_id in viewers]
+    db.session.remove()
+
+    counter = StatementCounter()
+
+    def run(count, seed):
+        per_worker = [count // args.workers + (i < count % args.workers)
+                      for i in range(args.workers)]
+        with ThreadPoolExecutor(args.workers) as pool:
+            futures = [
+                pool.submit(run_worker, i, viewer_id, state, targets,
+                            per_worker[i], counter, seed)
+                for i, (viewer_id, state) in enumerate(zip(viewers, states))
+            ]
+            return [row for future in futures for row in future.result()]
+
+    run(args.warmup, f"{args.seed}:warmup")
+
+    start = time.perf_counter()
+    results = run(args.requests, args.seed)
+    summary = summarize(results, time.perf_counter() - start)
+
+    baseline_path = os.path.join(BENCHMARK_DIR, f'{args.profile}.json')
+    baseline = None
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)['routes']
+
+    print_summary(summary, baseline)
+
+    if args.save_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump({
+                'profile': args.profile,
+                'workers': args.workers,
+                'requests': args.requests,
+                'recorded_at': datetime.now().isoformat(timespec='seconds'),
+                'routes': summary,
+            }, f, indent=2)
+        print(f"Saved baseline to {baseline_path}")
+
+    elif baseline:
+        found = regressions(summary, baseline, args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
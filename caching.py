@@ -0,0 +1,138 @@
+"""HTTP caching policy for Warbler.
+
+- Static files are linked with a `v=<content hash>` query string, so the
+  versioned URLs can be cached forever (`immutable`); a changed file gets
+  a new URL. Unversioned static URLs (e.g. from the stylesheet, or avatar
+  defaults stored in the database) are cached for an hour and then
+  revalidated.
+- Pages rendered with `render_conditional` get a weak ETag built from the
+  data they show, and a `304 Not Modified` when the browser's copy is
+  still current. They're `private, no-cache`: browsers may keep them but
+  must revalidate before each use.
+- Views that render forms holding what the user typed are marked
+  `no_store`, so those never touch the disk cache.
+- Everything else defaults to `private, no-cache`.
+"""
+
+import hashlib
+import os
+import time
+from functools import lru_cache, wraps
+
+from flask import (
+    current_app, g, make_response, render_template, request, session)
+
+from current_user import UserSnapshot
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+UNVERSIONED_STATIC_MAX_AGE = 60 * 60
+
+DEFAULT_CSRF_TIME_LIMIT = 3600
+
+
+def init_caching(app):
+    """Version static URLs and apply the caching policy to `app`."""
+
+    @app.url_defaults
+    def add_static_version(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['v'] = static_version(
+                os.path.join(app.static_folder, values['filename']))
+
+    @app.after_request
+    def set_cache_control(response):
+        cache_control = response.cache_control
+
+        if request.endpoint == 'static':
+            cache_control.public = True
+            if request.args.get('v'):
+                cache_control.max_age = STATIC_MAX_AGE
+                cache_control.immutable = True
+            else:
+                cache_control.max_age = UNVERSIONED_STATIC_MAX_AGE
+            cache_control.no_cache = None
+
+        elif not (cache_control.no_store or cache_control.no_cache):
+            cache_control.private = True
+            cache_control.no_cache = True
+
+        return response
+
+
+@lru_cache(maxsize=None)
+def static_version(path):
+    """Short hash of the static file at `path`'s contents.
+
+    Cached for the life of the process: deploys restart the workers.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()[:12]
+    except OSError:
+        return None
+
+
+def no_store(view):
+    """Mark the responses of `view` as never to be stored by caches."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        response.cache_control.no_store = True
+        return response
+
+    return wrapper
+
+
+def render_conditional(template, validators, **context):
+    """Render `template`, unless the browser's copy is still current.
+
+    `validators` is anything (hashable by repr) that changes whenever the
+    page would: the rows shown, their counters, the viewer's like and
+    follow state. The viewer's own snapshot and the age of the page's
+    CSRF tokens are added here.
+    """
+
+    # Flashed messages are shown once; a page showing them mustn't be
+    # replayed from cache.
+    if '_flashes' in session:
+        return render_template(template, **context)
+
+    etag = hashlib.sha1(
+        repr((request.full_path, _viewer_version(), _csrf_window(),
+              validators)).encode()
+    ).hexdigest()
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render_template(template, **context))
+
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    return response
+
+
+def _viewer_version():
+    """What the page chrome shows of the logged-in user."""
+
+    if not g.user:
+        return None
+
+    return tuple(getattr(g.user, field) for field in UserSnapshot._fields)
+
+
+def _csrf_window():
+    """Changes every half CSRF token lifetime, so a revalidated page never
+    carries a token old enough to be rejected.
+    """
+
+    limit = current_app.config.get(
+        'WTF_CSRF_TIME_LIMIT', DEFAULT_CSRF_TIME_LIMIT)
+    if not limit:
+        return None
+
+    return int(time.time() // (limit / 2))
@@ -0,0 +1,184 @@
+"""Cached loading of the logged-in user for `g.user`.
+
+Every request from a logged-in user needs a few facts about them (id,
+username, avatar, header counts) to render the page chrome. Rather than
+load the full User row each time, each process keeps a small TTL/LRU cache
+of lightweight snapshots and puts a `CurrentUser` on `g.user` that only
+loads the ORM object when a view uses something the snapshot doesn't have.
+
+Snapshots are invalidated when a commit changes the user, so the user
+sees their own edits at once; changes made by other processes or by bulk
+UPDATEs (e.g. someone else following them) show up within the TTL.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from follow_graph import follow_graph
+from models import db, User, Like
+
+UserSnapshot = namedtuple("UserSnapshot", [
+    "id",
+    "username",
+    "image_url",
+    "header_image_url",
+    "message_count",
+    "following_count",
+    "follower_count",
+    "like_count",
+])
+
+
+class SnapshotCache:
+    """Thread-safe TTL/LRU cache of UserSnapshots keyed by user id."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return the snapshot for `user_id`, loading it on a miss.
+
+        Returns None if there is no such user, or their account has been
+        deleted.
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        row = db.session.execute(
+            select(*[getattr(User, field) for field in UserSnapshot._fields])
+            .where(User.id == user_id, User.deactivated_at.is_(None))
+        ).one_or_none()
+
+        if row is None:
+            return None
+
+        snapshot = UserSnapshot(*row)
+
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, snapshot)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return snapshot
+
+    def invalidate(self, user_id):
+        """Drop any cached snapshot for `user_id`."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drop every cached snapshot."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def invalidate_on_commit(self):
+        """Invalidate users changed or deleted through the ORM whenever a
+        session commits.
+        """
+
+        @event.listens_for(Session, 'after_flush')
+        def collect_changed_users(session, flush_context):
+            changed = session.info.setdefault('changed_user_ids', set())
+            for obj in (*session.dirty, *session.deleted):
+                if isinstance(obj, User):
+                    changed.add(obj.id)
+
+        @event.listens_for(Session, 'after_commit')
+        def invalidate_changed_users(session):
+            for user_id in session.info.pop('changed_user_ids', ()):
+                self.invalidate(user_id)
+
+        @event.listens_for(Session, 'after_rollback')
+        def forget_changed_users(session):
+            session.info.pop('changed_user_ids', None)
+
+
+class CurrentUser:
+    """Stand-in for the logged-in User, placed on `g.user`.
+
+    Snapshot fields are answered from the cache. Anything else (relations,
+    methods, writes) loads the full User row on first use and is delegated
+    to it; from then on every attribute comes from the loaded row.
+    """
+
+    def __init__(self, snapshot):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_user', None)
+        object.__setattr__(self, '_likes_checked', {})
+
+    def load(self):
+        """Return the full User row for the current user."""
+
+        if self._user is None:
+            object.__setattr__(
+                self, '_user', db.session.get(User, self._snapshot.id))
+
+        return self._user
+
+    def __getattr__(self, name):
+        if self._user is None and name in UserSnapshot._fields:
+            return getattr(self._snapshot, name)
+
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._snapshot.id}: {self._snapshot.username}>"
+
+    def is_following(self, other_user):
+        """Is the current user following `other_user`? Answered from the
+        follow graph, without loading the user.
+        """
+
+        return follow_graph.graph().is_following(self.id, other_user.id)
+
+    def is_followed_by(self, other_user):
+        """Is the current user followed by `other_user`?"""
+
+        return follow_graph.graph().is_following(other_user.id, self.id)
+
+    def prefetch_likes(self, messages):
+        """Look up which of `messages` the current user has liked in one
+        query, without loading the user.
+        """
+
+        ids = {message.id for message in messages}
+        liked = db.session.scalars(
+            select(Like.message_id)
+            .where(Like.user_id == self.id, Like.message_id.in_(ids)))
+
+        self._likes_checked.update(dict.fromkeys(ids, False))
+        self._likes_checked.update(dict.fromkeys(liked, True))
+
+    def has_liked(self, message):
+        """Has the current user liked `message`? Answered from
+        `prefetch_likes`, or else by looking up the one like.
+        """
+
+        if message.id not in self._likes_checked:
+            self._likes_checked[message.id] = (
+                db.session.get(Like, (self.id, message.id)) is not None)
+
+        return self._likes_checked[message.id]
@@ -0,0 +1,224 @@
+"""Account deletion.
+
+Deleting an account used to load every one of the user's messages and
+delete them through the ORM one at a time. Instead, `purge_user` deletes
+set-based, in batches of `DELETE_BATCH_SIZE` rows, each batch committed
+in its own short transaction:
+
+1. the user's messages, letting the database cascade their likes and
+   timeline entries,
+2. their follows, in both directions,
+3. their likes, taking each out of its message's trending score, and
+   their own timeline,
+4. the user row itself.
+
+Each batch also decrements the counters other users keep for the rows
+it deleted. Every step is safe to repeat, so an interrupted purge picks
+up where it stopped when run again.
+
+`delete_account` is what the view calls. It marks the account
+deactivated first, which hides it at once (it can't log in, and its
+profile and search entry disappear). Small accounts are then purged
+inline. For accounts with more than DELETE_INLINE_MAX_ROWS messages,
+follows, followers and likes between them, a `purge_user` job is queued
+in the same transaction, so the request returns straight away and the
+purge is retried if a worker dies.
+`flask purge-deactivated` finishes any inline purge a restart interrupted.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import delete, func, select, tuple_, update
+
+from jobs import jobs
+from models import (
+    db, User, Message, Follow, Like, MessageScore, TimelineEntry)
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_INLINE_MAX_ROWS = 5000
+
+# Purges are mostly deletes, so don't let them take over the workers.
+PURGE_CONCURRENCY = 2
+
+
+def delete_account(app, user_id):
+    """Deactivate `user_id`'s account and purge it, inline for small
+    accounts and in a background job for large ones.
+
+    Returns the job, or None if the purge is already done.
+    """
+
+    rows = db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(deactivated_at=datetime.utcnow())
+        .returning(User.message_count
+                   + User.following_count
+                   + User.follower_count
+                   + User.like_count)
+    ).scalar_one()
+
+    batch_size = app.config['DELETE_BATCH_SIZE']
+
+    if rows > app.config['DELETE_INLINE_MAX_ROWS']:
+        job = jobs.enqueue('purge_user', user_id=user_id, batch_size=batch_size)
+        db.session.commit()
+        return job
+
+    db.session.commit()
+    purge_user(user_id, batch_size)
+    return None
+
+
+@jobs.job('purge_user', concurrency=PURGE_CONCURRENCY)
+def purge_user(user_id, batch_size=DEFAULT_BATCH_SIZE):
+    """Delete `user_id` and everything that references them, in batches
+    of `batch_size` rows.
+    """
+
+    while _delete_message_batch(user_id, batch_size):
+        db.session.commit()
+
+    while _delete_follow_batch(
+            Follow.user_following_id == user_id,
+            Follow.user_being_followed_id,
+            User.follower_count,
+            batch_size):
+        db.session.commit()
+
+    while _delete_follow_batch(
+            Follow.user_being_followed_id == user_id,
+            Follow.user_following_id,
+            User.following_count,
+            batch_size):
+        db.session.commit()
+
+    while _delete_like_batch(user_id, batch_size):
+        db.session.commit()
+
+    while _delete_batch(
+            TimelineEntry, TimelineEntry.user_id == user_id, batch_size):
+        db.session.commit()
+
+    db.session.execute(delete(User).where(User.id == user_id))
+    db.session.commit()
+
+
+def purge_deactivated(batch_size=DEFAULT_BATCH_SIZE):
+    """Finish purging every deactivated account. Returns how many there
+    were.
+    """
+
+    user_ids = db.session.scalars(
+        select(User.id).where(User.deactivated_at.is_not(None))).all()
+
+    for user_id in user_ids:
+        purge_user(user_id, batch_size)
+
+    return len(user_ids)
+
+
+def _delete_message_batch(user_id, batch_size):
+    """Delete up to `batch_size` of the user's messages, taking their likes
+    off their likers' counts in the same statement. The database cascades
+    the likes and timeline entries. Returns how many messages were deleted.
+    """
+
+    batch = (
+        select(Message.id)
+        .where(Message.user_id == user_id)
+        .order_by(Message.id)
+        .limit(batch_size)
+    )
+
+    gone = (
+        delete(Message)
+        .where(Message.id.in_(batch))
+        .returning(Message.id)
+        .cte('gone')
+    )
+
+    likes_lost = (
+        select(Like.user_id, func.count().label('n'))
+        .where(Like.message_id.in_(select(gone.c.id)))
+        .group_by(Like.user_id)
+        .subquery()
+    )
+
+    counted = (
+        update(User)
+        .where(User.id == likes_lost.c.user_id)
+        .values(like_count=User.like_count - likes_lost.c.n)
+        .returning(User.id)
+        .cte('counted')
+    )
+
+    return db.session.scalar(
+        select(func.count()).select_from(gone).add_cte(counted))
+
+
+def _delete_follow_batch(condition, other_id, other_count, batch_size):
+    """Delete up to `batch_size` follows matching `condition`, decrementing
+    `other_count` on the user at the other end (`other_id`) of each.
+    Returns how many follows were deleted.
+    """
+
+    batch = (
+        select(Follow.user_being_followed_id, Follow.user_following_id)
+        .where(condition)
+        .limit(batch_size)
+    )
+
+    gone = (
+        delete(Follow)
+        .where(tuple_(Follow.user_being_followed_id,
+                      Follow.user_following_id).in_(batch))
+        .returning(other_id.label('user_id'))
+        .cte('gone')
+    )
+
+    return db.session.execute(
+        update(User)
+        .where(User.id.in_(select(gone.c.user_id)))
+        .values({other_count: other_count - 1})
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def _delete_like_batch(user_id, batch_size):
+    """Delete up to `batch_size` of the user's likes, taking them out of
+    their messages' trending scores. Returns how many were deleted.
+    """
+
+    batch = (
+        select(Like.user_id, Like.message_id)
+        .where(Like.user_id == user_id)
+        .limit(batch_size)
+    )
+
+    gone = (
+        delete(Like)
+        .where(tuple_(Like.user_id, Like.message_id).in_(batch))
+        .returning(Like.message_id, Like.timestamp)
+        .cte('gone')
+    )
+
+    scored = MessageScore.remove_likes(gone).cte('scored')
+
+    return db.session.scalar(
+        select(func.count()).select_from(gone).add_cte(scored))
+
+
+def _delete_batch(model, condition, batch_size):
+    """Delete up to `batch_size` rows of `model` matching `condition`.
+    Returns how many were deleted.
+    """
+
+    pk = tuple_(*model.__table__.primary_key.columns)
+
+    return db.session.execute(
+        delete(model).where(pk.in_(
+            select(*model.__table__.primary_key.columns)
+            .where(condition)
+            .limit(batch_size)))
+    ).rowcount
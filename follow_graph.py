@@ -0,0 +1,446 @@
+"""In-memory follow graph, for answering follow questions without queries.
+
+Each process keeps the whole `follows` table in memory in compressed
+sparse row (CSR) form, once per direction: `offsets[u]:offsets[u + 1]` is
+the slice of a sorted int32 `neighbors` array holding the users `u`
+follows (or the users following `u`). With a few million follows that's
+tens of megabytes, and "does A follow B" is a binary search in A's slice.
+
+The arrays are loaded in bulk with a binary COPY and never changed.
+Follows and unfollows since the load are kept in a small overlay of
+per-user sets on top of them, patched by `FollowGraphCache.record` when
+a view commits one. The graph is reloaded every FOLLOW_GRAPH_TTL seconds
+(in the background, serving the old one meanwhile) to pick up changes
+made by other processes, and straight away after an ORM commit adds or
+removes follows some other way (seeding, tests).
+
+Users always see their own follows: `record` also keeps the change in
+the browser's session for a couple of TTLs, and every process applies a
+request's recorded changes its graph doesn't have yet, like the "read
+your writes" pinning in routing.py. Other people's follows show up within
+the TTL, like the counts in the current user snapshots.
+
+Edges of deleted accounts stay until the next reload after their purge;
+callers look users up by id anyway, and skip deactivated ones.
+"""
+
+import io
+import threading
+import time
+
+import numpy as np
+from flask import has_request_context, session
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import db, User, Follow
+from pagination import Page, decode_key_cursor
+
+FOLLOW_WRITES_KEY = "follow_writes"
+MAX_FOLLOW_WRITES = 50
+
+DEFAULT_TTL = 60
+
+# A binary COPY is an 11 byte signature and two int32 header fields, then
+# per row a field count and a (length, value) pair for each column, all
+# big-endian, then a -1 field count.
+COPY_HEADER_BYTES = 19
+COPY_TRAILER_BYTES = 2
+COPY_FOLLOWS = (
+    "COPY follows (user_following_id, user_being_followed_id) "
+    "TO STDOUT WITH (FORMAT binary)"
+)
+
+EMPTY = np.zeros(0, dtype=np.int32)
+
+
+class Adjacency:
+    """One direction of the graph: a CSR of sorted neighbor ids per user,
+    plus the neighbors added and removed since it was built.
+
+    The CSR never changes. The overlay is changed by `set` while other
+    threads read it, so it's only touched holding `lock`, which `set`'s
+    caller holds.
+    """
+
+    def __init__(self, sources, targets, lock=None):
+        size = int(sources.max()) + 1 if len(sources) else 0
+
+        # One sort of (source, target) packed into an int64 is several
+        # times faster than a lexsort of the pair.
+        keys = (sources.astype(np.int64) << 32) | targets.astype(np.int64)
+        keys.sort()
+
+        self.neighbors = (keys & 0xFFFFFFFF).astype(np.int32)
+        self.offsets = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=size), out=self.offsets[1:])
+
+        self.added = {}
+        self.removed = {}
+        self.lock = lock or threading.Lock()
+
+    def base(self, node):
+        """The sorted neighbors of `node` when the CSR was built."""
+
+        if not 0 <= node < len(self.offsets) - 1:
+            return EMPTY
+
+        return self.neighbors[self.offsets[node]:self.offsets[node + 1]]
+
+    def _in_base(self, node, other):
+        row = self.base(node)
+        i = np.searchsorted(row, other)
+        return i < len(row) and row[i] == other
+
+    def contains(self, node, other):
+        """Is `other` a neighbor of `node`?"""
+
+        with self.lock:
+            if other in self.added.get(node, ()):
+                return True
+            if other in self.removed.get(node, ()):
+                return False
+
+        return self._in_base(node, other)
+
+    def ids(self, node):
+        """Sorted int32 array of the neighbors of `node`."""
+
+        row = self.base(node)
+
+        with self.lock:
+            removed = set(self.removed.get(node, ()))
+            added = set(self.added.get(node, ()))
+
+        if removed:
+            row = row[~np.isin(row, list(removed))]
+        if added:
+            row = np.union1d(row, np.fromiter(added, np.int32, len(added)))
+
+        return row
+
+    def count(self, node):
+        """Number of neighbors of `node`."""
+
+        with self.lock:
+            return (len(self.base(node))
+                    - len(self.removed.get(node, ()))
+                    + len(self.added.get(node, ())))
+
+    def set(self, node, other, present):
+        """Add or remove the edge from `node` to `other`. The caller holds
+        `lock`.
+
+        `added` only holds edges not in the CSR and `removed` only edges
+        that are, so counts are simple sums.
+        """
+
+        if present:
+            changes, undo = self.added, self.removed
+        else:
+            changes, undo = self.removed, self.added
+
+        if other in undo.get(node, ()):
+            undo[node].discard(other)
+        elif self._in_base(node, other) != present:
+            changes.setdefault(node, set()).add(other)
+
+    @property
+    def overlay_size(self):
+        with self.lock:
+            return (sum(map(len, self.added.values()))
+                    + sum(map(len, self.removed.values())))
+
+    @property
+    def edge_count(self):
+        with self.lock:
+            return (len(self.neighbors)
+                    + sum(map(len, self.added.values()))
+                    - sum(map(len, self.removed.values())))
+
+
+class FollowGraph:
+    """Who follows whom, as two Adjacency directions."""
+
+    def __init__(self, followers, followed, loaded_at=None):
+        self._lock = threading.Lock()
+        self.following = Adjacency(followers, followed, self._lock)
+        self.followers = Adjacency(followed, followers, self._lock)
+        self.loaded_at = loaded_at if loaded_at is not None else time.time()
+        self._patched_at = {}
+
+    @classmethod
+    def load(cls, connection):
+        """Read every follow through `connection` (a DBAPI connection)."""
+
+        loaded_at = time.time()
+        followers, followed = copy_int_columns(connection, COPY_FOLLOWS, 2)
+
+        return cls(followers, followed, loaded_at)
+
+    def set(self, follower_id, followed_id, following, written_at):
+        """Record that `follower_id` started or stopped following
+        `followed_id` at `written_at`.
+
+        Changes older than the graph or than the last change to the same
+        pair are ignored, so applying one twice, or late, is harmless.
+        """
+
+        pair = (follower_id, followed_id)
+
+        with self._lock:
+            if written_at < self.loaded_at:
+                return
+            if self._patched_at.get(pair, 0) > written_at:
+                return
+
+            self._patched_at[pair] = written_at
+            self.following.set(follower_id, followed_id, following)
+            self.followers.set(followed_id, follower_id, following)
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        return self.following.contains(follower_id, followed_id)
+
+    def is_mutual(self, user_id, other_id):
+        """Do `user_id` and `other_id` follow each other?"""
+
+        return (self.following.contains(user_id, other_id)
+                and self.following.contains(other_id, user_id))
+
+    def following_ids(self, user_id):
+        """Sorted array of the ids `user_id` follows."""
+
+        return self.following.ids(user_id)
+
+    def follower_ids(self, user_id):
+        """Sorted array of the ids following `user_id`."""
+
+        return self.followers.ids(user_id)
+
+    def mutual_ids(self, user_id):
+        """Sorted array of the ids `user_id` follows who follow them back."""
+
+        return np.intersect1d(
+            self.following.ids(user_id),
+            self.followers.ids(user_id),
+            assume_unique=True)
+
+    def following_count(self, user_id):
+        return self.following.count(user_id)
+
+    def follower_count(self, user_id):
+        return self.followers.count(user_id)
+
+    def following_page(self, user_id, before, per_page):
+        """Return a Page of the ids `user_id` follows, highest first,
+        keyed like `paginate_by_key` pages.
+        """
+
+        return id_page(self.following.ids(user_id), before, per_page)
+
+    def followers_page(self, user_id, before, per_page):
+        """Return a Page of the ids following `user_id`, highest first."""
+
+        return id_page(self.followers.ids(user_id), before, per_page)
+
+    @property
+    def edge_count(self):
+        return self.following.edge_count
+
+
+def copy_int_columns(connection, copy_sql, columns):
+    """Run `copy_sql`, a binary COPY TO STDOUT of `columns` int4 columns
+    with no NULLs, through the DBAPI `connection`. Returns an int32 array
+    for each column.
+    """
+
+    row = np.dtype([('fields', '>i2')] + [
+        field
+        for i in range(columns)
+        for field in ((f'length{i}', '>i4'), (f'value{i}', '>i4'))
+    ])
+
+    buffer = io.BytesIO()
+    cursor = connection.cursor()
+    try:
+        cursor.copy_expert(copy_sql, buffer)
+    finally:
+        cursor.close()
+
+    data = buffer.getbuffer()
+    count = (len(data) - COPY_HEADER_BYTES - COPY_TRAILER_BYTES) // row.itemsize
+    rows = np.frombuffer(data, row, count=count, offset=COPY_HEADER_BYTES)
+
+    return tuple(rows[f'value{i}'].astype(np.int32) for i in range(columns))
+
+
+def id_page(ids, before, per_page):
+    """Return a Page of the sorted array `ids`, highest first, from below
+    the cursor `before`.
+    """
+
+    end = len(ids)
+    if before:
+        end = int(np.searchsorted(ids, decode_key_cursor(before)))
+
+    start = max(end - per_page, 0)
+    items = ids[start:end][::-1].tolist()
+
+    return Page(items, str(items[-1]) if start and items else None)
+
+
+class FollowGraphCache:
+    """Each process's FollowGraph, kept fresh and patched with follows."""
+
+    def __init__(self):
+        self._graph = None
+        self._stale = True
+        self._loading = False
+        self._recorded = []
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('FOLLOW_GRAPH_TTL', DEFAULT_TTL)
+        self._reload_on_commit()
+
+    def graph(self):
+        """Return this process's FollowGraph, with the current request's
+        own recorded follows applied.
+        """
+
+        if self._stale or self._graph is None:
+            self._load()
+        elif (time.time() - self._graph.loaded_at
+                > self.app.config['FOLLOW_GRAPH_TTL']):
+            self._load_in_background()
+
+        graph = self._graph
+
+        for write in self._session_writes():
+            graph.set(*write)
+
+        return graph
+
+    def record(self, follower_id, followed_id, following):
+        """Record a committed follow or unfollow, in this process's graph
+        and for the current browser's later requests to any process.
+        """
+
+        write = (follower_id, followed_id, following, time.time())
+
+        with self._lock:
+            if self._graph is not None:
+                self._graph.set(*write)
+            if self._loading:
+                self._recorded.append(write)
+
+        if has_request_context():
+            writes = self._session_writes()
+            writes.append(write)
+            session[FOLLOW_WRITES_KEY] = writes[-MAX_FOLLOW_WRITES:]
+
+    def clear(self):
+        """Drop the graph, so the next use loads it again."""
+
+        self._stale = True
+
+    def _session_writes(self):
+        """This browser's recorded follows that may not be in every
+        process's graph yet; forgets older ones.
+        """
+
+        if not has_request_context():
+            return []
+
+        writes = session.get(FOLLOW_WRITES_KEY)
+        if not writes:
+            return []
+
+        since = time.time() - 2 * self.app.config['FOLLOW_GRAPH_TTL']
+        recent = [tuple(write) for write in writes if write[3] > since]
+
+        if len(recent) < len(writes):
+            if recent:
+                session[FOLLOW_WRITES_KEY] = recent
+            else:
+                session.pop(FOLLOW_WRITES_KEY)
+
+        return recent
+
+    def _load(self):
+        """Load a new graph, replaying follows recorded while it loaded."""
+
+        with self._lock:
+            self._loading = True
+            self._recorded = []
+            self._stale = False
+
+        connection = db.engine.raw_connection()
+        try:
+            graph = FollowGraph.load(connection)
+            connection.commit()
+        except Exception:
+            self._stale = True
+            raise
+        finally:
+            connection.close()
+            with self._lock:
+                self._loading = False
+
+        with self._lock:
+            for write in self._recorded:
+                graph.set(*write)
+            self._recorded = []
+            self._graph = graph
+            self.loads += 1
+
+    def _load_in_background(self):
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+
+        def load():
+            with self.app.app_context():
+                try:
+                    self._load()
+                except Exception:
+                    self.app.logger.exception("Reloading the follow graph")
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def _reload_on_commit(self):
+        """Reload the graph after a commit that changed follows through
+        the ORM, which `record` doesn't see.
+        """
+
+        @event.listens_for(Session, 'after_flush')
+        def collect_follow_changes(session, flush_context):
+            for obj in (*session.new, *session.dirty, *session.deleted):
+                if isinstance(obj, Follow) or (
+                        isinstance(obj, User)
+                        and _follows_changed(obj)):
+                    session.info['follows_changed'] = True
+                    return
+
+        @event.listens_for(Session, 'after_commit')
+        def reload_graph(session):
+            if session.info.pop('follows_changed', False):
+                self.clear()
+
+        @event.listens_for(Session, 'after_rollback')
+        def forget_follow_changes(session):
+            session.info.pop('follows_changed', None)
+
+
+def _follows_changed(user):
+    attrs = inspect(user).attrs
+    return (attrs.following.history.has_changes()
+            or attrs.followers.history.has_changes())
+
+
+follow_graph = FollowGraphCache()
@@ -0,0 +1,104 @@
+"""Cache of rendered HTML fragments, such as message cards.
+
+Most of a message card (avatar, username, text, date) looks the same to
+every viewer, so it's rendered once and kept as HTML. The parts that depend
+on the viewer (like and follow buttons) are left as named slots, marked in
+the template with `{{ slot('name') }}`, and filled in on every render.
+
+Each entry is stored with a version built from everything the fragment
+shows; asking for a different version re-renders it. The cache is an LRU
+bounded by the total size of the HTML it holds.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+_SLOT_MARKER = '<!--slot:{}-->'
+_SLOT_PATTERN = re.compile(r'<!--slot:(\w+)-->')
+
+
+def slot(name):
+    """Mark where the per-viewer slot `name` goes in a cached fragment.
+
+    User content is escaped before it reaches the template, so it can
+    never produce a marker.
+    """
+
+    return Markup(_SLOT_MARKER.format(name))
+
+
+class FragmentCache:
+    """Thread-safe LRU of rendered fragments, bounded by size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, render):
+        """Return the fragment for `key` at `version`, calling `render()`
+        for its HTML on a miss.
+
+        Fragments are returned split on their slots:
+        [html, slot name, html, slot name, ..., html].
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        parts = _SLOT_PATTERN.split(render())
+        size = sum(len(part) for part in parts)
+
+        with self._lock:
+            self._remove(key)
+            if size <= self.max_bytes:
+                self._entries[key] = (version, parts, size)
+                self.size += size
+
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+        return parts
+
+    def invalidate(self, key):
+        """Drop any cached fragment for `key`."""
+
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """Drop every cached fragment."""
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry[2]
+
+
+def fill(parts, render_slot):
+    """Join fragment `parts`, replacing each slot with
+    `render_slot(name)`.
+    """
+
+    return Markup(''.join(
+        render_slot(part) if i % 2 else part
+        for i, part in enumerate(parts)
+    ))
@@ -3,33 +3,63 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+    python generator/create_csvs.py --users 100000 --messages 5000000 \\
+        --follows 10000000 --likes 10000000 --processes 8
+
+Rows are generated in fixed-size shards, each from its own seeded random
+generator, and streamed to disk, so memory use doesn't grow with the size
+of the dataset and the same --seed and --end-date always produce the same
+files, however many --processes are used.
+
+Follows and likes are drawn from a power-law distribution, so a few
+"celebrity" users and viral messages get most of them, like on a real
+social network.
+
+By default this runs offline. Pass --unsplash (with UNSPLASH_CID set) to use
+real header images from the Unsplash API.
 """
 
+import argparse
+import csv
 import os
-from dotenv import load_dotenv
+import shutil
+import tempfile
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
 
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+from dotenv import load_dotenv
 from faker import Faker
+
 from helpers import get_random_datetime
 
 load_dotenv()
 
-UNSPLASH_CID = os.environ['UNSPLASH_CID']
-
 MAX_WARBLER_LENGTH = 140
+MAX_USERNAME_LENGTH = 30
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id', 'timestamp']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 0
+
+# Rows per shard. Fixed (rather than derived from the process count) so
+# output only depends on --seed.
+SHARD_SIZE = 10_000
+
+# Exponents of the power laws used to pick who gets followed/liked and who
+# posts. Higher values concentrate more of the rows on the top few users.
+POPULARITY_EXPONENT = 1.2
+ACTIVITY_EXPONENT = 0.8
 
-fake = Faker()
+# bcrypt hash of "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
 # Generate random profile image URLs to use for users
 
@@ -39,51 +69,247 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-# NOTE: You will need to create a dev account at unsplash.com, 
-# generate an access key and set that to an environment
-# variable to successfully ping the API. 
+# Offline stand-ins for header images.
 
 header_image_urls = [
-    requests.get(
-        "https://api.unsplash.com/topics/wallpapers/photos" \
-        f"?per_page=30&orientation=landscape&client_id={UNSPLASH_CID}"
-    ).json()[i]['urls']['regular'] for i in range(0,29)
+    f"https://picsum.photos/seed/warbler{i}/1080/400" for i in range(30)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+def fetch_unsplash_header_image_urls():
+    """Get header image URLs from the Unsplash API.
+
+    NOTE: You will need to create a dev account at unsplash.com, generate
+    an access key and set that to the UNSPLASH_CID environment variable.
+    """
+
+    import requests
+
+    resp = requests.get(
+        "https://api.unsplash.com/topics/wallpapers/photos"
+        "?per_page=30&orientation=landscape"
+        f"&client_id={os.environ['UNSPLASH_CID']}"
+    )
+    return [photo['urls']['regular'] for photo in resp.json()]
+
+
+class PowerLaw:
+    """Draws ids 1..n so that a few ids are drawn far more than the rest.
+
+    Ranks follow a (continuous approximation of a) Zipf distribution and
+    are scrambled into ids, so the popular ids aren't simply 1, 2, 3... .
+    Uses constant memory however large n is.
+    """
+
+    def __init__(self, n, exponent=POPULARITY_EXPONENT, salt=0):
+        self.n = n
+        self.exponent = exponent
+        self._span = (n + 1) ** (1 - exponent) - 1
+
+        # Scramble ranks with a multiplier coprime to n, which makes
+        # rank -> id a bijection. Different salts give different orders, so
+        # e.g. the most followed users aren't also the most prolific.
+        self._offset = salt * 7_919 % n
+        self._multiplier = 2_654_435_761 % n or 1
+        while _gcd(self._multiplier, n) != 1:
+            self._multiplier += 1
+
+    def draw(self, rng):
+        """Return a random id in 1..n."""
+
+        u = rng.random()
+        rank = int((1 + u * self._span) ** (1 / (1 - self.exponent))) - 1
+        rank = min(rank, self.n - 1)
+        return (rank * self._multiplier + self._offset) % self.n + 1
+
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def split_evenly(total, parts, index):
+    """How many of `total` items go to part `index` of `parts`."""
+
+    return total // parts + (index < total % parts)
+
+
+def shard_rng(seed, table, shard):
+    """Random generator for one shard of one table."""
+
+    return Random(f"{seed}:{table}:{shard}")
+
+
+def generate_users(opts, shard, start, stop, writer):
+    rng = shard_rng(opts.seed, 'users', shard)
+    fake = Faker()
+    fake.seed_instance(rng.random())
+
+    for i in range(start, stop):
+        # Suffix the row number so usernames and emails are unique.
+        suffix = str(i + 1)
+        username = (fake.user_name()[:MAX_USERNAME_LENGTH - len(suffix)]
+                    + suffix)
+
+        writer.writerow(dict(
+            email=f"{username}@example.com",
+            username=username,
+            image_url=rng.choice(image_urls),
+            password=PASSWORD_HASH,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
+            header_image_url=rng.choice(opts.header_image_urls),
+            location=fake.city()[:30],
         ))
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
+def generate_messages(opts, shard, start, stop, writer):
+    rng = shard_rng(opts.seed, 'messages', shard)
+    fake = Faker()
+    fake.seed_instance(rng.random())
+    authors = PowerLaw(opts.users, ACTIVITY_EXPONENT, salt=1)
+
+    for i in range(start, stop):
+        writer.writerow(dict(
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+            timestamp=get_random_datetime(rng=rng, now=opts.end_date),
+            user_id=authors.draw(rng),
         ))
 
-# Generate follows.csv from random pairings of users
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+def generate_follows(opts, shard, start, stop, writer):
+    """Write the follows of users start+1..stop. Each user follows about
+    the same number of people; who they follow follows a power law.
+    """
+
+    rng = shard_rng(opts.seed, 'follows', shard)
+    popular = PowerLaw(opts.users)
+
+    for follower in range(start + 1, stop + 1):
+        count = split_evenly(opts.follows, opts.users, follower - 1)
+        for followed in _distinct_draws(
+                rng, popular, min(count, opts.users - 1), exclude=follower):
+            writer.writerow(dict(
+                user_being_followed_id=followed,
+                user_following_id=follower,
+            ))
+
+
+def generate_likes(opts, shard, start, stop, writer):
+    """Write the likes of users start+1..stop, drawing the liked messages
+    from a power law.
+    """
+
+    rng = shard_rng(opts.seed, 'likes', shard)
+    popular = PowerLaw(opts.messages)
+
+    for user in range(start + 1, stop + 1):
+        count = split_evenly(opts.likes, opts.users, user - 1)
+        for message in _distinct_draws(
+                rng, popular, min(count, opts.messages)):
+            writer.writerow(dict(
+                user_id=user,
+                message_id=message,
+                timestamp=get_random_datetime(rng=rng, now=opts.end_date),
+            ))
+
+
+def _distinct_draws(rng, dist, count, exclude=None):
+    """Draw `count` distinct ids from `dist`, skipping `exclude`."""
+
+    # Drawing nearly every id from a power law would take forever waiting
+    # for the rare ones, so fall back to a uniform sample.
+    if count * 2 > dist.n:
+        ids = [id for id in range(1, dist.n + 1) if id != exclude]
+        return sorted(rng.sample(ids, count))
+
+    seen = set()
+    while len(seen) < count:
+        id = dist.draw(rng)
+        if id != exclude:
+            seen.add(id)
+    return sorted(seen)
+
+
+# (file name, headers, generator, number of rows/users to shard over)
+TABLES = [
+    ('users.csv', USERS_CSV_HEADERS, generate_users, lambda o: o.users),
+    ('messages.csv', MESSAGES_CSV_HEADERS, generate_messages,
+     lambda o: o.messages),
+    ('follows.csv', FOLLOWS_CSV_HEADERS, generate_follows, lambda o: o.users),
+    ('likes.csv', LIKES_CSV_HEADERS, generate_likes, lambda o: o.users),
+]
+
+
+def write_shard(task):
+    """Generate one shard into its own part file and return its path."""
+
+    opts, table_index, shard, start, stop, part_dir = task
+    filename, headers, generate, _ = TABLES[table_index]
+    path = os.path.join(part_dir, f"{filename}.{shard:06}")
+
+    with open(path, 'w', newline='') as part:
+        generate(opts, shard, start, stop, csv.DictWriter(part, headers))
+
+    return path
+
+
+def write_table(opts, pool, table_index):
+    """Generate a table in shards across `pool`, then stitch the part
+    files together in order.
+    """
+
+    filename, headers, generate, size = TABLES[table_index]
+    total = size(opts)
+
+    with tempfile.TemporaryDirectory(dir=opts.out_dir) as part_dir:
+        tasks = [
+            (opts, table_index, shard, start,
+             min(start + SHARD_SIZE, total), part_dir)
+            for shard, start in enumerate(range(0, total, SHARD_SIZE))
+        ]
+
+        with open(os.path.join(opts.out_dir, filename), 'w',
+                  newline='') as out:
+            csv.DictWriter(out, headers).writeheader()
+
+            for done, path in enumerate(pool.imap(write_shard, tasks), 1):
+                with open(path) as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(path)
+                print(f"{filename}: {done}/{len(tasks)} shards", flush=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--seed', default='warbler',
+                        help="same seed, same output")
+    parser.add_argument('--end-date', type=datetime.fromisoformat,
+                        default=datetime.now().replace(
+                            hour=0, minute=0, second=0, microsecond=0),
+                        help="latest timestamp to generate (default: today)")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--out-dir', default='generator')
+    parser.add_argument('--unsplash', action='store_true',
+                        help="fetch header images from the Unsplash API")
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+    opts.header_image_urls = (
+        fetch_unsplash_header_image_urls() if opts.unsplash
+        else header_image_urls)
+
+    with Pool(opts.processes) as pool:
+        for table_index in range(len(TABLES)):
+            write_table(opts, pool, table_index)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
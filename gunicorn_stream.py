@@ -0,0 +1,30 @@
+"""Gunicorn settings for serving live timeline streams.
+
+A stream (see timeline_stream.py) is open for minutes while doing next to
+nothing, which would tie up a sync worker for all of it. These settings
+run gevent workers instead, each holding up to WORKER_CONNECTIONS open
+connections, with psycopg2 patched to wait on the database cooperatively.
+Route /timeline/stream to servers started with:
+
+    gunicorn -c gunicorn_stream.py app:app
+
+and leave the rest of the app on sync workers if you like.
+"""
+
+import os
+
+bind = os.environ.get('STREAM_BIND', '0.0.0.0:8001')
+workers = int(os.environ.get('STREAM_WORKERS', 2))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 5000))
+
+# An async worker keeps checking in while its streams are open, so this
+# doesn't cut them off; they close after TIMELINE_STREAM_SECONDS.
+timeout = 30
+graceful_timeout = 10
+
+
+def post_fork(server, worker):
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
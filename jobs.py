@@ -0,0 +1,231 @@
+"""Background jobs, queued in PostgreSQL.
+
+Work that doesn't need to finish before a response is sent is added to
+the `jobs` table with `jobs.enqueue(...)`. The job is added to the
+session like any other row, so it's committed (or rolled back) together
+with the request's own writes: a job is never run for a change that
+didn't happen, nor lost for one that did.
+
+`flask worker` runs the jobs. Each worker claims one job at a time with
+SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers can share the
+table without handing out a job twice or waiting on each other's locks.
+
+- A job that raises is retried after a delay that doubles with each
+  attempt (JOB_RETRY_BACKOFF_SECONDS, 2x, 4x, ... up to an hour). Once it
+  has used its `max_attempts`, it's left in the table as `failed`, with
+  the error, for someone to look at.
+- A job still `running` JOB_TIMEOUT_SECONDS after it was claimed is
+  assumed to belong to a worker that died, and is claimed again. Jobs
+  should therefore be safe to run more than once.
+- A job type registered with `concurrency=N` has at most N jobs running
+  at once across all workers, e.g. to keep heavy deletes from crowding
+  out everything else.
+
+Job durations are recorded in `metrics.job_seconds`; `flask worker
+--metrics-port` serves them from the worker process.
+"""
+
+import time
+import traceback
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, func, or_, select, update
+
+from metrics import metrics
+from models import db, Job
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_POLL_SECONDS = 1
+DEFAULT_TIMEOUT_SECONDS = 15 * 60
+DEFAULT_RETRY_BACKOFF_SECONDS = 10
+MAX_RETRY_BACKOFF_SECONDS = 60 * 60
+
+# First key of the advisory locks that serialize claiming jobs of a type
+# with a concurrency limit; the second is a hash of the type.
+CLAIM_LOCK_NAMESPACE = 0x6a6f6273
+
+# Longest error kept on a job.
+MAX_ERROR_LENGTH = 4000
+
+Handler = namedtuple('Handler', ['fn', 'concurrency', 'max_attempts'])
+
+
+class JobQueue:
+    """Registry of job types, and the worker side that runs them."""
+
+    def __init__(self):
+        self.handlers = {}
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('JOB_POLL_SECONDS', DEFAULT_POLL_SECONDS)
+        app.config.setdefault('JOB_TIMEOUT_SECONDS', DEFAULT_TIMEOUT_SECONDS)
+        app.config.setdefault(
+            'JOB_RETRY_BACKOFF_SECONDS', DEFAULT_RETRY_BACKOFF_SECONDS)
+
+    def job(self, type, concurrency=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Decorator registering a function as the handler for jobs of
+        `type`. It's called with the job's payload as keyword arguments.
+        """
+
+        def register(fn):
+            self.handlers[type] = Handler(fn, concurrency, max_attempts)
+            return fn
+
+        return register
+
+    def enqueue(self, type, run_at=None, **payload):
+        """Add a job of `type` to the session; the caller commits.
+
+        `payload` must be JSON serializable.
+        """
+
+        job = Job(
+            type=type,
+            payload=payload,
+            max_attempts=self.handlers[type].max_attempts,
+            run_at=run_at or datetime.utcnow(),
+        )
+        db.session.add(job)
+        return job
+
+    def run_one(self):
+        """Claim and run the next job that's due. Returns False if there
+        wasn't one.
+        """
+
+        claimed = self._claim()
+        if claimed is None:
+            return False
+
+        job_id, type, payload, attempts, max_attempts = claimed
+        start = time.perf_counter()
+
+        try:
+            self.handlers[type].fn(**payload)
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            self.app.logger.exception("Job %s (%s) failed", job_id, type)
+            outcome = self._fail(
+                job_id, attempts, max_attempts, traceback.format_exc())
+
+        else:
+            db.session.execute(delete(Job).where(Job.id == job_id))
+            db.session.commit()
+            outcome = 'done'
+
+        metrics.job_seconds.observe(
+            (type, outcome), time.perf_counter() - start)
+        return True
+
+    def run_pending(self):
+        """Run jobs until none are due. Returns how many were run."""
+
+        count = 0
+        while self.run_one():
+            count += 1
+        return count
+
+    def work(self, should_stop=lambda: False):
+        """Run jobs as they come due until `should_stop()` is true."""
+
+        poll_seconds = self.app.config['JOB_POLL_SECONDS']
+
+        while not should_stop():
+            if not self.run_one():
+                time.sleep(poll_seconds)
+
+    def _claim(self):
+        """Mark the next due job running and commit. Returns its id, type,
+        payload, attempts and max attempts, or None if no job is due.
+        """
+
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=self.app.config['JOB_TIMEOUT_SECONDS'])
+        full = set()
+
+        while True:
+            job = db.session.scalars(
+                select(Job)
+                .where(
+                    Job.type.in_(list(self.handlers.keys() - full)),
+                    or_(and_(Job.state == 'queued', Job.run_at <= now),
+                        and_(Job.state == 'running', Job.locked_at < stale)))
+                .order_by(Job.run_at, Job.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            ).first()
+
+            if job is None:
+                db.session.rollback()
+                return None
+
+            concurrency = self.handlers[job.type].concurrency
+
+            if concurrency is not None:
+                # Workers claiming this type take turns, so the count
+                # includes every claim committed before ours.
+                db.session.execute(select(func.pg_advisory_xact_lock(
+                    CLAIM_LOCK_NAMESPACE, func.hashtext(job.type))))
+
+                running = db.session.scalar(
+                    select(func.count())
+                    .select_from(Job)
+                    .where(Job.type == job.type,
+                           Job.state == 'running',
+                           Job.locked_at >= stale))
+
+                if running >= concurrency:
+                    db.session.rollback()
+                    full.add(job.type)
+                    continue
+
+            job.state = 'running'
+            job.locked_at = now
+            job.attempts += 1
+            claimed = (job.id, job.type, job.payload, job.attempts,
+                       job.max_attempts)
+            db.session.commit()
+
+            return claimed
+
+    def _fail(self, job_id, attempts, max_attempts, error):
+        """Schedule a failed job's retry, or mark it failed for good.
+        Returns the outcome recorded in the metrics.
+        """
+
+        if attempts >= max_attempts:
+            values = {'state': 'failed'}
+            outcome = 'failed'
+        else:
+            backoff = min(
+                self.app.config['JOB_RETRY_BACKOFF_SECONDS']
+                * 2 ** (attempts - 1),
+                MAX_RETRY_BACKOFF_SECONDS)
+            values = {
+                'state': 'queued',
+                'run_at': datetime.utcnow() + timedelta(seconds=backoff),
+            }
+            outcome = 'retry'
+
+        db.session.execute(
+            update(Job)
+            .where(Job.id == job_id)
+            .values(locked_at=None, last_error=error[-MAX_ERROR_LENGTH:],
+                    **values)
+        )
+        db.session.commit()
+
+        return outcome
+
+    def counts(self):
+        """Return the number of jobs in each state."""
+
+        return dict(db.session.execute(
+            select(Job.state, func.count()).group_by(Job.state)).all())
+
+
+jobs = JobQueue()
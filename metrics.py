@@ -0,0 +1,333 @@
+"""Lightweight request instrumentation for Warbler.
+
+`Metrics` hooks SQLAlchemy's engine events and Flask's request and template
+signals to record, per endpoint:
+
+- request latency,
+- SQL statements issued and time spent in the database,
+- time spent rendering templates,
+
+as histograms, along with how long database connection checkouts wait
+(recorded by `routing.TimedQueuePool`) and how long background jobs take
+(recorded by `jobs.JobQueue`), and serves them (plus any registered gauges
+and counters) in the Prometheus text format at /metrics.
+
+/metrics answers only scrapes from an address in METRICS_ALLOWED_IPS
+(default: this host) or with an `Authorization: Bearer` header matching
+METRICS_TOKEN; anything else gets a 403.
+
+Requests slower than SLOW_REQUEST_SECONDS (default 0.5) are logged with
+the SQL they ran, so a slow page can be traced to its queries without a
+profiler attached.
+"""
+
+import bisect
+import hmac
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from flask import (
+    Response, abort, current_app, request, template_rendered,
+    before_render_template)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_SLOW_REQUEST_SECONDS = 0.5
+DEFAULT_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+LATENCY_BUCKETS = (
+    .005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 7.5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 7, 10, 20, 50, 100)
+POOL_WAIT_BUCKETS = (
+    .0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 10, 30)
+JOB_BUCKETS = (.01, .05, .1, .5, 1, 5, 10, 30, 60, 300, 900)
+
+# Statements kept per request for the slow request log.
+MAX_LOGGED_STATEMENTS = 50
+
+
+class Histogram:
+    """Thread-safe Prometheus-style histogram with one label set per
+    observed combination of label values.
+    """
+
+    def __init__(self, name, help, buckets, label_names):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        """Record `value` for the label values `labels`."""
+
+        with self._lock:
+            counts, total = self._series.get(
+                labels, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._series[labels] = (counts, total + value)
+
+    def render(self):
+        """Return the histogram's lines in the Prometheus text format."""
+
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            series = sorted(
+                (labels, list(counts), total)
+                for labels, (counts, total) in self._series.items())
+
+        for labels, counts, total in series:
+            label_text = ','.join(
+                f'{name}="{_escape(value)}"'
+                for name, value in zip(self.label_names, labels))
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},'
+                             f'le="{bound}"}} {cumulative}')
+
+            lines.append(f"{self.name}_sum{{{label_text}}} {total}")
+            lines.append(f"{self.name}_count{{{label_text}}} {cumulative}")
+
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"')
+
+
+class Metrics:
+    """Per-endpoint request metrics, exposed at /metrics."""
+
+    def __init__(self):
+        self.request_seconds = Histogram(
+            'warbler_request_duration_seconds',
+            "Time to handle a request.",
+            LATENCY_BUCKETS, ('endpoint', 'method'))
+        self.query_count = Histogram(
+            'warbler_request_queries',
+            "SQL statements issued per request.",
+            QUERY_COUNT_BUCKETS, ('endpoint', 'method'))
+        self.db_seconds = Histogram(
+            'warbler_request_db_seconds',
+            "Time spent running SQL per request.",
+            LATENCY_BUCKETS, ('endpoint', 'method'))
+        self.template_seconds = Histogram(
+            'warbler_request_template_seconds',
+            "Time spent rendering templates per request.",
+            LATENCY_BUCKETS, ('endpoint', 'method'))
+        self.pool_wait_seconds = Histogram(
+            'warbler_db_pool_wait_seconds',
+            "Time spent waiting to check a connection out of a pool.",
+            POOL_WAIT_BUCKETS, ('pool',))
+        self.job_seconds = Histogram(
+            'warbler_job_duration_seconds',
+            "Time to run a background job, by how the run ended.",
+            JOB_BUCKETS, ('type', 'outcome'))
+        self._collected = []
+        self._local = threading.local()
+
+    def init_app(self, app):
+        """Start recording `app`'s requests and add the /metrics route."""
+
+        self.slow_request_seconds = app.config.setdefault(
+            'SLOW_REQUEST_SECONDS', DEFAULT_SLOW_REQUEST_SECONDS)
+        self.logger = app.logger
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_ALLOWED_IPS', DEFAULT_ALLOWED_IPS)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._finish_template, app)
+
+        event.listen(Engine, 'before_cursor_execute', self._start_statement)
+        event.listen(Engine, 'after_cursor_execute', self._finish_statement)
+
+        app.add_url_rule('/metrics', 'metrics', self.render_response)
+
+    def gauge(self, name, help, fn):
+        """Report the current value of `fn()` as gauge `name`."""
+
+        self._collected.append((name, help, 'gauge', fn))
+
+    def counter(self, name, help, fn):
+        """Report the running total `fn()` as counter `name`."""
+
+        self._collected.append((name, help, 'counter', fn))
+
+    def per_scrape(self, fn):
+        """Return a function that calls `fn` once per render and repeats
+        its result, for metrics read from one query.
+        """
+
+        def once():
+            scrape = getattr(self._local, 'scrape', None)
+            if scrape is None:
+                return fn()
+            if fn not in scrape:
+                scrape[fn] = fn()
+            return scrape[fn]
+
+        return once
+
+    def allowed(self, config, remote_addr, authorization):
+        """Can a scrape from `remote_addr`, with the Authorization header
+        `authorization`, read the metrics?
+        """
+
+        if remote_addr in config['METRICS_ALLOWED_IPS']:
+            return True
+
+        token = config['METRICS_TOKEN']
+        return bool(token) and hmac.compare_digest(
+            (authorization or '').encode(), f"Bearer {token}".encode())
+
+    def render(self):
+        """Return every metric in the Prometheus text format."""
+
+        lines = []
+        self._local.scrape = {}
+
+        for histogram in (self.request_seconds, self.query_count,
+                          self.db_seconds, self.template_seconds,
+                          self.pool_wait_seconds, self.job_seconds):
+            lines.extend(histogram.render())
+
+        try:
+            for name, help, kind, fn in self._collected:
+                lines.extend([f"# HELP {name} {help}",
+                              f"# TYPE {name} {kind}",
+                              f"{name} {fn()}"])
+        finally:
+            self._local.scrape = None
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, app, port):
+        """Serve the metrics at http://0.0.0.0:`port`/ from a background
+        thread, for processes like the job worker that don't serve `app`.
+        """
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not metrics.allowed(app.config, self.client_address[0],
+                                       self.headers.get('Authorization')):
+                    self.send_error(403)
+                    return
+
+                with app.app_context():
+                    body = metrics.render().encode()
+
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def render_response(self):
+        if not self.allowed(current_app.config, request.remote_addr,
+                            request.headers.get('Authorization')):
+            abort(403)
+
+        return Response(
+            self.render(), mimetype='text/plain; version=0.0.4')
+
+    # Request state lives in a thread local rather than on `g`, since `g`
+    # outlives a request when an app context is already pushed.
+
+    def _start_request(self):
+        self._local.request = {
+            'start': time.perf_counter(),
+            'queries': 0,
+            'db_seconds': 0.0,
+            'template_seconds': 0.0,
+            'statements': [],
+        }
+
+    def _finish_request(self, response):
+        stats = getattr(self._local, 'request', None)
+        if stats is None:
+            return response
+
+        labels = (request.endpoint or 'unknown', request.method)
+        path = request.full_path
+
+        # A streamed body is rendered, and queried for, after this. Event
+        # streams stay open for minutes and don't query, so they're timed
+        # up to here.
+        if (response.is_streamed
+                and response.mimetype != 'text/event-stream'):
+            response.call_on_close(
+                lambda: self._record_request(stats, labels, path))
+        else:
+            self._record_request(stats, labels, path)
+
+        return response
+
+    def _record_request(self, stats, labels, path):
+        if getattr(self._local, 'request', None) is stats:
+            self._local.request = None
+
+        elapsed = time.perf_counter() - stats['start']
+
+        self.request_seconds.observe(labels, elapsed)
+        self.query_count.observe(labels, stats['queries'])
+        self.db_seconds.observe(labels, stats['db_seconds'])
+        self.template_seconds.observe(labels, stats['template_seconds'])
+
+        if elapsed >= self.slow_request_seconds:
+            statements = '\n'.join(
+                f"  {seconds * 1000:.1f}ms {statement}"
+                for seconds, statement in stats['statements'])
+            self.logger.warning(
+                "Slow request: %s %s took %.0fms (%d queries, %.0fms in "
+                "SQL, %.0fms rendering)\n%s",
+                labels[1], path, elapsed * 1000,
+                stats['queries'], stats['db_seconds'] * 1000,
+                stats['template_seconds'] * 1000, statements)
+
+    def _start_template(self, app, template, context, **extra):
+        self._local.template_start = time.perf_counter()
+
+    def _finish_template(self, app, template, context, **extra):
+        stats = getattr(self._local, 'request', None)
+        start = getattr(self._local, 'template_start', None)
+        if stats is not None and start is not None:
+            stats['template_seconds'] += time.perf_counter() - start
+
+    def _start_statement(self, conn, cursor, statement, parameters,
+                         context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _finish_statement(self, conn, cursor, statement, parameters,
+                          context, executemany):
+        start = conn.info['query_start'].pop()
+        stats = getattr(self._local, 'request', None)
+        if stats is None:
+            return
+
+        elapsed = time.perf_counter() - start
+        stats['queries'] += 1
+        stats['db_seconds'] += elapsed
+        if len(stats['statements']) < MAX_LOGGED_STATEMENTS:
+            stats['statements'].append((elapsed, ' '.join(statement.split())))
+
+
+metrics = Metrics()
@@ -0,0 +1,49 @@
+"""Add user counters
+
+Denormalized message, following, follower and like counts on users,
+filled in from the underlying tables as User.reconcile_counts does.
+
+Revision ID: 22d0f281c241
+Revises: 681cee277ae8
+Create Date: 2026-10-17 05:20:33.918452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '22d0f281c241'
+down_revision = '681cee277ae8'
+branch_labels = None
+depends_on = None
+
+COUNTERS = [
+    ('message_count', 'messages', 'user_id'),
+    ('following_count', 'follows', 'user_following_id'),
+    ('follower_count', 'follows', 'user_being_followed_id'),
+    ('like_count', 'likes', 'user_id'),
+]
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        for counter, _, _ in COUNTERS:
+            batch_op.add_column(sa.Column(counter, sa.Integer(), server_default='0', nullable=False))
+
+    for counter, table, key in COUNTERS:
+        op.execute(f"""
+            UPDATE users SET {counter} = counts.count
+            FROM (
+                SELECT {key} AS user_id, count(*) AS count
+                FROM {table}
+                GROUP BY {key}
+            ) AS counts
+            WHERE users.id = counts.user_id
+        """)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        for counter, _, _ in reversed(COUNTERS):
+            batch_op.drop_column(counter)
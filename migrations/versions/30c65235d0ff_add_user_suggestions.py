@@ -0,0 +1,46 @@
+"""Add user suggestions
+
+Precomputed "who to follow" suggestions (see suggestions.py), and the
+users whose suggestions need recomputing.
+
+Revision ID: 30c65235d0ff
+Revises: e38939818898
+Create Date: 2026-10-17 06:24:04.645206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '30c65235d0ff'
+down_revision = 'e38939818898'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('suggestion_refreshes',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_table('user_suggestions',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.SmallInteger(), nullable=False),
+    sa.Column('suggested_user_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['suggested_user_id'], ['users.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'rank')
+    )
+    with op.batch_alter_table('user_suggestions', schema=None) as batch_op:
+        batch_op.create_index('ix_user_suggestions_suggested_user_id', ['suggested_user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user_suggestions', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_suggestions_suggested_user_id')
+
+    op.drop_table('user_suggestions')
+    op.drop_table('suggestion_refreshes')
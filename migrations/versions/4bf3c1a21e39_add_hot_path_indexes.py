@@ -0,0 +1,63 @@
+"""Add hot path indexes
+
+Indexes for looking up a user's messages newest first, a message's likes
+and the users someone follows. Each covers its query, so they can be
+answered from the index alone.
+
+They're built CONCURRENTLY, so writes to these tables aren't blocked
+while a large production table is indexed. That can't run inside a
+transaction, hence the autocommit blocks.
+
+Revision ID: 4bf3c1a21e39
+Revises: 8101b1578709
+Create Date: 2026-10-17 05:20:39.770909
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4bf3c1a21e39'
+down_revision = '8101b1578709'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages',
+     ['user_id', 'timestamp', 'id']),
+    ('ix_likes_message_id', 'likes', ['message_id', 'user_id']),
+    ('ix_follows_user_following_id', 'follows',
+     ['user_following_id', 'user_being_followed_id']),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            # A concurrent build that fails leaves an invalid index behind;
+            # drop it so the migration can simply be rerun.
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
+            op.create_index(
+                name,
+                table,
+                columns,
+                unique=False,
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
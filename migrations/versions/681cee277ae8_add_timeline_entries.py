@@ -0,0 +1,61 @@
+"""Add timeline entries
+
+Each user's home timeline, written as messages are posted (see
+TimelineEntry). Filled in from existing messages and follows: a user's
+own messages and the latest 100 of each user they follow, as a new follow
+backfills.
+
+Revision ID: 681cee277ae8
+Revises: d490faa18270
+Create Date: 2026-10-17 05:20:31.204167
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '681cee277ae8'
+down_revision = 'd490faa18270'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline_entries',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id')
+    )
+    with op.batch_alter_table('timeline_entries', schema=None) as batch_op:
+        batch_op.create_index('ix_timeline_entries_user_id_timestamp', ['user_id', 'timestamp', 'message_id'], unique=False)
+
+    # TimelineEntry.rebuild for every user, ranking each author's messages
+    # once rather than per follower, since messages has no index on
+    # user_id yet.
+    op.execute("""
+        INSERT INTO timeline_entries (user_id, message_id, timestamp)
+        SELECT user_id, id, timestamp
+        FROM messages
+        UNION ALL
+        SELECT follows.user_following_id, recent.id, recent.timestamp
+        FROM follows
+        JOIN (
+            SELECT id, timestamp, user_id,
+                   row_number() OVER (PARTITION BY user_id
+                                      ORDER BY timestamp DESC) AS n
+            FROM messages
+        ) AS recent ON recent.user_id = follows.user_being_followed_id
+        WHERE recent.n <= 100
+        ON CONFLICT DO NOTHING
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('timeline_entries', schema=None) as batch_op:
+        batch_op.drop_index('ix_timeline_entries_user_id_timestamp')
+
+    op.drop_table('timeline_entries')
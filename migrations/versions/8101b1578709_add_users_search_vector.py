@@ -0,0 +1,48 @@
+"""Add users.search_vector
+
+A generated tsvector of each user's username, location and bio for
+User.search, with a GIN index. Adding the stored column rewrites users;
+the index is built CONCURRENTLY after that, as in the hot path indexes.
+
+Revision ID: 8101b1578709
+Revises: 22d0f281c241
+Create Date: 2026-10-17 05:20:36.655210
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8101b1578709'
+down_revision = '22d0f281c241'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("setweight(to_tsvector('simple', username), 'A') || setweight(to_tsvector('simple', location), 'B') || setweight(to_tsvector('simple', bio), 'C')", persisted=True), nullable=True))
+
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_users_search_vector',
+            table_name='users',
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        op.create_index(
+            'ix_users_search_vector',
+            'users',
+            ['search_vector'],
+            unique=False,
+            postgresql_using='gin',
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_index('ix_users_search_vector', postgresql_using='gin')
+        batch_op.drop_column('search_vector')
@@ -0,0 +1,56 @@
+"""Add message scores
+
+Trending scores for messages (see MessageScore), filled in from the likes
+of the last five days.
+
+Revision ID: a8b1b7a5d762
+Revises: 30c65235d0ff
+Create Date: 2026-10-17 06:30:05.411939
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8b1b7a5d762'
+down_revision = '30c65235d0ff'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('message_scores',
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('message_id')
+    )
+    with op.batch_alter_table('message_scores', schema=None) as batch_op:
+        batch_op.create_index('ix_message_scores_score', ['score'], unique=False)
+
+    # MessageScore.rebuild as of this revision: a 6 hour half-life from
+    # 2024-01-01, over 20 half-lives.
+    op.execute("""
+        INSERT INTO message_scores (message_id, score)
+        SELECT message_id,
+               max(top) + ln(sum(exp(greatest(x - top, -700))))
+        FROM (
+            SELECT message_id, x, max(x) OVER (PARTITION BY message_id) AS top
+            FROM (
+                SELECT message_id,
+                       extract(epoch FROM timestamp - '2024-01-01')
+                       / 21600 * ln(2) AS x
+                FROM likes
+                WHERE timestamp > now() at time zone 'utc' - interval '5 days'
+            ) AS weighted
+        ) AS likes
+        GROUP BY message_id
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('message_scores', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_scores_score')
+
+    op.drop_table('message_scores')
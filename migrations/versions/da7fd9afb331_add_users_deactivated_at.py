@@ -0,0 +1,30 @@
+"""Add users.deactivated_at
+
+Deleted accounts are marked deactivated, which hides them straight away,
+and their rows are purged in batches afterwards. Adding a nullable column
+without a default doesn't rewrite the table.
+
+Revision ID: da7fd9afb331
+Revises: 4bf3c1a21e39
+Create Date: 2026-10-17 05:30:10.000431
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'da7fd9afb331'
+down_revision = '4bf3c1a21e39'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('deactivated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('deactivated_at')
@@ -1,12 +1,24 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import math
+import re
+from datetime import datetime, timedelta
 
-from flask_bcrypt import Bcrypt
+from flask_migrate import upgrade
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import contains_eager
+from sqlalchemy import (
+    case, delete, event, func, literal, select, true, tuple_, union_all,
+    update)
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR, insert
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+from routing import RoutingSession
+from pagination import (
+    Page, decode_timestamp_cursor, paginate_by_key, paginate_by_offset,
+    paginate_by_timestamp)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
@@ -17,6 +29,34 @@ DEFAULT_HEADER_IMAGE_URL = (
     "rb-4.0.3&ixid=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=for" +
     "mat&fit=crop&w=2070&q=80")
 
+# How many of a user's recent messages are copied into a new follower's
+# home timeline when the follow is added.
+TIMELINE_BACKFILL_SIZE = 100
+
+# Search results can't be keyed, so cap how many pages deep they go.
+MAX_SEARCH_PAGES = 20
+
+# A like's weight in a message's trending score halves every
+# TREND_HALF_LIFE. Scores are stored relative to TREND_EPOCH, so changing
+# either means running MessageScore.rebuild. Scores that have decayed
+# below one like TREND_MAX_AGE old are pruned.
+TREND_HALF_LIFE = timedelta(hours=6)
+TREND_EPOCH = datetime(2024, 1, 1)
+TREND_MAX_AGE = 20 * TREND_HALF_LIFE
+
+# Postgres raises an error rather than underflow to 0 in exp(), so keep
+# exponents above this; exp(-700) is ~1e-304.
+MIN_EXPONENT = -700
+
+
+def to_prefix_tsquery(text):
+    """Turn free text into a tsquery matching every word as a prefix, e.g.
+    "matt fer" -> "matt:* & fer:*". Returns None if there are no words.
+    """
+
+    words = re.findall(r"[^\W_]+", text.lower())
+    return " & ".join(f"{word}:*" for word in words) or None
+
 
 class Follow(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -35,6 +75,76 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with the followed user, so looking up who a
+    # user follows needs its own index.
+    __table_args__ = (
+        db.Index(
+            'ix_follows_user_following_id',
+            user_following_id, user_being_followed_id,
+        ),
+    )
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id` and update both users'
+        counters. Does nothing if they already do.
+
+        Returns whether a follow was added.
+        """
+
+        added = db.session.execute(
+            insert(cls)
+            .values(user_being_followed_id=followed_id,
+                    user_following_id=follower_id)
+            .on_conflict_do_nothing()
+            .returning(cls.user_following_id)
+        ).first() is not None
+
+        if added:
+            cls._update_counts(follower_id, followed_id, 1)
+
+        return added
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Make `follower_id` stop following `followed_id` and update both
+        users' counters. Does nothing if they don't follow them.
+
+        Returns whether a follow was removed.
+        """
+
+        removed = db.session.execute(
+            delete(cls)
+            .where(cls.user_being_followed_id == followed_id,
+                   cls.user_following_id == follower_id)
+            .returning(cls.user_following_id)
+        ).first() is not None
+
+        if removed:
+            cls._update_counts(follower_id, followed_id, -1)
+
+        return removed
+
+    @staticmethod
+    def _update_counts(follower_id, followed_id, change):
+        """Add `change` to the follower's following count and the followed
+        user's follower count, in one statement.
+        """
+
+        db.session.execute(
+            update(User)
+            .where(User.id.in_([follower_id, followed_id]))
+            .values(
+                following_count=case(
+                    (User.id == follower_id, User.following_count + change),
+                    else_=User.following_count),
+                follower_count=case(
+                    (User.id == followed_id, User.follower_count + change),
+                    else_=User.follower_count),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
 
 class User(db.Model):
     """User in the system."""
@@ -87,24 +197,85 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Full-text search document over username, location and bio, weighted
+    # in that order. Maintained by the database.
+    search_vector = db.Column(
+        TSVECTOR,
+        db.Computed(
+            "setweight(to_tsvector('simple', username), 'A') || "
+            "setweight(to_tsvector('simple', location), 'B') || "
+            "setweight(to_tsvector('simple', bio), 'C')",
+            persisted=True,
+        ),
+    )
+
+    # Denormalized counts so profile headers don't load whole collections.
+    # Kept up to date by the views' write paths; rebuild them with
+    # `flask reconcile-counts` if they drift.
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Set when the account is deleted; the rows are purged afterwards (see
+    # deletion.py). Deactivated users can't log in and aren't shown.
+    deactivated_at = db.Column(
+        db.DateTime,
+    )
+
+    # passive_deletes: the foreign keys cascade, so deleting a user or
+    # message never needs to load these collections.
+
     messages = db.relationship(
         'Message',
         order_by="desc(Message.timestamp)",
-        backref="user")
+        backref="user",
+        passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follow.user_being_followed_id == id),
         secondaryjoin=(Follow.user_following_id == id),
-        backref="following",
+        backref=db.backref("following", passive_deletes=True),
+        passive_deletes=True,
     )
 
     liked_messages = db.relationship(
         "Message",
         order_by="desc(Message.timestamp)",
         secondary="likes",
-        backref="liked_by")
+        backref=db.backref("liked_by", passive_deletes=True),
+        passive_deletes=True)
+
+    __table_args__ = (
+        db.Index('ix_users_search_vector', search_vector,
+                 postgresql_using='gin'),
+    )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
@@ -116,7 +287,7 @@ class User(db.Model):
         Hashes password and adds user to session.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -138,30 +309,191 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the stored hash was made with a different bcrypt cost than the
+        one configured, it is replaced with a new hash; the caller commits.
         """
 
-        user = cls.query.filter_by(username=username).one_or_none()
+        user = (cls
+                .query
+                .filter_by(username=username, deactivated_at=None)
+                .one_or_none())
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
+    @classmethod
+    def get_active_or_404(cls, user_id):
+        """Return the user with `user_id`, or abort with a 404 if there is
+        none or their account has been deleted.
+        """
+
+        return db.first_or_404(
+            select(cls).where(cls.id == user_id, cls.deactivated_at.is_(None)))
+
+    @classmethod
+    def search(cls, text, page, per_page, stream=False):
+        """Return a Page of users matching `text`, best matches first.
+
+        Every word in `text` must prefix a word in the user's username,
+        location or bio; username matches rank highest. If `stream`, the
+        Page is a StreamedPage.
+        """
+
+        tsquery = to_prefix_tsquery(text)
+        if tsquery is None:
+            return Page([], cursor_param="page")
+
+        tsquery = func.to_tsquery('simple', tsquery)
+        query = (cls
+                 .query
+                 .filter(cls.search_vector.op('@@')(tsquery),
+                         cls.deactivated_at.is_(None))
+                 .order_by(func.ts_rank(cls.search_vector, tsquery).desc(),
+                           cls.id))
+
+        return paginate_by_offset(
+            query, page, per_page, MAX_SEARCH_PAGES, stream)
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the underlying tables.
+
+        Each counter is one grouped aggregate joined back onto users, so
+        each table is scanned once rather than once per user.
+        """
+
+        db.session.execute(
+            update(cls).values(
+                message_count=0,
+                following_count=0,
+                follower_count=0,
+                like_count=0,
+            )
+        )
+
+        for counter, key in [
+            (cls.message_count, Message.user_id),
+            (cls.following_count, Follow.user_following_id),
+            (cls.follower_count, Follow.user_being_followed_id),
+            (cls.like_count, Like.user_id),
+        ]:
+            counts = (
+                select(key.label('user_id'), func.count().label('count'))
+                .group_by(key)
+                .subquery()
+            )
+            db.session.execute(
+                update(cls)
+                .where(cls.id == counts.c.user_id)
+                .values({counter: counts.c.count})
+            )
+
+    def messages_page(self, before, per_page, stream=False):
+        """Return a Page of this user's messages, newest first."""
+
+        query = Message.query.filter(Message.user_id == self.id)
+
+        return paginate_by_timestamp(
+            query, Message.timestamp, Message.id, before, per_page, stream)
+
+    def liked_messages_page(self, before, per_page, stream=False):
+        """Return a Page of messages this user has liked, keyed on the
+        liked message's id.
+        """
+
+        query = (Message
+                 .query
+                 .join(Message.user)
+                 .options(contains_eager(Message.user))
+                 .join(Like, Like.message_id == Message.id)
+                 .filter(Like.user_id == self.id,
+                         User.deactivated_at.is_(None)))
+
+        return paginate_by_key(
+            query, Like.message_id, before, per_page, stream)
+
+    # Per-instance membership caches, filled on first use and cleared
+    # whenever the instance is expired (see `_clear_membership_caches`).
+    # Since `g.user` is loaded fresh each request, they last one request.
+    _following_ids = None
+    _liked_message_ids = None
+    _likes_checked = None
+
+    @property
+    def following_ids(self):
+        """Frozenset of ids of the users this user follows."""
+
+        if self._following_ids is None:
+            self._following_ids = frozenset(db.session.scalars(
+                select(Follow.user_being_followed_id)
+                .where(Follow.user_following_id == self.id)))
+
+        return self._following_ids
+
+    @property
+    def liked_message_ids(self):
+        """Frozenset of ids of every message this user has liked."""
+
+        if self._liked_message_ids is None:
+            self._liked_message_ids = frozenset(db.session.scalars(
+                select(Like.message_id).where(Like.user_id == self.id)))
+
+        return self._liked_message_ids
+
+    def prefetch_likes(self, messages):
+        """Look up which of `messages` this user has liked in one query.
+
+        Later `has_liked` calls for these messages are answered from memory
+        without loading the user's whole like history.
+        """
+
+        ids = {message.id for message in messages}
+        liked = db.session.scalars(
+            select(Like.message_id)
+            .where(Like.user_id == self.id)
+            .where(Like.message_id.in_(ids)))
+
+        self._likes_checked = dict.fromkeys(ids, False)
+        self._likes_checked.update(dict.fromkeys(liked, True))
+
+    def has_liked(self, message):
+        """Has this user liked `message`?"""
+
+        if self._likes_checked and message.id in self._likes_checked:
+            return self._likes_checked[message.id]
+
+        return message.id in self.liked_message_ids
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        follow = db.session.get(Follow, (self.id, other_user.id))
+        return follow is not None
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids
+
+
+@event.listens_for(User, 'expire')
+def _clear_membership_caches(user, attrs):
+    """Drop a user's cached membership sets when its state is expired."""
+
+    # The instance may already have been garbage collected.
+    if user is None:
+        return
+
+    user._following_ids = None
+    user._liked_message_ids = None
+    user._likes_checked = None
 
 
 class Message(db.Model):
@@ -191,6 +523,271 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # For a user's messages, newest first.
+    __table_args__ = (
+        db.Index(
+            'ix_messages_user_id_timestamp',
+            user_id, timestamp, id,
+        ),
+    )
+
+    @classmethod
+    def get_visible_or_404(cls, message_id):
+        """Return the message with `message_id`, or abort with a 404 if there
+        is none or its author's account has been deleted.
+        """
+
+        return db.first_or_404(
+            select(cls)
+            .join(cls.user)
+            .options(contains_eager(cls.user))
+            .where(cls.id == message_id, User.deactivated_at.is_(None)))
+
+    # Like count filled in by `prefetch_like_counts`.
+    _like_count = None
+
+    @property
+    def like_count(self):
+        """Number of users who have liked this message."""
+
+        if self._like_count is None:
+            self._like_count = db.session.scalar(
+                select(func.count()).where(Like.message_id == self.id))
+
+        return self._like_count
+
+    @classmethod
+    def prefetch_like_counts(cls, messages):
+        """Fill in `like_count` for every message in `messages` with one
+        grouped query, rather than loading each message's `liked_by`.
+        """
+
+        messages = list(messages)
+        counts = dict(db.session.execute(
+            select(Like.message_id, func.count())
+            .where(Like.message_id.in_([message.id for message in messages]))
+            .group_by(Like.message_id)).all())
+
+        for message in messages:
+            message._like_count = counts.get(message.id, 0)
+
+    def remove_from_counts(self):
+        """Decrement the author's message count and the like count of every
+        user who liked this message. Call before deleting the message.
+        """
+
+        db.session.execute(
+            update(User)
+            .where(User.id == self.user_id)
+            .values(message_count=User.message_count - 1)
+        )
+
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(
+                select(Like.user_id).where(Like.message_id == self.id)))
+            .values(like_count=User.like_count - 1)
+        )
+
+
+@event.listens_for(Message, 'expire')
+def _clear_like_count(message, attrs):
+    """Drop a message's prefetched like count when its state is expired."""
+
+    if message is None:
+        return
+
+    message._like_count = None
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write) so the
+    homepage can read a user's feed with one range scan of
+    `ix_timeline_entries_user_id_timestamp` instead of rebuilding it from
+    `follows` and `messages` on every request.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # Copy of the message timestamp so the feed can be ordered straight off
+    # the index without joining to messages first.
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_id_timestamp',
+            user_id, timestamp, message_id,
+        ),
+    )
+
+    @classmethod
+    def fan_out(cls, message):
+        """Deliver `message` to its author's and their followers' timelines.
+
+        The message must already be flushed so it has an id and timestamp.
+        """
+
+        author = select(
+            literal(message.user_id),
+            literal(message.id),
+            literal(message.timestamp, db.DateTime),
+        )
+
+        followers = select(
+            Follow.user_following_id,
+            literal(message.id),
+            literal(message.timestamp, db.DateTime),
+        ).where(Follow.user_being_followed_id == message.user_id)
+
+        db.session.execute(
+            insert(cls).from_select(
+                ['user_id', 'message_id', 'timestamp'],
+                union_all(author, followers),
+            )
+            .on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def backfill(cls, follower_id, followed_id, limit=TIMELINE_BACKFILL_SIZE):
+        """Copy the most recent messages of `followed_id` into the timeline
+        of `follower_id`. Called when a new follow is added.
+        """
+
+        recent = (
+            select(literal(follower_id), Message.id, Message.timestamp)
+            .where(Message.user_id == followed_id)
+            .order_by(Message.timestamp.desc())
+            .limit(limit)
+        )
+
+        db.session.execute(
+            insert(cls)
+            .from_select(['user_id', 'message_id', 'timestamp'], recent)
+            .on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def prune(cls, follower_id, followed_id):
+        """Remove messages by `followed_id` from the timeline of
+        `follower_id`. Called when a follow is removed.
+        """
+
+        db.session.execute(
+            delete(cls)
+            .where(cls.user_id == follower_id)
+            .where(cls.message_id.in_(
+                select(Message.id).where(Message.user_id == followed_id)))
+        )
+
+    @classmethod
+    def sync(cls, follower_id, followed_id):
+        """Backfill or prune the timeline of `follower_id` to match whether
+        they follow `followed_id` now. Run as a job after a follow or
+        unfollow, so repeated or out-of-order runs still end up right.
+        """
+
+        follows = db.session.get(Follow, (followed_id, follower_id))
+
+        if follows:
+            cls.backfill(follower_id, followed_id)
+        else:
+            cls.prune(follower_id, followed_id)
+
+    @classmethod
+    def rebuild(cls, first_user_id, last_user_id,
+                limit=TIMELINE_BACKFILL_SIZE):
+        """Rebuild the timelines of users `first_user_id` to `last_user_id`
+        from `messages` and `follows`: their own messages, and the most
+        recent `limit` of each user they follow, as `backfill` gives a new
+        follow. Returns how many entries were written.
+
+        Used after bulk loads (e.g. seeding) that bypass `fan_out`.
+        """
+
+        users = (first_user_id, last_user_id)
+
+        own = (
+            select(Message.user_id, Message.id, Message.timestamp)
+            .where(Message.user_id.between(*users))
+        )
+
+        recent = (
+            select(Message.id, Message.timestamp)
+            .where(Message.user_id == Follow.user_being_followed_id)
+            .order_by(Message.timestamp.desc())
+            .limit(limit)
+            .lateral('recent')
+        )
+        followed = (
+            select(Follow.user_following_id, recent.c.id, recent.c.timestamp)
+            .join(recent, true())
+            .where(Follow.user_following_id.between(*users))
+        )
+
+        db.session.execute(delete(cls).where(cls.user_id.between(*users)))
+
+        return db.session.execute(
+            insert(cls).from_select(
+                ['user_id', 'message_id', 'timestamp'],
+                union_all(own, followed),
+            )
+            .on_conflict_do_nothing()
+        ).rowcount
+
+    @classmethod
+    def messages_for(cls, user_id, before, per_page):
+        """Return a Page of the messages on a user's timeline, newest first.
+
+        `before` is the cursor of the previous page, or None.
+        """
+
+        query = (Message
+                 .query
+                 .join(Message.user)
+                 .options(contains_eager(Message.user))
+                 .join(cls, cls.message_id == Message.id)
+                 .filter(cls.user_id == user_id,
+                         User.deactivated_at.is_(None)))
+
+        return paginate_by_timestamp(
+            query, cls.timestamp, cls.message_id, before, per_page)
+
+    @classmethod
+    def messages_after(cls, user_id, after, limit):
+        """Return the newest `limit` messages on a user's timeline that are
+        newer than the cursor `after`, newest first.
+        """
+
+        return (Message
+                .query
+                .join(Message.user)
+                .options(contains_eager(Message.user))
+                .join(cls, cls.message_id == Message.id)
+                .filter(cls.user_id == user_id,
+                        User.deactivated_at.is_(None),
+                        tuple_(cls.timestamp, cls.message_id)
+                        > decode_timestamp_cursor(after))
+                .order_by(cls.timestamp.desc(), cls.message_id.desc())
+                .limit(limit)
+                .all())
+
 
 class Like(db.Model):
     """An individual like"""
@@ -215,6 +812,359 @@ class Like(db.Model):
         default=datetime.utcnow,
     )
 
+    # The primary key leads with the user, so counting a message's likes
+    # needs its own index.
+    __table_args__ = (
+        db.Index(
+            'ix_likes_message_id',
+            message_id, user_id,
+        ),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Like `message_id` as `user_id` and update the user's like
+        count. Does nothing if they already like it.
+
+        Returns whether a like was added.
+        """
+
+        timestamp = db.session.scalar(
+            insert(cls)
+            .values(user_id=user_id, message_id=message_id)
+            .on_conflict_do_nothing()
+            .returning(cls.timestamp))
+
+        if timestamp is not None:
+            cls._update_count(user_id, 1)
+            MessageScore.add_like(message_id, timestamp)
+
+        return timestamp is not None
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Unlike `message_id` as `user_id` and update the user's like
+        count. Does nothing if they don't like it.
+
+        Returns whether a like was removed.
+        """
+
+        timestamp = db.session.scalar(
+            delete(cls)
+            .where(cls.user_id == user_id, cls.message_id == message_id)
+            .returning(cls.timestamp))
+
+        if timestamp is not None:
+            cls._update_count(user_id, -1)
+            MessageScore.remove_like(message_id, timestamp)
+
+        return timestamp is not None
+
+    @staticmethod
+    def _update_count(user_id, change):
+        db.session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(like_count=User.like_count + change)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def trend_exponent(timestamp):
+    """The log of a like's weight in a trending score, for a like at
+    `timestamp`: the number of half-lives since TREND_EPOCH, times ln 2.
+    """
+
+    return (timestamp - TREND_EPOCH) / TREND_HALF_LIFE * math.log(2)
+
+
+def sql_trend_exponent(timestamp):
+    """`trend_exponent` in SQL, for the timestamp column `timestamp`."""
+
+    return (func.extract('epoch', timestamp - TREND_EPOCH)
+            / TREND_HALF_LIFE.total_seconds() * math.log(2))
+
+
+class MessageScore(db.Model):
+    """A message's trending score (see trending.py).
+
+    The score is the sum over the message's likes of 2 ** (half-lives from
+    TREND_EPOCH to the like), so newer likes count for more, and every
+    message's score decays at the same rate: ordering by score orders by
+    likes decayed to now, without updating anything as time passes. It's
+    stored as its natural log, which grows by about 2.8 a day rather than
+    overflowing, and updated with log-sum-exp arithmetic.
+    """
+
+    __tablename__ = 'message_scores'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # The top of the index is the trending list; the bottom is pruned.
+    __table_args__ = (
+        db.Index(
+            'ix_message_scores_score',
+            score,
+        ),
+    )
+
+    @classmethod
+    def add_like(cls, message_id, timestamp):
+        """Add a like at `timestamp` to the score of `message_id`."""
+
+        x = trend_exponent(timestamp)
+
+        # log(e^score + e^x), without overflowing e^score.
+        db.session.execute(
+            insert(cls)
+            .values(message_id=message_id, score=x)
+            .on_conflict_do_update(
+                index_elements=[cls.message_id],
+                set_={'score': (
+                    func.greatest(cls.score, x)
+                    + func.ln(1 + func.exp(func.greatest(
+                        -func.abs(cls.score - x), MIN_EXPONENT))))},
+            ))
+
+    @classmethod
+    def remove_like(cls, message_id, timestamp):
+        """Take a like at `timestamp` out of the score of `message_id`.
+
+        A score with no likes left becomes -Infinity until it's pruned.
+        """
+
+        db.session.execute(
+            update(cls)
+            .where(cls.message_id == message_id)
+            .values(score=cls._without(trend_exponent(timestamp)))
+            .execution_options(synchronize_session=False))
+
+    @classmethod
+    def remove_likes(cls, likes):
+        """Return an UPDATE taking the likes in `likes`, a CTE of
+        (message_id, timestamp) rows with at most one per message, out of
+        their messages' scores; e.g. with the DELETE that returned them.
+        """
+
+        return (
+            update(cls)
+            .where(cls.message_id == likes.c.message_id)
+            .values(score=cls._without(sql_trend_exponent(likes.c.timestamp)))
+            .returning(cls.message_id)
+            .execution_options(synchronize_session=False))
+
+    @classmethod
+    def _without(cls, x):
+        """log(e^score - e^x), if what's left isn't just rounding error."""
+
+        return case(
+            (cls.score - x > 1e-9,
+             cls.score + func.ln(1 - func.exp(func.greatest(
+                 x - cls.score, MIN_EXPONENT)))),
+            else_=float('-inf'),
+        )
+
+    @classmethod
+    def prune(cls):
+        """Delete scores that have decayed below one like TREND_MAX_AGE
+        old. Returns how many were deleted.
+        """
+
+        cutoff = trend_exponent(datetime.utcnow() - TREND_MAX_AGE)
+
+        return db.session.execute(
+            delete(cls).where(cls.score < cutoff)).rowcount
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every score from the likes of the last TREND_MAX_AGE,
+        e.g. after a bulk load.
+        """
+
+        x = sql_trend_exponent(Like.timestamp)
+
+        likes = (
+            select(
+                Like.message_id,
+                x.label('x'),
+                func.max(x).over(partition_by=Like.message_id).label('top'))
+            .where(Like.timestamp > datetime.utcnow() - TREND_MAX_AGE)
+            .subquery())
+
+        db.session.execute(delete(cls))
+        db.session.execute(
+            insert(cls).from_select(
+                ['message_id', 'score'],
+                select(
+                    likes.c.message_id,
+                    func.max(likes.c.top) + func.ln(func.sum(func.exp(
+                        func.greatest(likes.c.x - likes.c.top,
+                                      MIN_EXPONENT)))))
+                .group_by(likes.c.message_id)))
+
+
+class Suggestion(db.Model):
+    """A user suggested to another as someone to follow, precomputed by
+    suggestions.py. Each user has up to SUGGESTIONS_PER_USER, ranked from 0.
+    """
+
+    __tablename__ = 'user_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.SmallInteger,
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # Deleting a user deletes the suggestions of them.
+    __table_args__ = (
+        db.Index(
+            'ix_user_suggestions_suggested_user_id',
+            suggested_user_id,
+        ),
+    )
+
+    @classmethod
+    def users_for(cls, user_id, limit):
+        """Return up to `limit` active users suggested to `user_id`, best
+        first, with one lookup on the primary key.
+        """
+
+        return db.session.scalars(
+            select(User)
+            .join(cls, cls.suggested_user_id == User.id)
+            .where(cls.user_id == user_id, User.deactivated_at.is_(None))
+            .order_by(cls.rank)
+            .limit(limit)
+        ).all()
+
+    @classmethod
+    def mark_stale(cls, *user_ids):
+        """Have the next `flask suggestions` run recompute the suggestions
+        of `user_ids`, whose follows, followers or likes changed.
+        """
+
+        db.session.execute(
+            insert(SuggestionRefresh)
+            .values([{'user_id': user_id} for user_id in user_ids])
+            .on_conflict_do_nothing())
+
+
+class SuggestionRefresh(db.Model):
+    """A user whose suggestions are out of date."""
+
+    __tablename__ = 'suggestion_refreshes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work, run by `flask worker` (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    type = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        JSONB,
+        nullable=False,
+        default=dict,
+    )
+
+    # queued -> running -> (deleted when done) or back to queued to retry;
+    # failed once it has used up its attempts.
+    state = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # Workers look for the next queued job due to run, and count the jobs
+    # of a type that are running. Both only touch a few rows of the table.
+    __table_args__ = (
+        db.Index(
+            'ix_jobs_queued_run_at',
+            run_at, id,
+            postgresql_where=(state == 'queued'),
+        ),
+        db.Index(
+            'ix_jobs_running_type',
+            type, locked_at,
+            postgresql_where=(state == 'running'),
+        ),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.type} {self.state}>"
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -225,3 +1175,16 @@ def connect_db(app):
     app.app_context().push()
     db.app = app
     db.init_app(app)
+
+
+def reset_db():
+    """Drop every table, then build the schema by running the migrations.
+
+    Needs an app set up with Flask-Migrate.
+    """
+
+    db.drop_all()
+    db.session.execute(db.text("DROP TABLE IF EXISTS alembic_version"))
+    db.session.commit()
+
+    upgrade()
@@ -0,0 +1,211 @@
+"""Keyset (cursor) pagination for Warbler listings.
+
+Pages are fetched with `WHERE key < :cursor ORDER BY key DESC LIMIT n`
+rather than with OFFSET, so the cost of a page does not grow with how far
+back a user has scrolled.
+
+Each paginate function can also return a StreamedPage, whose rows are read
+from a server-side cursor while the page renders (see STREAM_LIST_PAGES in
+app.py).
+"""
+
+from datetime import datetime
+from itertools import islice
+from operator import itemgetter
+
+from sqlalchemy import tuple_
+from werkzeug.exceptions import BadRequest
+
+CURSOR_TIMESTAMP_FORMAT = "%Y%m%d%H%M%S%f"
+STREAM_BATCH_SIZE = 20
+
+
+class Page:
+    """One page of results plus the cursor for the page after it.
+
+    Iterating over a page iterates over its items. `next_cursor` is None
+    on the last page; `cursor_param` is the querystring parameter the
+    cursor is passed back in.
+    """
+
+    def __init__(self, items, next_cursor=None, cursor_param="before"):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.cursor_param = cursor_param
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return f"<Page {len(self.items)} items, next={self.next_cursor}>"
+
+
+class StreamedPage(Page):
+    """A Page whose rows are fetched `batch_size` at a time while it's
+    iterated over, so a template can send each batch before the next is
+    read, holding only one batch in memory.
+
+    It can only be iterated over once, and `next_cursor` is only known
+    after that: templates must use it after their loop over the items, and
+    can't take its length. `prepare`, if set, is called with each batch of
+    items before they're yielded, to batch-load what rendering them needs.
+
+    `item` picks the item out of each row of `query`, if it isn't the row.
+    """
+
+    def __init__(self, query, per_page, cursor_for=None, cursor_param="before",
+                 item=None, next_cursor=None, batch_size=STREAM_BATCH_SIZE):
+        self.query = query
+        self.per_page = per_page
+        self.cursor_for = cursor_for
+        self.cursor_param = cursor_param
+        self.item = item or _same
+        self.next_cursor = next_cursor
+        self.batch_size = batch_size
+        self.prepare = None
+
+    def __iter__(self):
+        rows = iter(self.query.yield_per(self.batch_size))
+        left = self.per_page
+
+        while batch := list(islice(rows, self.batch_size)):
+            # The query reads one row past the page to find if there's
+            # another.
+            more = len(batch) > left
+            batch = batch[:left]
+            left -= len(batch)
+
+            items = [self.item(row) for row in batch]
+            if self.prepare and items:
+                self.prepare(items)
+            yield from items
+
+            if more:
+                self.next_cursor = self.cursor_for(batch[-1])
+                return
+
+    def __len__(self):
+        raise TypeError("A StreamedPage's length isn't known in advance.")
+
+    def __repr__(self):
+        return f"<StreamedPage {self.per_page} per page>"
+
+
+def encode_timestamp_cursor(timestamp, id):
+    """Encode a (timestamp, id) pair as a URL-safe cursor string."""
+
+    return f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}-{id}"
+
+
+def decode_timestamp_cursor(cursor):
+    """Decode a cursor made by `encode_timestamp_cursor`.
+
+    Raises BadRequest if the cursor is malformed.
+    """
+
+    try:
+        timestamp, id = cursor.split("-")
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except ValueError:
+        raise BadRequest("Invalid cursor.")
+
+
+def decode_key_cursor(cursor):
+    """Decode a primary key cursor. Raises BadRequest if malformed."""
+
+    try:
+        return int(cursor)
+    except ValueError:
+        raise BadRequest("Invalid cursor.")
+
+
+def paginate_by_timestamp(query, timestamp_col, id_col, before, per_page,
+                          stream=False):
+    """Return a Page of `query` ordered newest first on (timestamp, id).
+
+    `before` is a cursor from a previous page's `next_cursor`, or None for
+    the first page. The id breaks ties between equal timestamps. If
+    `stream`, the Page is a StreamedPage.
+    """
+
+    if before:
+        query = query.filter(
+            tuple_(timestamp_col, id_col) < decode_timestamp_cursor(before))
+
+    query = (query
+             .order_by(timestamp_col.desc(), id_col.desc())
+             .add_columns(timestamp_col, id_col)
+             .limit(per_page + 1))
+
+    def cursor_for(row):
+        _, timestamp, id = row
+        return encode_timestamp_cursor(timestamp, id)
+
+    return _page(query, per_page, cursor_for, stream)
+
+
+def paginate_by_key(query, key_col, before, per_page, stream=False):
+    """Return a Page of `query` ordered by `key_col`, highest first."""
+
+    if before:
+        query = query.filter(key_col < decode_key_cursor(before))
+
+    query = (query
+             .order_by(key_col.desc())
+             .add_columns(key_col)
+             .limit(per_page + 1))
+
+    return _page(query, per_page, lambda row: str(row[1]), stream)
+
+
+def paginate_by_offset(query, page, per_page, max_page, stream=False):
+    """Return a Page of an already-ordered `query` by page number.
+
+    Only for result sets that can't be keyed, such as search results
+    ordered by rank; `max_page` bounds how deep an OFFSET can go.
+    """
+
+    try:
+        page = int(page or 1)
+    except ValueError:
+        raise BadRequest("Invalid page.")
+
+    if not 1 <= page <= max_page:
+        raise BadRequest("Invalid page.")
+
+    query = query.offset((page - 1) * per_page).limit(per_page + 1)
+
+    def cursor_for(item):
+        return str(page + 1) if page < max_page else None
+
+    return _page(query, per_page, cursor_for, stream, cursor_param="page",
+                 item=None)
+
+
+def _page(query, per_page, cursor_for, stream, cursor_param="before",
+          item=itemgetter(0)):
+    """Return a Page of `query`, which reads up to one row more than
+    `per_page`. `cursor_for` gives the next page's cursor from the page's
+    last row, and `item` the item from a row (None if rows are items).
+    """
+
+    item = item or _same
+
+    if stream:
+        return StreamedPage(query, per_page, cursor_for, cursor_param, item)
+
+    rows = query.all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = cursor_for(rows[-1])
+
+    return Page([item(row) for row in rows], next_cursor, cursor_param)
+
+
+def _same(row):
+    return row
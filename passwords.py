@@ -0,0 +1,131 @@
+"""Password hashing for Warbler, run off the request worker.
+
+bcrypt is deliberately slow: at the default cost a single hash or check
+takes a few hundred milliseconds of CPU. `PasswordHasher` runs that work on
+a small, fixed-size process pool so a burst of logins can't tie up every
+web worker's CPU at once, and hashing capacity can be sized separately from
+the number of web workers.
+
+Configuration (read in `init_app`):
+
+- BCRYPT_LOG_ROUNDS: bcrypt cost factor for new hashes. Hashes made with a
+  different cost are upgraded the next time their user logs in.
+- PASSWORD_HASH_WORKERS: size of the process pool. 0 hashes inline in the
+  calling thread, which is handy for tests and one-off scripts.
+"""
+
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_WORKERS = 2
+
+
+def _hash_password(password, rounds):
+    """Hash `password` (bytes) with a fresh salt. Runs in a pool process."""
+
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check_password(pw_hash, password):
+    """Check `password` against `pw_hash` (both bytes). Runs in a pool
+    process.
+    """
+
+    return bcrypt.checkpw(password, pw_hash)
+
+
+def _to_bytes(password):
+    if not password:
+        raise ValueError("Password must be non-empty.")
+
+    return password.encode('UTF-8')
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded process pool."""
+
+    def __init__(self, rounds=DEFAULT_LOG_ROUNDS, workers=DEFAULT_WORKERS):
+        self.rounds = rounds
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._seconds = 0.0
+
+    def init_app(self, app):
+        """Configure the cost factor and pool size from `app.config`."""
+
+        self.rounds = app.config.setdefault(
+            'BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+        self.workers = app.config.setdefault(
+            'PASSWORD_HASH_WORKERS', DEFAULT_WORKERS)
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash_password, _to_bytes(password), self.rounds)
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run(
+            _check_password, pw_hash.encode('UTF-8'), _to_bytes(password))
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a cost other than the configured one?
+
+        bcrypt hashes look like "$2b$12$<salt+hash>", where 12 is the cost.
+        """
+
+        return int(pw_hash.split('$')[2]) != self.rounds
+
+    def stats(self):
+        """Return a snapshot of the hasher's queue and throughput."""
+
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'rounds': self.rounds,
+                'queue_depth': self._pending,
+                'completed': self._completed,
+                'seconds': self._seconds,
+            }
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool (or inline with no workers) and wait
+        for the result, keeping the queue metrics up to date.
+        """
+
+        start = time.perf_counter()
+
+        with self._lock:
+            self._pending += 1
+
+        try:
+            if self.workers:
+                return self._get_pool().submit(fn, *args).result()
+            return fn(*args)
+
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._completed += 1
+                self._seconds += time.perf_counter() - start
+
+    def _get_pool(self):
+        """Create the pool on first use, so each forked web worker gets its
+        own rather than inheriting one from the parent.
+        """
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,126 @@
+"""Read replica routing and connection pool settings.
+
+Reads from GET requests are sent to a read replica, when any are
+configured in DATABASE_REPLICA_URLS, so page views don't compete with
+writes on the primary. Everything else stays on the primary:
+
+- writes, and any statement made while flushing,
+- SELECT ... FOR UPDATE,
+- every request that isn't a GET or HEAD,
+- the requests of a browser that wrote something in the last
+  REPLICA_LAG_SECONDS, so users always see their own likes, follows and
+  posts even if the replica is behind ("read your writes").
+
+Connection pools use `TimedQueuePool`, which records how long each
+checkout waited for a free connection.
+"""
+
+import random
+import time
+
+from flask import request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+
+from metrics import metrics
+
+PRIMARY_UNTIL_KEY = "primary_until"
+
+DEFAULT_REPLICA_LAG_SECONDS = 5
+
+
+class RoutingSession(Session):
+    """Session that sends plain reads to `info['read_engine']`, if set."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = self.info.get('read_engine')
+
+        if (engine is not None
+                and bind is None
+                and not self._flushing
+                and isinstance(clause, Select)
+                and clause._for_update_arg is None):
+            return engine
+
+        return super().get_bind(
+            mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection,
+    labelled with the pool's logging name.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            return super()._do_get()
+        finally:
+            metrics.pool_wait_seconds.observe(
+                (self._orig_logging_name or 'default',),
+                time.perf_counter() - start)
+
+
+class ReadReplicas:
+    """Routes each GET request's reads to one of the configured replicas."""
+
+    def __init__(self, db):
+        self.db = db
+        self._engines = {}
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('DATABASE_REPLICA_URLS', [])
+        app.config.setdefault(
+            'REPLICA_LAG_SECONDS', DEFAULT_REPLICA_LAG_SECONDS)
+
+        app.before_request(self._route_request)
+        app.teardown_request(self._end_request)
+
+    def engine(self, url):
+        """Return the engine for the replica at `url`, creating it with
+        the same options as the primary's on first use.
+        """
+
+        if url not in self._engines:
+            index = self.app.config['DATABASE_REPLICA_URLS'].index(url)
+            options = dict(self.app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+            options['pool_logging_name'] = f"replica{index}"
+            self._engines[url] = create_engine(url, **options)
+
+        return self._engines[url]
+
+    def pin_to_primary(self):
+        """Send this browser's reads to the primary for a while, until the
+        replicas have caught up with its writes.
+        """
+
+        session[PRIMARY_UNTIL_KEY] = (
+            time.time() + self.app.config['REPLICA_LAG_SECONDS'])
+
+    def _route_request(self):
+        urls = self.app.config['DATABASE_REPLICA_URLS']
+        info = self.db.session.info
+        info.pop('read_engine', None)
+
+        if request.method not in ('GET', 'HEAD'):
+            if urls:
+                self.pin_to_primary()
+            return
+
+        primary_until = session.get(PRIMARY_UNTIL_KEY)
+        if primary_until is not None:
+            if primary_until > time.time():
+                return
+            session.pop(PRIMARY_UNTIL_KEY)
+
+        if not urls:
+            return
+
+        info['read_engine'] = self.engine(random.choice(urls))
+
+    def _end_request(self, exc):
+        self.db.session.info.pop('read_engine', None)
@@ -1,19 +1,345 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Run with `python -m seed`. The CSVs are streamed into PostgreSQL with
+`COPY ... FROM STDIN` in chunks, so files with tens of millions of rows load
+in constant memory:
+
+- Secondary indexes, unique constraints and foreign keys are dropped
+  before loading and rebuilt afterwards, which is much faster than
+  maintaining them row by row.
+- Users and messages get ids from their row numbers, and the id
+  sequences are reset once everything is loaded.
+- Each chunk commits together with a progress row in `seed_progress`, so
+  an interrupted load can be picked up with `python -m seed --resume`.
+- Timelines are then built from the loaded messages and follows, a chunk
+  of users at a time with progress kept the same way, before their
+  indexes are restored. Each follow gets the followed user's latest
+  TIMELINE_BACKFILL_SIZE messages, as a new follow does.
+
+Options: `--data-dir` (default: generator), `--chunk-size` (default: 50000).
+"""
+
+import argparse
+import csv
+import io
+import os
+import time
+
+from sqlalchemy import func, select, text
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follow
+from models import (
+    User, TimelineEntry, MessageScore, TIMELINE_BACKFILL_SIZE, reset_db)
+
+DEFAULT_DATA_DIR = 'generator'
+DEFAULT_CHUNK_SIZE = 50_000
+
+# (table, CSV file, whether the table's ids come from the row number),
+# in load order. Files that don't exist are skipped.
+SEED_FILES = [
+    ('users', 'users.csv', True),
+    ('messages', 'messages.csv', True),
+    ('follows', 'follows.csv', False),
+    ('likes', 'likes.csv', False),
+]
+
+# Tables whose secondary indexes and constraints are dropped for the load.
+BULK_TABLES = ['users', 'messages', 'follows', 'likes', 'timeline_entries']
+
+
+def seed(data_dir=DEFAULT_DATA_DIR, chunk_size=DEFAULT_CHUNK_SIZE,
+         resume=False):
+    """Load the CSVs in `data_dir` into a fresh database.
+
+    With `resume`, continue a load that was interrupted instead of
+    starting over.
+    """
+
+    conn = db.engine.raw_connection()
+
+    try:
+        cursor = conn.cursor()
+
+        if not (resume and _has_progress(cursor)):
+            _reset_schema(cursor)
+            conn.commit()
+            _defer_constraints(cursor)
+            conn.commit()
+
+        for table, filename, numbered in SEED_FILES:
+            path = os.path.join(data_dir, filename)
+            if os.path.exists(path):
+                _copy_csv(conn, cursor, table, path, numbered, chunk_size)
+
+        _reset_sequences(cursor)
+        conn.commit()
+
+        # Timelines are read from messages and follows with their indexes,
+        # and written before timeline_entries has its own. Bulk loads skip
+        # the counters maintained by the views, so build them first: the
+        # timeline chunks are sized by following_count.
+        _restore_constraints(conn, cursor, exclude='timeline_entries')
+        _timed("counters", User.reconcile_counts)
+        db.session.commit()
+        _rebuild_timelines(chunk_size)
+        _restore_constraints(conn, cursor)
+
+        cursor.execute("DROP TABLE seed_progress, seed_deferred_ddl")
+        conn.commit()
+
+    finally:
+        conn.close()
+
+    _timed("trending scores", MessageScore.rebuild)
+    db.session.commit()
+
+
+def _has_progress(cursor):
+    """Is there an interrupted load to resume?"""
+
+    cursor.execute("SELECT to_regclass('seed_progress') IS NOT NULL")
+    return cursor.fetchone()[0]
+
+
+def _reset_schema(cursor):
+    """Recreate every table, plus the tables that track load progress."""
+
+    cursor.execute("DROP TABLE IF EXISTS seed_progress, seed_deferred_ddl")
+    cursor.connection.commit()
+
+    reset_db()
+
+    cursor.execute("""
+        CREATE TABLE seed_progress (
+            table_name TEXT PRIMARY KEY,
+            rows_loaded BIGINT NOT NULL
+        )""")
+    cursor.execute("""
+        CREATE TABLE seed_deferred_ddl (
+            id SERIAL PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            ddl TEXT NOT NULL
+        )""")
+
+
+def _defer_constraints(cursor):
+    """Drop secondary indexes, unique constraints and foreign keys on the
+    bulk-loaded tables, saving the DDL to recreate them in
+    `seed_deferred_ddl`. Primary keys are kept.
+    """
+
+    tables = tuple(BULK_TABLES)
+
+    # Foreign keys first, since they depend on the unique indexes.
+    cursor.execute("""
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid),
+               contype
+        FROM pg_constraint
+        WHERE conrelid::regclass::text IN %s AND contype IN ('f', 'u')
+        ORDER BY contype = 'u'
+        """, (tables,))
+    constraints = cursor.fetchall()
+
+    cursor.execute("""
+        SELECT indrelid::regclass::text, indexrelid::regclass::text,
+               pg_get_indexdef(indexrelid)
+        FROM pg_index
+        WHERE indrelid::regclass::text IN %s
+          AND NOT indisprimary
+          AND NOT EXISTS (
+              SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)
+        """, (tables,))
+    indexes = cursor.fetchall()
+
+    for table, name, definition, kind in constraints:
+        cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+
+    for table, name, definition in indexes:
+        cursor.execute(f'DROP INDEX "{name}"')
+
+    # Recreate in the reverse order: indexes and unique constraints, then
+    # the foreign keys that need them.
+    restore = (
+        [(table, definition) for table, name, definition in indexes]
+        + [(table,
+            f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}')
+           for table, name, definition, kind in reversed(constraints)]
+    )
+
+    for table, ddl in restore:
+        cursor.execute(
+            "INSERT INTO seed_deferred_ddl (table_name, ddl) VALUES (%s, %s)",
+            (table, ddl))
+
+
+def _copy_csv(conn, cursor, table, path, numbered, chunk_size):
+    """Stream the CSV at `path` into `table` in chunks of `chunk_size`
+    rows, committing progress with each chunk and skipping rows loaded by
+    an earlier, interrupted run.
+    """
+
+    cursor.execute(
+        "SELECT rows_loaded FROM seed_progress WHERE table_name = %s",
+        (table,))
+    row = cursor.fetchone()
+    loaded = row[0] if row else 0
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        if numbered:
+            columns = ['id'] + columns
+
+        copy_sql = (f"COPY {table} ({', '.join(columns)}) "
+                    "FROM STDIN WITH (FORMAT csv)")
+
+        for _ in range(loaded):
+            next(reader)
+
+        start = time.perf_counter()
+        done = 0
+
+        while True:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            count = 0
+
+            for row in reader:
+                if numbered:
+                    row = [loaded + count + 1] + row
+                writer.writerow(row)
+                count += 1
+                if count == chunk_size:
+                    break
+
+            if not count:
+                break
+
+            buffer.seek(0)
+            cursor.copy_expert(copy_sql, buffer)
+
+            loaded += count
+            done += count
+            cursor.execute("""
+                INSERT INTO seed_progress (table_name, rows_loaded)
+                VALUES (%s, %s)
+                ON CONFLICT (table_name)
+                DO UPDATE SET rows_loaded = EXCLUDED.rows_loaded
+                """, (table, loaded))
+            conn.commit()
+
+            elapsed = time.perf_counter() - start
+            print(f"{table}: {loaded:,} rows "
+                  f"({done / elapsed:,.0f} rows/sec)", flush=True)
+
+
+def _reset_sequences(cursor):
+    """Point the id sequences past the ids assigned during the load."""
+
+    for table, filename, numbered in SEED_FILES:
+        if numbered:
+            cursor.execute(f"""
+                SELECT setval(pg_get_serial_sequence('{table}', 'id'),
+                              COALESCE(MAX(id), 0) + 1, false)
+                FROM {table}""")
+
+
+def _restore_constraints(conn, cursor, exclude=None):
+    """Recreate the indexes and constraints dropped before the load, but
+    those on the table `exclude`, one statement per transaction so an
+    interrupted rebuild can resume.
+    """
+
+    cursor.execute(
+        "SELECT id, ddl FROM seed_deferred_ddl "
+        "WHERE table_name IS DISTINCT FROM %s ORDER BY id",
+        (exclude,))
+
+    for id, ddl in cursor.fetchall():
+        start = time.perf_counter()
+        cursor.execute(ddl)
+        cursor.execute("DELETE FROM seed_deferred_ddl WHERE id = %s", (id,))
+        conn.commit()
+        print(f"{ddl[:70]}... ({time.perf_counter() - start:.1f}s)",
+              flush=True)
+
+
+def _rebuild_timelines(chunk_size):
+    """Build every user's timeline, for chunks of users expected to come
+    to about `chunk_size` entries, committing progress with each chunk and
+    skipping users done by an earlier, interrupted run.
+
+    Each user is expected to need TIMELINE_BACKFILL_SIZE entries for
+    every user they follow, plus as many again for their own messages, so
+    a chunk takes users in id order until their following_counts (plus
+    one each) add up to chunk_size // TIMELINE_BACKFILL_SIZE. Users' ids
+    are their row numbers, so progress is the last id done.
+    """
+
+    budget = max(1, chunk_size // TIMELINE_BACKFILL_SIZE)
+
+    done = db.session.scalar(text(
+        "SELECT rows_loaded FROM seed_progress "
+        "WHERE table_name = 'timeline_entries'")) or 0
+    last = db.session.scalar(select(func.max(User.id))) or 0
+
+    start = time.perf_counter()
+    rows = 0
+
+    while done < last:
+        end = _chunk_end(done, budget) or done + 1
+        rows += TimelineEntry.rebuild(done + 1, end)
+
+        db.session.execute(text("""
+            INSERT INTO seed_progress (table_name, rows_loaded)
+            VALUES ('timeline_entries', :done)
+            ON CONFLICT (table_name)
+            DO UPDATE SET rows_loaded = EXCLUDED.rows_loaded
+            """), {'done': end})
+        db.session.commit()
+        done = end
+
+        elapsed = time.perf_counter() - start
+        print(f"timelines: {done:,} of {last:,} users "
+              f"({rows / elapsed:,.0f} rows/sec)", flush=True)
+
+
+def _chunk_end(done, budget):
+    """The last id of the users after `done` whose following_counts, plus
+    one each, add up to no more than `budget`, or None if the first of
+    them is over it by itself.
+
+    Every user adds at least one, so no more than `budget` are read.
+    """
+
+    weights = (
+        select(
+            User.id,
+            func.sum(User.following_count + 1)
+            .over(order_by=User.id).label('total'))
+        .where(User.id > done)
+        .order_by(User.id)
+        .limit(budget)
+        .subquery())
+
+    return db.session.scalar(
+        select(func.max(weights.c.id)).where(weights.c.total <= budget))
+
 
-db.drop_all()
-db.create_all()
+def _timed(label, fn):
+    """Call `fn`, printing how long it took."""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    start = time.perf_counter()
+    fn()
+    print(f"{label}: rebuilt ({time.perf_counter() - start:.1f}s)", flush=True)
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follow, DictReader(follows))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted load")
+    args = parser.parse_args()
 
-db.session.commit()
+    seed(args.data_dir, args.chunk_size, args.resume)
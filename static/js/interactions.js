@@ -0,0 +1,87 @@
+"use strict";
+
+/** Like and follow buttons without reloading the page.
+ *
+ * The like and follow forms work as plain POSTs. When this script runs,
+ * submitting one instead calls the JSON endpoint named by its
+ * data-like-url or data-follow-url (PUT to like or follow, DELETE to
+ * undo) and updates the buttons in place.
+ */
+
+const CSRF_HEADER = "X-CSRFToken";
+
+
+/** Send `method` to `url` with the form's CSRF token; return the JSON. */
+
+async function sendJson(form, method, url) {
+  const token = form.querySelector("[name=csrf_token]").value;
+  const resp = await fetch(url, {
+    method,
+    headers: { [CSRF_HEADER]: token, "Accept": "application/json" },
+    credentials: "same-origin",
+  });
+
+  if (!resp.ok) throw new Error(`${method} ${url}: ${resp.status}`);
+  return resp.json();
+}
+
+
+/** Show a like form as liked or not, with the message's new like count. */
+
+function showLike(form, { message_id, liked, like_count }) {
+  form.dataset.liked = liked;
+  form.action = `/messages/${message_id}/like${liked ? "/delete" : ""}`;
+  form.querySelector(".like-count").textContent = like_count;
+
+  const icon = form.querySelector("i");
+  icon.classList.toggle("bi-heart-fill", liked);
+  icon.classList.toggle("bi-heart", !liked);
+}
+
+
+/** Show every follow form for a user as following them or not. */
+
+function showFollow(url, { user_id, following }) {
+  for (const form of document.querySelectorAll(
+      `form[data-follow-url="${url}"]`)) {
+    form.dataset.following = following;
+    form.action = following
+        ? `/users/stop-following/${user_id}`
+        : `/users/follow/${user_id}`;
+
+    const button = form.querySelector("button");
+    button.classList.toggle("btn-primary", following);
+    button.classList.toggle("btn-outline-primary", !following);
+    button.textContent = following ? "Unfollow" : "Follow";
+  }
+}
+
+
+async function handleSubmit(evt) {
+  const form = evt.target;
+  const { likeUrl, followUrl } = form.dataset;
+  if (!likeUrl && !followUrl) return;
+
+  evt.preventDefault();
+  const button = form.querySelector("button");
+  button.disabled = true;
+
+  try {
+    if (likeUrl) {
+      const method = form.dataset.liked === "true" ? "DELETE" : "PUT";
+      showLike(form, await sendJson(form, method, likeUrl));
+    } else {
+      const method = form.dataset.following === "true" ? "DELETE" : "PUT";
+      showFollow(followUrl, await sendJson(form, method, followUrl));
+    }
+  } catch (err) {
+    // Fall back to the plain form post, e.g. if the session expired.
+    console.error(err);
+    form.submit();
+  } finally {
+    button.disabled = false;
+  }
+}
+
+
+document.addEventListener("submit", handleSubmit);
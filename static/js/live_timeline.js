@@ -0,0 +1,60 @@
+"use strict";
+
+/** New messages at the top of the home timeline without reloading.
+ *
+ * Opens the live timeline stream from the newest message shown (the
+ * list's data-stream-after cursor). The stream sends the ids of new
+ * messages; this counts them on the "new warbles" button, and clicking it
+ * fetches their cards from /timeline/new and adds them to the list. The
+ * browser reconnects by itself when the stream closes, resuming after the
+ * last message it was sent.
+ */
+
+const CURSOR_HEADER = "X-Timeline-Cursor";
+
+const $messages = document.querySelector("#messages");
+const $newMessages = document.querySelector("#new-messages");
+
+let shownCursor = $messages.dataset.streamAfter;
+const unseen = new Set();
+
+
+function showUnseen() {
+  const n = unseen.size;
+  $newMessages.textContent = `Show ${n} new warble${n === 1 ? "" : "s"}`;
+  $newMessages.hidden = n === 0;
+}
+
+
+function handleEvent(evt) {
+  unseen.add(JSON.parse(evt.data).id);
+  showUnseen();
+}
+
+
+/** Add the cards of the messages newer than the ones shown. */
+
+async function showNewMessages() {
+  $newMessages.disabled = true;
+
+  try {
+    const url = `/timeline/new?after=${encodeURIComponent(shownCursor)}`;
+    const resp = await fetch(url, { credentials: "same-origin" });
+    if (!resp.ok) throw new Error(`GET ${url}: ${resp.status}`);
+
+    $messages.insertAdjacentHTML("afterbegin", await resp.text());
+    shownCursor = resp.headers.get(CURSOR_HEADER) || shownCursor;
+    unseen.clear();
+    showUnseen();
+  } catch (err) {
+    console.error(err);
+  } finally {
+    $newMessages.disabled = false;
+  }
+}
+
+
+const stream = new EventSource(
+    `/timeline/stream?after=${encodeURIComponent(shownCursor)}`);
+stream.addEventListener("message", handleEvent);
+$newMessages.addEventListener("click", showNewMessages);
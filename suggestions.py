@@ -0,0 +1,193 @@
+"""Precomputed "who to follow" suggestions.
+
+`flask suggestions` computes suggestions offline as sparse matrix products
+over the whole follows and likes tables and stores each user's best
+SUGGESTIONS_PER_USER in `user_suggestions`, so pages read them with one
+primary key lookup. A candidate's score for a user is:
+
+- friends of friends: how many of the people the user follows follow the
+  candidate, the user's row of F @ F, where F is the users x users follows
+  matrix; plus
+- co-likes: how many messages both the user and the candidate liked, the
+  user's row of L @ L.T, where L is the users x messages likes matrix,
+  times CO_LIKE_WEIGHT. Messages with more than MAX_LIKES_PER_MESSAGE
+  likes are left out of L: liking a hit says little about shared taste,
+  and would make the product nearly dense.
+
+People the user already follows, the user and deactivated accounts are
+never suggested. Scores are computed BATCH_SIZE users at a time, so memory
+is the two matrices plus one batch of rows.
+
+Following or liking marks the user's suggestions stale; plain `flask
+suggestions` recomputes only those users, `--all` everyone. Run it from
+cron. Pages also drop anyone the viewer has followed since, using the
+follow graph.
+"""
+
+import io
+
+import numpy as np
+from scipy import sparse
+
+from follow_graph import COPY_FOLLOWS, copy_int_columns
+from models import db
+
+SUGGESTIONS_PER_USER = 50
+CO_LIKE_WEIGHT = 0.5
+MAX_LIKES_PER_MESSAGE = 1000
+BATCH_SIZE = 1000
+
+COPY_LIKES = "COPY likes (user_id, message_id) TO STDOUT WITH (FORMAT binary)"
+COPY_ACTIVE_USERS = (
+    "COPY (SELECT id FROM users WHERE deactivated_at IS NULL) "
+    "TO STDOUT WITH (FORMAT binary)"
+)
+COPY_SUGGESTIONS = (
+    "COPY user_suggestions (user_id, rank, suggested_user_id, score) "
+    "FROM STDIN WITH (FORMAT csv)"
+)
+
+
+class Recommender:
+    """The follows and likes matrices suggestions are computed from."""
+
+    def __init__(self, followers, followed, likers, liked, active_ids):
+        size = 1 + max(
+            (int(ids.max()) for ids in (followers, followed, likers,
+                                       active_ids) if len(ids)),
+            default=0)
+
+        self.follows = adjacency(followers, followed, (size, size))
+
+        popular = np.bincount(liked)[liked] > MAX_LIKES_PER_MESSAGE
+        likes = adjacency(
+            likers[~popular], liked[~popular],
+            (size, int(liked.max()) + 1 if len(liked) else 1))
+        self.likes = likes
+        self.liked_by = likes.T.tocsr()
+
+        self.active = np.zeros(size, dtype=bool)
+        self.active[active_ids] = True
+
+    @classmethod
+    def load(cls, connection):
+        """Read the follows, likes and active users through `connection`
+        (a DBAPI connection).
+        """
+
+        followers, followed = copy_int_columns(connection, COPY_FOLLOWS, 2)
+        likers, liked = copy_int_columns(connection, COPY_LIKES, 2)
+        active_ids, = copy_int_columns(connection, COPY_ACTIVE_USERS, 1)
+
+        return cls(followers, followed, likers, liked, active_ids)
+
+    @property
+    def active_ids(self):
+        return np.flatnonzero(self.active)
+
+    def scores(self, user_ids):
+        """Return a sparse matrix of the candidates' scores, a row for each
+        of `user_ids`, with the users who can't be suggested left out.
+        """
+
+        follows = self.follows[user_ids]
+        scores = (follows @ self.follows
+                  + CO_LIKE_WEIGHT * (self.likes[user_ids] @ self.liked_by))
+
+        size = self.follows.shape[0]
+        themselves = adjacency(
+            np.arange(len(user_ids)), user_ids, (len(user_ids), size))
+        excluded = (follows + themselves) > 0
+
+        scores = (scores - scores.multiply(excluded)) @ sparse.diags(
+            self.active.astype(np.float32))
+        scores.eliminate_zeros()
+
+        return scores.tocsr()
+
+    def top(self, user_ids, k):
+        """Return the best `k` suggestions for each of `user_ids`, as arrays
+        of (user id, rank, suggested user id, score).
+        """
+
+        user_ids = np.asarray(user_ids, dtype=np.int32)
+        user_ids = user_ids[user_ids < len(self.active)]
+        scores = self.scores(user_ids)
+
+        rows = np.repeat(np.arange(len(user_ids)), np.diff(scores.indptr))
+        order = np.lexsort((scores.indices, -scores.data, rows))
+        rank = np.arange(len(order)) - scores.indptr[rows[order]]
+        best = order[rank < k]
+
+        return (user_ids[rows[best]], rank[rank < k],
+                scores.indices[best], scores.data[best])
+
+
+def adjacency(sources, targets, shape):
+    """A float32 CSR matrix with a 1 at each (source, target)."""
+
+    return sparse.csr_matrix(
+        (np.ones(len(sources), dtype=np.float32), (sources, targets)),
+        shape=shape)
+
+
+def refresh_suggestions(everyone=False, batch_size=BATCH_SIZE,
+                        k=SUGGESTIONS_PER_USER):
+    """Recompute the suggestions of users marked stale, or of every active
+    user if `everyone`. Returns how many users were refreshed.
+    """
+
+    connection = db.engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        # Users who follow or like something from here on are marked again
+        # for the next run.
+        cursor.execute("DELETE FROM suggestion_refreshes RETURNING user_id")
+        stale = np.array([row[0] for row in cursor], dtype=np.int32)
+        connection.commit()
+
+        try:
+            recommender = Recommender.load(connection)
+            connection.commit()
+
+            if everyone:
+                user_ids = recommender.active_ids
+            else:
+                user_ids = stale[stale < len(recommender.active)]
+                user_ids = user_ids[recommender.active[user_ids]]
+
+            for start in range(0, len(user_ids), batch_size):
+                batch = user_ids[start:start + batch_size]
+                _store(cursor, batch, recommender.top(batch, k))
+                connection.commit()
+
+        except Exception:
+            connection.rollback()
+            cursor.execute(
+                "INSERT INTO suggestion_refreshes (user_id) "
+                "SELECT unnest(%s) ON CONFLICT DO NOTHING",
+                (stale.tolist(),))
+            connection.commit()
+            raise
+
+    finally:
+        connection.close()
+
+    return len(user_ids)
+
+
+def _store(cursor, user_ids, suggestions):
+    """Replace the stored suggestions of `user_ids`."""
+
+    cursor.execute(
+        "DELETE FROM user_suggestions WHERE user_id = ANY(%s)",
+        (user_ids.tolist(),))
+
+    buffer = io.StringIO()
+    np.savetxt(buffer, np.column_stack(suggestions).astype(np.float64),
+               fmt=['%d', '%d', '%d', '%.6g'], delimiter=',')
+    buffer.seek(0)
+
+    cursor.copy_expert(COPY_SUGGESTIONS, buffer)
@@ -0,0 +1,244 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY, current_users
+from models import (
+    db, reset_db, User, Message, Follow, Like, TimelineEntry,
+    DEFAULT_IMAGE_URL)
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+class ApiTestCase(TestCase):
+    """Tests for the /api/v1 endpoints."""
+
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        u2.bio = "u2 bio"
+
+        messages = [
+            Message(text=f"m{i}", user_id=u2.id) for i in range(5)
+        ]
+        db.session.add_all(messages)
+        db.session.flush()
+
+        db.session.add_all([
+            Follow(user_being_followed_id=u2.id, user_following_id=u1.id),
+            Follow(user_being_followed_id=u3.id, user_following_id=u1.id),
+            Like(user_id=u1.id, message_id=messages[0].id),
+            Like(user_id=u3.id, message_id=messages[0].id),
+        ])
+        for message in messages:
+            TimelineEntry.fan_out(message)
+
+        db.session.commit()
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+        self.message_ids = [message.id for message in messages]
+
+        current_users.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get(self, client, url):
+        resp = client.get(url)
+        return resp.status_code, resp.json
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_requires_login(self):
+        """Test the API needs a logged-in user."""
+
+        with app.test_client() as c:
+            status, body = self.get(c, "/api/v1/timeline")
+
+        self.assertEqual(status, 401)
+        self.assertIn("error", body)
+
+    def test_timeline_pages(self):
+        """Test the timeline is paged newest first with cursors."""
+
+        with app.test_client() as c:
+            self.login(c)
+
+            _, body = self.get(c, "/api/v1/timeline?limit=3")
+            newest = list(reversed(self.message_ids))
+            self.assertEqual([m["id"] for m in body["data"]], newest[:3])
+            self.assertEqual(
+                set(body["data"][0]), {"id", "text", "timestamp", "user_id"})
+
+            _, body = self.get(
+                c, f"/api/v1/timeline?limit=3&before={body['next_cursor']}")
+            self.assertEqual([m["id"] for m in body["data"]], newest[3:])
+            self.assertIsNone(body["next_cursor"])
+
+    def test_message_fields(self):
+        """Test messages include only the fields asked for, including
+        counts, the viewer's likes and their author.
+        """
+
+        m0 = self.message_ids[0]
+
+        with app.test_client() as c:
+            self.login(c)
+
+            _, body = self.get(
+                c,
+                f"/api/v1/messages/{m0}"
+                "?fields=text,like_count,liked,user.username,user.bio")
+
+        self.assertEqual(body["data"], {
+            "text": "m0",
+            "like_count": 2,
+            "liked": True,
+            "user": {"username": "u2", "bio": "u2 bio"},
+        })
+
+    def test_batch(self):
+        """Test batch lookups keep the order asked for and skip unknown ids.
+        """
+
+        with app.test_client() as c:
+            self.login(c)
+
+            _, body = self.get(
+                c,
+                f"/api/v1/users?ids={self.u3_id},0,{self.u2_id}"
+                "&fields=username,follower_count,following")
+            self.assertEqual(body["data"], [
+                {"username": "u3", "follower_count": 1, "following": True},
+                {"username": "u2", "follower_count": 1, "following": True},
+            ])
+
+            ids = ",".join(str(id) for id in self.message_ids[:2])
+            _, body = self.get(c, f"/api/v1/messages?ids={ids}&fields=user")
+            self.assertEqual(
+                body["data"][0]["user"],
+                {"id": self.u2_id, "username": "u2",
+                 "image_url": DEFAULT_IMAGE_URL})
+
+    def test_user_listings(self):
+        """Test a user's following, followers, messages and likes."""
+
+        with app.test_client() as c:
+            self.login(c)
+
+            _, body = self.get(c, f"/api/v1/users/{self.u1_id}/following")
+            self.assertEqual([u["id"] for u in body["data"]],
+                             [self.u3_id, self.u2_id])
+
+            _, body = self.get(c, f"/api/v1/users/{self.u2_id}/followers")
+            self.assertEqual([u["id"] for u in body["data"]], [self.u1_id])
+
+            _, body = self.get(
+                c, f"/api/v1/users/{self.u2_id}/messages?limit=2&fields=id")
+            self.assertEqual(
+                body["data"],
+                [{"id": id} for id in reversed(self.message_ids[-2:])])
+            self.assertIsNotNone(body["next_cursor"])
+
+            _, body = self.get(
+                c, f"/api/v1/users/{self.u3_id}/likes?fields=id")
+            self.assertEqual(body["data"], [{"id": self.message_ids[0]}])
+
+    def test_deactivated_authors_hidden(self):
+        """Test messages by a deactivated author aren't returned."""
+
+        db.session.get(User, self.u2_id).deactivated_at = db.func.now()
+        db.session.commit()
+
+        with app.test_client() as c:
+            self.login(c)
+
+            for url in [
+                "/api/v1/timeline",
+                f"/api/v1/users/{self.u3_id}/likes",
+                f"/api/v1/messages?ids={self.message_ids[0]}",
+            ]:
+                _, body = self.get(c, url)
+                self.assertEqual(body["data"], [], url)
+
+            status, _ = self.get(c, f"/api/v1/messages/{self.message_ids[0]}")
+            self.assertEqual(status, 404)
+
+    def test_errors(self):
+        """Test bad parameters and missing items get JSON errors."""
+
+        with app.test_client() as c:
+            self.login(c)
+
+            for url, expected in [
+                ("/api/v1/users?ids=1&fields=password", 400),
+                ("/api/v1/messages?ids=1&fields=user.email", 400),
+                ("/api/v1/users?ids=a", 400),
+                ("/api/v1/timeline?limit=0", 400),
+                ("/api/v1/timeline?before=nope", 400),
+                ("/api/v1/users/0", 404),
+                ("/api/v1/users/0/followers", 404),
+                ("/api/v1/messages/0", 404),
+            ]:
+                status, body = self.get(c, url)
+                self.assertEqual(status, expected, url)
+                self.assertIn("error", body)
+
+    def test_set_based_queries(self):
+        """Test a timeline page is read with two queries, whatever its size
+        and fields, and only reads the columns asked for.
+        """
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.test_client() as c:
+            self.login(c)
+            c.get("/api/v1/timeline")  # cache the current user
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                c.get("/api/v1/timeline?limit=1&fields=id,like_count,user")
+                small = len(statements)
+                statements.clear()
+
+                c.get("/api/v1/timeline?fields=id,like_count,liked,user")
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(small, 2)
+        self.assertEqual(len(statements), 2)
+        self.assertNotIn("users.bio", " ".join(statements))
@@ -8,7 +8,7 @@ from flask import session
 from flask_bcrypt import Bcrypt
 
 from app import app, CURR_USER_KEY
-from models import db, User
+from models import db, reset_db, User
 
 # This is a bit of hack, but don't use Flask DebugToolbar
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
@@ -19,8 +19,7 @@ app.config['WTF_CSRF_ENABLED'] = False
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
 
-db.drop_all()
-db.create_all()
+reset_db()
 
 bcrypt = Bcrypt()
 
@@ -0,0 +1,179 @@
+"""HTTP caching policy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_caching.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, reset_db, User, Message
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+class CachingTestCase(TestCase):
+    """Tests for Cache-Control headers and conditional GETs."""
+
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u2.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_versioned_static(self):
+        """Test pages link versioned static files that are cached forever.
+        """
+
+        with app.test_client() as c:
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("/static/stylesheets/style.css?v=", html)
+
+            start = html.index("/static/stylesheets/style.css?v=")
+            url = html[start:html.index('"', start)]
+            resp = c.get(url)
+
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+            resp.close()
+
+            resp = c.get("/static/stylesheets/style.css")
+            self.assertIn("max-age=3600", resp.headers["Cache-Control"])
+            self.assertNotIn("immutable", resp.headers["Cache-Control"])
+            resp.close()
+
+    def test_show_user_not_modified(self):
+        """Test a profile page is a 304 until something on it changes."""
+
+        with app.test_client() as c:
+            self.login(c)
+
+            resp = c.get(f"/users/{self.u2_id}")
+            etag = resp.headers["ETag"]
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+            self.assertIn("private", resp.headers["Cache-Control"])
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post(f"/users/follow/{self.u2_id}")
+            c.get("/")  # show the flashed message, if any
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+    def test_show_message_not_modified(self):
+        """Test a message page is a 304 until its likes change."""
+
+        with app.test_client() as c:
+            self.login(c)
+
+            etag = c.get(f"/messages/{self.m1_id}").headers["ETag"]
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post(f"/messages/{self.m1_id}/like",
+                   data={"requesting_url": "/"})
+
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_show_message_follow_button(self):
+        """Test a message page isn't a 304 once the viewer stops following
+        its author, even if their following count is unchanged.
+        """
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        u3_id = u3.id
+
+        with app.test_client() as c:
+            self.login(c)
+            c.post(f"/users/follow/{self.u2_id}")
+            c.get("/")  # show the flashed message, if any
+
+            etag = c.get(f"/messages/{self.m1_id}").headers["ETag"]
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+            c.post(f"/users/follow/{u3_id}")
+            c.get("/")
+
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('data-following="false"',
+                          resp.get_data(as_text=True))
+
+    def test_follow_lists_not_modified(self):
+        """Test the following and followers pages are conditional."""
+
+        with app.test_client() as c:
+            self.login(c)
+
+            for path in ("following", "followers"):
+                etag = c.get(f"/users/{self.u2_id}/{path}").headers["ETag"]
+                resp = c.get(f"/users/{self.u2_id}/{path}",
+                             headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 304)
+
+    def test_flashed_page_not_conditional(self):
+        """Test a page showing a flashed message gets no ETag."""
+
+        with app.test_client() as c:
+            self.login(c)
+            with c.session_transaction() as sess:
+                sess["_flashes"] = [("success", "Hello!")]
+
+            resp = c.get(f"/users/{self.u2_id}")
+            self.assertNotIn("ETag", resp.headers)
+            self.assertIn("Hello!", resp.get_data(as_text=True))
+
+    def test_forms_not_stored(self):
+        """Test pages with forms holding user input are no-store."""
+
+        with app.test_client() as c:
+            self.assertIn("no-store", c.get("/login").headers["Cache-Control"])
+            self.assertIn("no-store",
+                          c.get("/signup").headers["Cache-Control"])
+
+            self.login(c)
+            self.assertIn("no-store",
+                          c.get("/messages/new").headers["Cache-Control"])
+            self.assertIn("no-store",
+                          c.get("/users/profile").headers["Cache-Control"])
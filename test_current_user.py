@@ -0,0 +1,137 @@
+"""Current user snapshot cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_current_user.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import app, CURR_USER_KEY, current_users
+from current_user import CurrentUser, SnapshotCache
+from models import db, reset_db, User, Message, Like
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+class SnapshotCacheTestCase(TestCase):
+    """Tests for SnapshotCache and CurrentUser."""
+
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_get_caches(self):
+        """Test snapshots are served from the cache until they expire."""
+
+        cache = SnapshotCache(max_size=10, ttl=30)
+
+        self.assertEqual(cache.get(self.u1_id).username, "u1")
+        self.assertEqual(cache.get(self.u1_id).username, "u1")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        with patch("current_user.time.monotonic", return_value=1e12):
+            cache.get(self.u1_id)
+
+        self.assertEqual(cache.misses, 2)
+
+    def test_lru_eviction(self):
+        """Test the least recently used snapshot is evicted first."""
+
+        cache = SnapshotCache(max_size=1, ttl=30)
+        cache.get(self.u1_id)
+        cache.get(self.u2_id)
+        cache.get(self.u1_id)
+
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+    def test_missing_user(self):
+        """Test a snapshot for a user that doesn't exist is None."""
+
+        cache = SnapshotCache(max_size=10, ttl=30)
+        self.assertIsNone(cache.get(0))
+
+    def test_invalidated_on_commit(self):
+        """Test committing a change to a user drops their snapshot."""
+
+        current_users.get(self.u1_id)
+
+        u1 = db.session.get(User, self.u1_id)
+        u1.username = "renamed"
+        db.session.commit()
+
+        self.assertEqual(current_users.get(self.u1_id).username, "renamed")
+
+    def test_current_user_loads_lazily(self):
+        """Test CurrentUser only loads the row for non-snapshot fields."""
+
+        user = CurrentUser(current_users.get(self.u1_id))
+
+        self.assertEqual(user.username, "u1")
+        self.assertIsNone(user._user)
+
+        self.assertEqual(user.email, "u1@email.com")
+        self.assertIsNotNone(user._user)
+
+    def test_likes_without_loading(self):
+        """Test CurrentUser answers like checks without loading the row."""
+
+        messages = [Message(text=f"m{i}", user_id=self.u2_id)
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        db.session.add(Like(user_id=self.u1_id, message_id=messages[0].id))
+        db.session.commit()
+
+        user = CurrentUser(current_users.get(self.u1_id))
+
+        user.prefetch_likes(messages[:2])
+        self.assertTrue(user.has_liked(messages[0]))
+        self.assertFalse(user.has_liked(messages[1]))
+        self.assertFalse(user.has_liked(messages[2]))
+        self.assertIsNone(user._user)
+
+    def test_profile_edit_shows_at_once(self):
+        """Test the nav bar reflects a profile edit on the next page."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.get("/messages/new")
+            client.post(
+                "/users/profile",
+                data={
+                    "username": "u1",
+                    "email": "u1@email.com",
+                    "image_url": "https://new_image_url.jpg",
+                    "password": "password",
+                })
+
+            resp = client.get("/messages/new")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('src="https://new_image_url.jpg" alt="u1"', html)
@@ -0,0 +1,297 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletion.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY, current_users
+from deletion import delete_account, purge_deactivated, purge_user
+from jobs import jobs
+from models import (
+    db, reset_db, User, Message, Follow, Like, TimelineEntry, Job,
+    MessageScore, trend_exponent)
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+class DeletionTestCase(TestCase):
+    """Tests for deactivating and purging accounts."""
+
+    def setUp(self):
+        Job.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        messages = [Message(text=f"m{i}", user_id=u1.id) for i in range(3)]
+        m4 = Message(text="m4", user_id=u2.id)
+        db.session.add_all(messages + [m4])
+        db.session.flush()
+
+        db.session.add_all([
+            Follow(user_being_followed_id=u2.id, user_following_id=u1.id),
+            Follow(user_being_followed_id=u3.id, user_following_id=u1.id),
+            Follow(user_being_followed_id=u1.id, user_following_id=u2.id),
+            Like(user_id=u2.id, message_id=messages[0].id),
+            Like(user_id=u2.id, message_id=messages[1].id),
+            Like(user_id=u3.id, message_id=messages[0].id),
+            Like(user_id=u1.id, message_id=m4.id),
+        ])
+        for message in messages + [m4]:
+            TimelineEntry.fan_out(message)
+
+        db.session.commit()
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+        self.m4_id = m4.id
+        self.message_ids = [message.id for message in messages]
+
+        current_users.clear()
+
+    def tearDown(self):
+        app.config['DELETE_INLINE_MAX_ROWS'] = 5000
+        db.session.rollback()
+        current_users.clear()
+
+    def assertPurged(self):
+        """Assert u1 and everything referencing them is gone, and the other
+        users' counters are right.
+        """
+
+        db.session.expire_all()
+
+        self.assertIsNone(db.session.get(User, self.u1_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(),
+                         0)
+        self.assertEqual(Follow.query.count(), 0)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u1_id).count(), 0)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u2_id).count(), 1)
+
+        u2 = db.session.get(User, self.u2_id)
+        u3 = db.session.get(User, self.u3_id)
+        self.assertEqual(u2.follower_count, 0)
+        self.assertEqual(u2.following_count, 0)
+        self.assertEqual(u2.like_count, 0)
+        self.assertEqual(u3.follower_count, 0)
+        self.assertEqual(u3.like_count, 0)
+
+    def test_purge_user_batches(self):
+        """Test purging a row at a time removes everything."""
+
+        purge_user(self.u1_id, batch_size=1)
+        self.assertPurged()
+
+    def test_purge_trending_scores(self):
+        """Test the purged user's likes are taken out of the trending
+        scores of the messages they liked.
+        """
+
+        Like.add(self.u3_id, self.m4_id)
+        MessageScore.rebuild()
+        db.session.commit()
+
+        purge_user(self.u1_id, batch_size=1)
+
+        like = Like.query.filter_by(message_id=self.m4_id).one()
+        self.assertEqual(like.user_id, self.u3_id)
+        self.assertAlmostEqual(
+            db.session.get(MessageScore, self.m4_id).score,
+            trend_exponent(like.timestamp),
+            places=6)
+
+        Like.remove(self.u3_id, self.m4_id)
+        db.session.commit()
+        self.assertEqual(
+            db.session.get(MessageScore, self.m4_id).score, float('-inf'))
+
+    def test_delete_account_inline(self):
+        """Test a small account is purged before delete_account returns."""
+
+        self.assertIsNone(delete_account(app, self.u1_id))
+        self.assertPurged()
+
+    def test_delete_account_background(self):
+        """Test a large account is hidden at once and purged by a job."""
+
+        app.config['DELETE_INLINE_MAX_ROWS'] = 0
+
+        job = delete_account(app, self.u1_id)
+        self.assertEqual(job.type, 'purge_user')
+        self.assertFalse(User.authenticate("u1", "password"))
+        self.assertEqual(
+            Message.query.filter_by(user_id=self.u1_id).count(), 3)
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertPurged()
+
+    def test_delete_account_counts_follows_and_likes(self):
+        """Test an account with few messages but more rows than the limit
+        in follows and likes is purged by a job.
+        """
+
+        # 3 messages, 2 follows, 1 follower and 1 like.
+        app.config['DELETE_INLINE_MAX_ROWS'] = 6
+
+        job = delete_account(app, self.u1_id)
+        self.assertEqual(job.type, 'purge_user')
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertPurged()
+
+    def test_delete_account_inline_limit(self):
+        """Test an account with as many rows as the limit is purged inline."""
+
+        app.config['DELETE_INLINE_MAX_ROWS'] = 7
+
+        self.assertIsNone(delete_account(app, self.u1_id))
+        self.assertPurged()
+
+    def test_purge_deactivated(self):
+        """Test an interrupted purge is finished by purge_deactivated."""
+
+        u1 = db.session.get(User, self.u1_id)
+        u1.deactivated_at = db.func.now()
+        db.session.commit()
+
+        self.assertEqual(purge_deactivated(), 1)
+        self.assertPurged()
+
+    def test_deactivated_hidden(self):
+        """Test a deactivated user can't log in and isn't shown."""
+
+        u1 = db.session.get(User, self.u1_id)
+        u1.deactivated_at = db.func.now()
+        db.session.commit()
+
+        self.assertFalse(User.authenticate("u1", "password"))
+        self.assertEqual(User.search("u1", None, 10).items, [])
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            self.assertEqual(c.get(f"/users/{self.u1_id}").status_code, 404)
+            self.assertEqual(
+                c.post(f"/users/follow/{self.u1_id}").status_code, 404)
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertNotIn("@u1", html)
+            self.assertIn("@u2", html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u2_id}/following")
+            self.assertEqual(resp.status_code, 302)
+
+    def deactivate_u1(self):
+        """Deactivate u1 without purging them; return a client logged in as
+        u2, who follows them and likes two of their messages.
+        """
+
+        u1 = db.session.get(User, self.u1_id)
+        u1.deactivated_at = db.func.now()
+        db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+        return client
+
+    def assertNoU1Messages(self, html):
+        self.assertIn(f'href="/messages/{self.m4_id}"', html)
+        for message_id in self.message_ids:
+            self.assertNotIn(f'href="/messages/{message_id}"', html)
+
+    def test_deactivated_messages_off_timeline(self):
+        """Test a deactivated user's messages leave their followers'
+        timelines.
+        """
+
+        with self.deactivate_u1() as c:
+            self.assertNoU1Messages(c.get("/").get_data(as_text=True))
+
+    def test_deactivated_messages_off_likes(self):
+        """Test a deactivated user's messages leave the likes pages."""
+
+        u2 = db.session.get(User, self.u2_id)
+        db.session.add(Like(user_id=u2.id, message_id=self.m4_id))
+        db.session.commit()
+
+        with self.deactivate_u1() as c:
+            self.assertNoU1Messages(
+                c.get(f"/users/{self.u2_id}/likes").get_data(as_text=True))
+
+    def test_deactivated_message_page(self):
+        """Test a deactivated user's message pages are gone."""
+
+        with self.deactivate_u1() as c:
+            resp = c.get(f"/messages/{self.message_ids[0]}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_deactivated_messages_not_likeable(self):
+        """Test a deactivated user's messages can't be liked."""
+
+        message_id = self.message_ids[2]
+
+        with self.deactivate_u1() as c:
+            resp = c.post(f"/messages/{message_id}/like",
+                          data={"requesting_url": "/"})
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.put(f"/messages/{message_id}/like")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertIsNone(db.session.get(Like, (self.u2_id, message_id)))
+
+    def test_deactivated_messages_not_deletable(self):
+        """Test the delete view 404s for a deactivated user's message."""
+
+        with self.deactivate_u1() as c:
+            resp = c.post(f"/messages/{self.message_ids[0]}/delete")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(
+            Message.query.filter_by(user_id=self.u1_id).count(), 3)
+
+    def test_delete_user_view(self):
+        """Test the delete view logs out and purges the account."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post("/users/delete", follow_redirects=True)
+            self.assertIn("User successfully deleted.",
+                          resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+        self.assertPurged()
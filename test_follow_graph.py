@@ -0,0 +1,220 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+import re
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+import numpy as np
+from flask import session
+
+from app import app, CURR_USER_KEY
+from follow_graph import FollowGraph, FollowGraphCache, follow_graph
+from models import db, reset_db, User, Follow
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+def make_graph(edges, loaded_at=0):
+    followers, followed = np.array(edges, dtype=np.int32).reshape(-1, 2).T
+    return FollowGraph(followers, followed, loaded_at)
+
+
+class FollowGraphTestCase(TestCase):
+    """Tests for the CSR graph and its overlay."""
+
+    def setUp(self):
+        # 1 follows 2, 3 and 5; 2 and 3 follow 1; 4 follows 2.
+        self.graph = make_graph([(1, 3), (1, 2), (2, 1), (3, 1), (4, 2),
+                                 (1, 5)])
+
+    def test_queries(self):
+        graph = self.graph
+
+        self.assertTrue(graph.is_following(1, 2))
+        self.assertFalse(graph.is_following(2, 3))
+        self.assertFalse(graph.is_following(99, 1))
+        self.assertTrue(graph.is_mutual(1, 3))
+        self.assertFalse(graph.is_mutual(1, 5))
+
+        self.assertEqual(graph.following_ids(1).tolist(), [2, 3, 5])
+        self.assertEqual(graph.follower_ids(2).tolist(), [1, 4])
+        self.assertEqual(graph.mutual_ids(1).tolist(), [2, 3])
+        self.assertEqual(graph.following_count(1), 3)
+        self.assertEqual(graph.follower_count(5), 1)
+        self.assertEqual(graph.follower_count(99), 0)
+        self.assertEqual(graph.edge_count, 6)
+
+    def test_pages(self):
+        page = self.graph.following_page(1, None, 2)
+        self.assertEqual(page.items, [5, 3])
+        self.assertEqual(page.next_cursor, "3")
+
+        page = self.graph.following_page(1, page.next_cursor, 2)
+        self.assertEqual(page.items, [2])
+        self.assertIsNone(page.next_cursor)
+
+        self.assertEqual(self.graph.followers_page(99, None, 2).items, [])
+
+    def test_overlay(self):
+        """Test follows and unfollows since the load are applied, once."""
+
+        graph = self.graph
+
+        graph.set(2, 3, True, 1)
+        graph.set(1, 2, False, 1)
+        graph.set(1, 2, False, 2)
+        graph.set(6, 1, True, 1)
+
+        self.assertTrue(graph.is_following(2, 3))
+        self.assertFalse(graph.is_following(1, 2))
+        self.assertEqual(graph.following_ids(1).tolist(), [3, 5])
+        self.assertEqual(graph.following_count(1), 2)
+        self.assertEqual(graph.follower_ids(1).tolist(), [2, 3, 6])
+        self.assertEqual(graph.follower_count(2), 1)
+
+        graph.set(1, 2, True, 3)
+        self.assertEqual(graph.following_ids(1).tolist(), [2, 3, 5])
+        self.assertEqual(graph.following.overlay_size, 2)
+
+    def test_overlay_ignores_old_changes(self):
+        """Test changes older than the graph or the pair's last change are
+        ignored.
+        """
+
+        graph = make_graph([(1, 2)], loaded_at=10)
+
+        graph.set(1, 2, False, 5)
+        self.assertTrue(graph.is_following(1, 2))
+
+        graph.set(1, 2, False, 12)
+        graph.set(1, 2, True, 11)
+        self.assertFalse(graph.is_following(1, 2))
+
+    def test_empty(self):
+        graph = make_graph([])
+
+        self.assertFalse(graph.is_following(1, 2))
+        self.assertEqual(graph.follower_ids(1).tolist(), [])
+
+
+class FollowGraphCacheTestCase(TestCase):
+    """Tests for loading the graph and keeping it up to date."""
+
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(4)
+        ]
+        db.session.flush()
+
+        self.ids = [user.id for user in users]
+        u0, u1, u2, u3 = self.ids
+
+        db.session.add_all([
+            Follow(user_following_id=u0, user_being_followed_id=u1),
+            Follow(user_following_id=u0, user_being_followed_id=u2),
+            Follow(user_following_id=u1, user_being_followed_id=u0),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_load(self):
+        """Test the graph is loaded with the follows table."""
+
+        connection = db.engine.raw_connection()
+        try:
+            graph = FollowGraph.load(connection)
+        finally:
+            connection.close()
+
+        u0, u1, u2, u3 = self.ids
+        self.assertEqual(graph.following_ids(u0).tolist(), [u1, u2])
+        self.assertEqual(graph.follower_ids(u0).tolist(), [u1])
+        self.assertEqual(graph.mutual_ids(u0).tolist(), [u1])
+        self.assertEqual(graph.edge_count, 3)
+
+    def test_reload_after_orm_commit(self):
+        """Test follows changed through the ORM reload the graph."""
+
+        u0, u1, u2, u3 = self.ids
+        self.assertTrue(follow_graph.graph().is_following(u0, u2))
+        loads = follow_graph.loads
+
+        db.session.delete(db.session.get(Follow, (u2, u0)))
+        db.session.commit()
+
+        self.assertFalse(follow_graph.graph().is_following(u0, u2))
+        self.assertEqual(follow_graph.loads, loads + 1)
+
+    def test_read_your_writes(self):
+        """Test another process's graph shows a browser's own follows."""
+
+        u0, u1, u2, u3 = self.ids
+
+        other = FollowGraphCache()
+        other.app = app
+        other.graph()
+
+        with app.test_request_context():
+            db.session.add(Follow(user_following_id=u0,
+                                  user_being_followed_id=u3))
+            db.session.commit()
+            follow_graph.record(u0, u3, True)
+
+            self.assertTrue(follow_graph.graph().is_following(u0, u3))
+            self.assertTrue(other.graph().is_following(u0, u3))
+            self.assertEqual(len(session['follow_writes']), 1)
+
+    def test_views(self):
+        """Test follow lists and the "Follows you" badge use the graph."""
+
+        u0, u1, u2, u3 = self.ids
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0
+
+            html = c.get(f"/users/{u1}").get_data(as_text=True)
+            self.assertIn("Follows you", html)
+            html = c.get(f"/users/{u2}").get_data(as_text=True)
+            self.assertNotIn("Follows you", html)
+
+            c.post(f"/users/follow/{u3}")
+            html = c.get(f"/users/{u0}/following").get_data(as_text=True)
+            self.assertEqual(self.cards(html), [u3, u2, u1])
+
+            c.post(f"/users/stop-following/{u1}")
+            html = c.get(f"/users/{u0}/following").get_data(as_text=True)
+            self.assertEqual(self.cards(html), [u3, u2])
+
+            html = c.get(f"/users/{u1}/followers").get_data(as_text=True)
+            self.assertEqual(self.cards(html), [])
+            html = c.get(f"/users/{u3}/followers").get_data(as_text=True)
+            self.assertEqual(self.cards(html), [u0])
+
+    def cards(self, html):
+        """Ids of the users with cards on a page, in order."""
+
+        return [int(id) for id in re.findall(
+            r'href="/users/(\d+)" class="card-link"', html)]
@@ -0,0 +1,141 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY, message_cards
+from fragments import FragmentCache, fill, slot
+from models import db, reset_db, User, Message, Like
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+class FragmentCacheTestCase(TestCase):
+    """Tests for FragmentCache."""
+
+    def test_get_caches_by_version(self):
+        """Test fragments are reused until their version changes."""
+
+        cache = FragmentCache(max_bytes=1000)
+
+        self.assertEqual(cache.get("k", 1, lambda: "a"), ["a"])
+        self.assertEqual(cache.get("k", 1, lambda: "b"), ["a"])
+        self.assertEqual(cache.get("k", 2, lambda: "c"), ["c"])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(cache.size, 1)
+
+    def test_size_bound(self):
+        """Test least recently used fragments are evicted to stay under
+        the size bound.
+        """
+
+        cache = FragmentCache(max_bytes=10)
+        cache.get("a", 1, lambda: "x" * 4)
+        cache.get("b", 1, lambda: "x" * 4)
+        cache.get("a", 1, lambda: "x" * 4)
+        cache.get("c", 1, lambda: "x" * 4)
+
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.get("a", 1, lambda: "new"), ["x" * 4])
+        self.assertEqual(cache.get("b", 1, lambda: "new"), ["new"])
+
+    def test_slots(self):
+        """Test slots are split out and filled on each render."""
+
+        cache = FragmentCache(max_bytes=1000)
+        parts = cache.get("k", 1, lambda: f"<p>{slot('likes')}</p>")
+
+        self.assertEqual(parts, ["<p>", "likes", "</p>"])
+        self.assertEqual(fill(parts, lambda name: name.upper()),
+                         "<p>LIKES</p>")
+
+    def test_invalidate(self):
+        """Test invalidating a fragment drops it."""
+
+        cache = FragmentCache(max_bytes=1000)
+        cache.get("k", 1, lambda: "a")
+        cache.invalidate("k")
+
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(cache.get("k", 1, lambda: "b"), ["b"])
+
+
+class MessageCardViewTestCase(TestCase):
+    """Tests for cached message cards in pages."""
+
+    def setUp(self):
+        User.query.delete()
+        message_cards.clear()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u2.id)
+        db.session.add(m1)
+        db.session.flush()
+
+        db.session.add(Like(user_id=u1.id, message_id=m1.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get_as(self, user_id, path):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            return c.get(path).get_data(as_text=True)
+
+    def test_card_shared_between_viewers(self):
+        """Test one viewer's cached card is reused for another, with their
+        own like controls.
+        """
+
+        html = self.get_as(self.u1_id, f"/users/{self.u2_id}")
+        self.assertIn("m1-text", html)
+        self.assertIn("bi-heart-fill", html)
+
+        hits = message_cards.hits
+        html = self.get_as(self.u2_id, f"/users/{self.u2_id}")
+
+        self.assertEqual(message_cards.hits, hits + 1)
+        self.assertIn("m1-text", html)
+        self.assertNotIn("bi-heart", html)
+        self.assertRegex(html, r"1\s+Like\s")
+
+    def test_author_update_rerenders(self):
+        """Test a card is re-rendered when its author changes username."""
+
+        self.get_as(self.u1_id, f"/messages/{self.m1_id}")
+
+        u2 = db.session.get(User, self.u2_id)
+        u2.username = "renamed"
+        db.session.commit()
+
+        html = self.get_as(self.u1_id, f"/messages/{self.m1_id}")
+        self.assertIn("@renamed", html)
+        self.assertIn("Follow", html)
@@ -0,0 +1,207 @@
+"""Index usage tests for the hot queries.
+
+Each test runs a real query, then EXPLAINs it with sequential scans
+disabled and checks the plan uses the index meant for it. The tables are
+tiny here, so turning off sequential scans is what makes the planner show
+which index it would use at scale.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_indexes.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app, load_users
+from deletion import _delete_follow_batch
+from models import (
+    db, reset_db, User, Message, Like, Follow, TimelineEntry)
+from pagination import Page
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+FILLER_ROWS = 2000
+
+
+class StatementRecorder:
+    """Context manager that records the SQL statements sent to the database,
+    with their parameters.
+    """
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, many):
+        self.statements.append((statement, parameters))
+
+
+class IndexUsageTestCase(TestCase):
+    """The hot queries use their indexes."""
+
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password")
+            for i in range(3)
+        ]
+        db.session.flush()
+
+        messages = [
+            Message(text=f"m{i}", user_id=users[i % 3].id) for i in range(6)
+        ]
+        db.session.add_all(messages)
+        db.session.flush()
+
+        db.session.add_all([
+            Follow(user_being_followed_id=users[1].id,
+                   user_following_id=users[0].id),
+            Follow(user_being_followed_id=users[2].id,
+                   user_following_id=users[0].id),
+            Like(user_id=users[0].id, message_id=messages[1].id),
+            Like(user_id=users[2].id, message_id=messages[1].id),
+        ])
+        for message in messages:
+            TimelineEntry.fan_out(message)
+
+        db.session.commit()
+
+        # Filler: other users' messages, each liked and on u0's timeline,
+        # so the statistics look like a real table and the plans don't
+        # depend on whatever earlier tests left behind.
+        db.session.execute(
+            db.text(
+                "INSERT INTO messages (text, timestamp, user_id) "
+                "SELECT 'filler', now(), :user_id "
+                "FROM generate_series(1, :count)"),
+            {"user_id": users[1].id, "count": FILLER_ROWS})
+        db.session.execute(
+            db.text(
+                "INSERT INTO likes (user_id, message_id, timestamp) "
+                "SELECT :user_id, id, now() FROM messages "
+                "WHERE text = 'filler'"),
+            {"user_id": users[2].id})
+        db.session.execute(
+            db.text(
+                "INSERT INTO timeline_entries "
+                "(user_id, message_id, timestamp) "
+                "SELECT :user_id, id, timestamp FROM messages "
+                "WHERE text = 'filler'"),
+            {"user_id": users[0].id})
+        db.session.commit()
+
+        db.session.execute(db.text(
+            "ANALYZE users, messages, likes, follows, timeline_entries"))
+        db.session.commit()
+
+        self.user_id = users[0].id
+        self.message_ids = [message.id for message in messages]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def assertUsesIndex(self, run, index):
+        """Assert the last statement `run()` sends uses `index`."""
+
+        with StatementRecorder() as recorder:
+            run()
+
+        statement, parameters = recorder.statements[-1]
+
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql("SET enable_seqscan = off")
+            plan = "\n".join(
+                row[0] for row in
+                conn.exec_driver_sql(f"EXPLAIN {statement}", parameters))
+
+        self.assertIn(index, plan)
+
+    def test_user_messages(self):
+        """Test a user's messages page uses the (user_id, timestamp) index.
+        """
+
+        user = db.session.get(User, self.user_id)
+        self.assertUsesIndex(
+            lambda: user.messages_page(None, 10),
+            "ix_messages_user_id_timestamp")
+
+    def test_like_counts(self):
+        """Test counting likes per message uses the message_id index."""
+
+        messages = Message.query.filter(Message.id.in_(self.message_ids)).all()
+        self.assertUsesIndex(
+            lambda: Message.prefetch_like_counts(messages),
+            "ix_likes_message_id")
+
+    def test_following(self):
+        """Test purging the follows a deleted user made uses the
+        user_following_id index.
+        """
+
+        self.assertUsesIndex(
+            lambda: _delete_follow_batch(
+                Follow.user_following_id == self.user_id,
+                Follow.user_being_followed_id,
+                User.follower_count,
+                10),
+            "ix_follows_user_following_id")
+
+    def test_fan_out(self):
+        """Test delivering a message to its author's followers uses the
+        follows primary key.
+        """
+
+        message = db.session.get(Message, self.message_ids[1])
+        self.assertUsesIndex(
+            lambda: TimelineEntry.fan_out(message),
+            "follows_pkey")
+
+    def test_follow_list_users(self):
+        """Test a following/followers page's users, whose ids come from
+        the follow graph, are read by primary key.
+        """
+
+        user_ids = db.session.scalars(db.select(User.id)).all()
+        self.assertUsesIndex(
+            lambda: load_users(Page(user_ids)),
+            "users_pkey")
+
+    def test_timeline(self):
+        """Test the home timeline uses the timeline index."""
+
+        self.assertUsesIndex(
+            lambda: TimelineEntry.messages_for(self.user_id, None, 10),
+            "ix_timeline_entries_user_id_timestamp")
+
+    def test_liked_messages(self):
+        """Test a user's liked messages use the likes primary key."""
+
+        user = db.session.get(User, self.user_id)
+        self.assertUsesIndex(
+            lambda: user.liked_messages_page(None, 10),
+            "likes_pkey")
+
+    def test_search(self):
+        """Test user search uses the full-text index."""
+
+        self.assertUsesIndex(
+            lambda: User.search("u1", None, 10),
+            "ix_users_search_vector")
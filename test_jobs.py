@@ -0,0 +1,179 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import select
+
+from app import app
+from jobs import jobs
+from models import db, reset_db, Job
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+ran = []
+
+
+@jobs.job('test_record')
+def record(value):
+    ran.append(value)
+
+
+@jobs.job('test_fail', max_attempts=2)
+def fail():
+    raise ValueError("nope")
+
+
+@jobs.job('test_limited', concurrency=1)
+def limited(value):
+    ran.append(value)
+
+
+class JobQueueTestCase(TestCase):
+    """Tests for queueing, claiming and retrying jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+        ran.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_enqueue_with_transaction(self):
+        """Test a job is only queued if its transaction commits."""
+
+        jobs.enqueue('test_record', value=1)
+        db.session.rollback()
+        self.assertEqual(jobs.run_pending(), 0)
+
+        jobs.enqueue('test_record', value=2)
+        db.session.commit()
+        self.assertEqual(jobs.run_pending(), 1)
+
+        self.assertEqual(ran, [2])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_run_in_order(self):
+        """Test due jobs run oldest first and later ones wait."""
+
+        jobs.enqueue('test_record', value=1)
+        jobs.enqueue('test_record', value=2)
+        jobs.enqueue('test_record', value=3,
+                     run_at=datetime.utcnow() + timedelta(hours=1))
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 2)
+        self.assertEqual(ran, [1, 2])
+        self.assertEqual(jobs.counts(), {'queued': 1})
+
+    def test_retry_with_backoff(self):
+        """Test a failing job is retried later, then marked failed."""
+
+        job = jobs.enqueue('test_fail')
+        db.session.commit()
+        job_id = job.id
+
+        self.assertEqual(jobs.run_pending(), 1)
+
+        job = db.session.get(Job, job_id)
+        self.assertEqual(job.state, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("ValueError: nope", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(jobs.run_pending(), 1)
+
+        db.session.expire_all()
+        job = db.session.get(Job, job_id)
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_skip_locked(self):
+        """Test a job locked by another worker is skipped, not waited on."""
+
+        job = jobs.enqueue('test_record', value=1)
+        db.session.commit()
+
+        with db.engine.connect() as other_worker:
+            other_worker.execute(
+                select(Job).where(Job.id == job.id).with_for_update())
+
+            self.assertEqual(jobs.run_pending(), 0)
+
+            other_worker.rollback()
+
+        self.assertEqual(jobs.run_pending(), 1)
+
+    def test_abandoned_job_reclaimed(self):
+        """Test a job whose worker died is run again after the timeout."""
+
+        timeout = timedelta(seconds=app.config['JOB_TIMEOUT_SECONDS'])
+
+        job = jobs.enqueue('test_record', value=1)
+        job.state = 'running'
+        job.locked_at = datetime.utcnow()
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 0)
+
+        job.locked_at = datetime.utcnow() - timeout - timedelta(seconds=1)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(ran, [1])
+
+    def test_concurrency_limit(self):
+        """Test a type at its concurrency limit waits, but others run."""
+
+        running = jobs.enqueue('test_limited', value=1)
+        running.state = 'running'
+        running.locked_at = datetime.utcnow()
+        jobs.enqueue('test_limited', value=2)
+        jobs.enqueue('test_record', value=3)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(ran, [3])
+
+        db.session.delete(running)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(ran, [3, 2])
+
+    def test_metrics(self):
+        """Test job durations and queue depth are reported."""
+
+        jobs.enqueue('test_record', value=1)
+        jobs.enqueue('test_record', value=2,
+                     run_at=datetime.utcnow() + timedelta(hours=1))
+        db.session.commit()
+        jobs.run_pending()
+
+        with app.test_client() as c:
+            text = c.get("/metrics").get_data(as_text=True)
+
+        self.assertIn(
+            'warbler_job_duration_seconds_count{type="test_record",'
+            'outcome="done"}',
+            text)
+        self.assertIn("warbler_jobs_queued 1", text)
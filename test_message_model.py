@@ -7,7 +7,7 @@ import os
 from unittest import TestCase
 from flask_bcrypt import Bcrypt
 
-from models import db, User, Message
+from models import db, reset_db, User, Message
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -24,8 +24,7 @@ from app import app
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
-db.drop_all()
-db.create_all()
+reset_db()
 
 bcrypt = Bcrypt()
 
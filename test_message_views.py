@@ -9,7 +9,7 @@ from app import app, CURR_USER_KEY
 import os
 from unittest import TestCase
 
-from models import db, Message, User
+from models import db, reset_db, Message, User, Follow, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -31,8 +31,7 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
-db.drop_all()
-db.create_all()
+reset_db()
 
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
@@ -97,6 +96,37 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
                 1
             )
             self.assertIn("Hello", html)
+            self.assertEqual(
+                db.session.get(User, self.u1_id).message_count, 1)
+
+    def test_add_message_fans_out(self):
+        """Test a new message is delivered to followers' timelines."""
+
+        db.session.add(
+            Follow(user_being_followed_id=self.u1_id,
+                   user_following_id=self.u2_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Fan out"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Fan out", html)
+
+        msg = Message.query.filter_by(text="Fan out").one()
+        self.assertEqual(
+            {e.user_id for e in TimelineEntry.query.filter_by(message_id=msg.id)},
+            {self.u1_id, self.u2_id},
+        )
 
     def test_anon_add_message(self):
         """Test adding a message while logged out."""
@@ -136,6 +166,24 @@ class MessageDeleteViewTestCase(MessageBaseViewTestCase):
             self.assertIn("Message successfully deleted.", html)
             self.assertFalse(Message.query.filter_by(id=self.m1_id).all())
 
+    def test_delete_message_counts(self):
+        """Test deleting a message updates author and liker counters."""
+
+        u2 = db.session.get(User, self.u2_id)
+        u2.liked_messages.append(db.session.get(Message, self.m1_id))
+        db.session.commit()
+        User.reconcile_counts()
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/messages/{self.m1_id}/delete")
+
+        self.assertEqual(db.session.get(User, self.u1_id).message_count, 0)
+        self.assertEqual(db.session.get(User, self.u2_id).like_count, 0)
+
     def test_loggedout_delete_message(self):
         """Test deleting message while logged out."""
 
@@ -170,3 +218,77 @@ class MessageDeleteViewTestCase(MessageBaseViewTestCase):
                 len(Message.query.filter_by(id=self.m2_id).all()),
                 1
             )
+
+
+class MessageLikeJsonTestCase(MessageBaseViewTestCase):
+    """Test cases for the JSON like endpoints."""
+
+    def tearDown(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        db.session.rollback()
+
+    def test_like_json(self):
+        """Test liking and unliking return the new state and are idempotent.
+        """
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for _ in range(2):
+                resp = c.put(f"/messages/{self.m2_id}/like")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(
+                    resp.json,
+                    {"message_id": self.m2_id, "liked": True, "like_count": 1})
+
+            self.assertEqual(db.session.get(User, self.u1_id).like_count, 1)
+
+            for _ in range(2):
+                resp = c.delete(f"/messages/{self.m2_id}/like")
+                self.assertEqual(
+                    resp.json,
+                    {"message_id": self.m2_id, "liked": False,
+                     "like_count": 0})
+
+            db.session.expire_all()
+            self.assertEqual(db.session.get(User, self.u1_id).like_count, 0)
+
+    def test_like_json_errors(self):
+        """Test the JSON like endpoints' errors are JSON too."""
+
+        with app.test_client() as c:
+            resp = c.put(f"/messages/{self.m2_id}/like")
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn("error", resp.json)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.put("/messages/0/like")
+            self.assertEqual(resp.status_code, 404)
+            self.assertIn("error", resp.json)
+
+    def test_like_json_csrf(self):
+        """Test the JSON endpoints need the CSRF token in a header."""
+
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/messages/{self.m2_id}").get_data(as_text=True)
+            self.assertIn(f'data-like-url="/messages/{self.m2_id}/like"', html)
+
+            start = html.index('name="csrf_token" type="hidden" value="')
+            start = html.index('value="', start) + len('value="')
+            token = html[start:html.index('"', start)]
+
+            resp = c.put(f"/messages/{self.m2_id}/like")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.put(f"/messages/{self.m2_id}/like",
+                         headers={"X-CSRFToken": token})
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.json["liked"])
@@ -0,0 +1,166 @@
+"""Request metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from metrics import Histogram, metrics
+from models import db, reset_db, User
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+class HistogramTestCase(TestCase):
+    """Tests for Histogram."""
+
+    def test_render(self):
+        """Test buckets are cumulative and end with +Inf."""
+
+        histogram = Histogram("h", "Help.", (1, 5), ("route",))
+        histogram.observe(("/",), 1)
+        histogram.observe(("/",), 3)
+        histogram.observe(("/",), 10)
+
+        self.assertEqual(histogram.render(), [
+            '# HELP h Help.',
+            '# TYPE h histogram',
+            'h_bucket{route="/",le="1"} 1',
+            'h_bucket{route="/",le="5"} 2',
+            'h_bucket{route="/",le="+Inf"} 3',
+            'h_sum{route="/"} 14',
+            'h_count{route="/"} 3',
+        ])
+
+
+class MetricsViewTestCase(TestCase):
+    """Tests for request instrumentation and /metrics."""
+
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+    def tearDown(self):
+        db.session.rollback()
+        metrics.slow_request_seconds = 0.5
+        app.config['METRICS_ALLOWED_IPS'] = ['127.0.0.1', '::1']
+        app.config['METRICS_TOKEN'] = None
+
+    def test_metrics_endpoint(self):
+        """Test requests are recorded per endpoint and exposed."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get(f"/users/{self.u1_id}")
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("text/plain", resp.content_type)
+
+            labels = '{endpoint="show_user",method="GET"}'
+            self.assertIn(f"warbler_request_duration_seconds_count{labels}",
+                          text)
+            self.assertIn(f"warbler_request_queries_count{labels}", text)
+            self.assertIn(f"warbler_request_db_seconds_sum{labels}", text)
+            self.assertIn(f"warbler_request_template_seconds_sum{labels}",
+                          text)
+            self.assertIn("warbler_current_user_cache_hits_total", text)
+            self.assertIn("warbler_password_hash_queue_depth 0", text)
+
+    def test_metrics_access(self):
+        """Test /metrics is only served to allowed addresses and to
+        scrapes with the token.
+        """
+
+        app.config['METRICS_ALLOWED_IPS'] = []
+        app.config['METRICS_TOKEN'] = "sekrit"
+
+        with app.test_client() as c:
+            self.assertEqual(c.get("/metrics").status_code, 403)
+
+            resp = c.get("/metrics",
+                         headers={"Authorization": "Bearer wrong"})
+            self.assertEqual(resp.status_code, 403)
+
+            resp = c.get("/metrics",
+                         headers={"Authorization": "Bearer sekrit"})
+            self.assertEqual(resp.status_code, 200)
+
+            app.config['METRICS_TOKEN'] = None
+            resp = c.get("/metrics", headers={"Authorization": "Bearer "})
+            self.assertEqual(resp.status_code, 403)
+
+            app.config['METRICS_ALLOWED_IPS'] = ['127.0.0.1']
+            self.assertEqual(c.get("/metrics").status_code, 200)
+
+    def test_job_counts_once(self):
+        """Test the job gauges share one query per scrape."""
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with app.test_client() as c:
+                text = c.get("/metrics").get_data(as_text=True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertIn("warbler_jobs_queued 0", text)
+        self.assertIn("warbler_jobs_failed 0", text)
+        self.assertEqual(
+            len([s for s in statements if "FROM jobs" in s]), 1)
+
+    def test_query_count_recorded(self):
+        """Test a page's SQL statements are counted."""
+
+        before = metrics.query_count._series.get(('show_user', 'GET'))
+        before_total = before[1] if before else 0
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get(f"/users/{self.u1_id}")
+
+        counts, total = metrics.query_count._series[('show_user', 'GET')]
+        self.assertGreater(total, before_total)
+
+    def test_slow_request_logged(self):
+        """Test slow requests are logged with their SQL."""
+
+        metrics.slow_request_seconds = 0
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with self.assertLogs(app.logger, level="WARNING") as logs:
+                c.get(f"/users/{self.u1_id}")
+
+        self.assertIn("Slow request: GET /users/", logs.output[0])
+        self.assertIn("FROM users", logs.output[0])
@@ -0,0 +1,156 @@
+"""SQL statement count tests for the listing pages."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_counts.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY, current_users
+from models import db, reset_db, User, Message, Like, Follow, TimelineEntry
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+# Most statements any listing page may issue, however many rows it shows.
+MAX_STATEMENTS_PER_PAGE = 7
+
+
+class QueryCounter:
+    """Context manager that counts the SQL statements sent to the database.
+
+        with QueryCounter() as counter:
+            client.get("/")
+        counter.count  # -> number of statements
+    """
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, many):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class QueryCountTestCase(TestCase):
+    """Listing pages issue a bounded number of statements."""
+
+    def setUp(self):
+        User.query.delete()
+
+        self.viewer = User.signup("viewer", "viewer@email.com", "password")
+        authors = [
+            User.signup(f"a{i}", f"a{i}@email.com", "password")
+            for i in range(3)
+        ]
+        db.session.flush()
+
+        self.viewer_id = self.viewer.id
+        self.author_ids = [author.id for author in authors]
+
+        for author in authors:
+            db.session.add(Follow(
+                user_being_followed_id=author.id,
+                user_following_id=self.viewer.id))
+
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def add_messages(self, count):
+        """Have each author post `count` messages, each liked by the
+        viewer and delivered to the viewer's timeline.
+        """
+
+        for author_id in self.author_ids:
+            for i in range(count):
+                msg = Message(text=f"m{i}", user_id=author_id)
+                db.session.add(msg)
+                db.session.flush()
+                TimelineEntry.fan_out(msg)
+                db.session.add(Like(user_id=self.viewer_id, message_id=msg.id))
+
+        db.session.commit()
+
+    def count_statements(self, url):
+        """Count the statements issued by a GET of `url` as the viewer."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            # Measure the worst case: the viewer's snapshot isn't cached.
+            db.session.expire_all()
+            current_users.clear()
+
+            with QueryCounter() as counter:
+                resp = client.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            return counter.count
+
+    def assert_constant_statements(self, url):
+        """Check `url` stays under the statement budget and doesn't issue
+        more statements as the number of rows grows.
+        """
+
+        self.add_messages(2)
+        few = self.count_statements(url)
+
+        self.add_messages(10)
+        many = self.count_statements(url)
+
+        self.assertLessEqual(few, MAX_STATEMENTS_PER_PAGE)
+        self.assertEqual(few, many)
+
+    def test_cached_current_user(self):
+        """A page that only needs the viewer's snapshot issues no queries
+        once the snapshot is cached.
+        """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            client.get("/messages/new")
+
+            with QueryCounter() as counter:
+                resp = client.get("/messages/new")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(counter.count, 0)
+
+            with QueryCounter() as counter:
+                client.get("/static/stylesheets/style.css")
+
+            self.assertEqual(counter.count, 0)
+
+    def test_homepage(self):
+        self.assert_constant_statements("/")
+
+    def test_show_user(self):
+        self.assert_constant_statements(f"/users/{self.author_ids[0]}")
+
+    def test_show_user_likes(self):
+        self.assert_constant_statements(f"/users/{self.viewer_id}/likes")
@@ -0,0 +1,152 @@
+"""Read replica routing tests.
+
+A second local database, warbler_test_replica, stands in for the replica.
+Nothing replicates into it, so rows are written to each database directly
+and the tests check which one a page was read from.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_routing.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from sqlalchemy import insert, select, update
+
+from app import app, CURR_USER_KEY, current_users, read_replicas
+from models import db, reset_db, User
+from routing import PRIMARY_UNTIL_KEY
+
+REPLICA_URL = 'postgresql:///warbler_test_replica'
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests for sending GET requests' reads to a replica."""
+
+    def setUp(self):
+        app.config['DATABASE_REPLICA_URLS'] = [REPLICA_URL]
+        self.replica = read_replicas.engine(REPLICA_URL)
+
+        # The stand-in replica only needs the tables, not the migration
+        # history.
+        db.metadata.drop_all(self.replica)
+        db.metadata.create_all(self.replica)
+
+        User.query.delete()
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        columns = ['id', 'username', 'email', 'password', 'image_url']
+        rows = db.session.execute(
+            select(*[getattr(User, column) for column in columns])
+        ).mappings().all()
+
+        with self.replica.begin() as conn:
+            conn.execute(insert(User.__table__), [dict(row) for row in rows])
+            conn.execute(
+                update(User.__table__)
+                .where(User.__table__.c.id == self.u2_id)
+                .values(username="u2-on-replica"))
+
+        current_users.clear()
+
+    def tearDown(self):
+        app.config['DATABASE_REPLICA_URLS'] = []
+        db.session.rollback()
+        current_users.clear()
+
+    def test_get_reads_replica(self):
+        """Test a GET page is read from the replica."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+            self.assertIn("@u2-on-replica", html)
+
+        self.assertNotIn('read_engine', db.session.info)
+
+    def test_reads_primary_after_write(self):
+        """Test a browser that just wrote reads from the primary."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+
+            with c.session_transaction() as sess:
+                self.assertIn(PRIMARY_UNTIL_KEY, sess)
+
+            db.session.expire_all()
+            html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+            self.assertIn("@u2", html)
+            self.assertNotIn("u2-on-replica", html)
+            self.assertIn("Unfollow", html)
+
+    def test_reads_replica_after_lag(self):
+        """Test reads go back to the replica once it has caught up."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+                sess[PRIMARY_UNTIL_KEY] = 0
+
+            db.session.expire_all()
+            html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+            self.assertIn("@u2-on-replica", html)
+
+            with c.session_transaction() as sess:
+                self.assertNotIn(PRIMARY_UNTIL_KEY, sess)
+
+    def test_session_routing(self):
+        """Test only plain SELECTs are routed to the read engine."""
+
+        db.session.info['read_engine'] = self.replica
+
+        try:
+            self.assertIs(db.session.get_bind(clause=select(User)),
+                          self.replica)
+            self.assertIs(
+                db.session.get_bind(clause=select(User).with_for_update()),
+                db.engine)
+            self.assertIs(db.session.get_bind(clause=update(User)),
+                          db.engine)
+        finally:
+            db.session.info.pop('read_engine')
+
+    def test_pool_wait_metrics(self):
+        """Test connection checkouts are timed per pool."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get(f"/users/{self.u2_id}")
+            text = c.get("/metrics").get_data(as_text=True)
+
+        self.assertIn('warbler_db_pool_wait_seconds_count{pool="primary"}',
+                      text)
+        self.assertIn('warbler_db_pool_wait_seconds_count{pool="replica0"}',
+                      text)
@@ -0,0 +1,218 @@
+"""Streamed list page tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_streaming.py
+
+
+import html
+import os
+import re
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from flask import g
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from metrics import metrics
+from models import db, reset_db, User, Message, Follow, Like
+from pagination import StreamedPage, paginate_by_key
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+def shown(page):
+    """The users and messages a page lists, and its "Load more" link."""
+
+    return (re.findall(r'href="/users/(\d+)" class="card-link"', page),
+            re.findall(r'href="/messages/(\d+)" class="message-link"', page),
+            [html.unescape(url) for url in re.findall(
+                r'href="([^"]+)"\s+class="btn btn-outline-secondary">\s+Load more',
+                page)])
+
+
+class StreamingTestCase(TestCase):
+    """Tests for streaming list pages."""
+
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(7)
+        ]
+        db.session.flush()
+        self.ids = [user.id for user in users]
+        u0 = self.ids[0]
+
+        messages = [Message(text=f"m{i}", user_id=u0) for i in range(5)]
+        db.session.add_all(messages)
+        db.session.flush()
+
+        db.session.add_all(
+            [Follow(user_following_id=u0, user_being_followed_id=id)
+             for id in self.ids[1:]]
+            + [Follow(user_following_id=id, user_being_followed_id=u0)
+               for id in self.ids[1:]]
+            + [Like(user_id=u0, message_id=message.id)
+               for message in messages])
+        db.session.commit()
+
+        app.config['USERS_PER_PAGE'] = 4
+        app.config['MESSAGES_PER_PAGE'] = 3
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['STREAM_LIST_PAGES'] = False
+        app.config['USERS_PER_PAGE'] = 60
+        app.config['MESSAGES_PER_PAGE'] = 100
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[0]
+
+    def test_same_pages(self):
+        """Test streamed pages show what whole ones do, over two pages."""
+
+        u0 = self.ids[0]
+        urls = ["/users", "/users?q=u", f"/users/{u0}", f"/users/{u0}/likes",
+                f"/users/{u0}/following", f"/users/{u0}/followers"]
+
+        for url in urls:
+            pages = []
+
+            for stream in (False, True):
+                app.config['STREAM_LIST_PAGES'] = stream
+
+                with app.test_client() as c:
+                    self.login(c)
+                    resp = c.get(url)
+                    self.assertEqual('Content-Length' not in resp.headers, stream)
+                    first = shown(resp.get_data(as_text=True))
+                    second = shown(c.get(first[2][0]).get_data(as_text=True))
+
+                pages.append((first, second))
+
+            self.assertEqual(pages[0], pages[1], url)
+            self.assertTrue(pages[1][0][0] or pages[1][0][1], url)
+            self.assertEqual(pages[1][1][2], [], url)
+
+    def test_streamed_response(self):
+        """Test a streamed page sends its headers, with a CSRF token in the
+        session, before it reads the list.
+        """
+
+        app.config['STREAM_LIST_PAGES'] = True
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        # The app context connect_db pushes outlives requests, and with it
+        # the token flask_wtf caches on g.
+        g.pop('csrf_token', None)
+
+        with app.test_client() as c:
+            self.login(c)
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                resp = c.get(f"/users/{self.ids[0]}/following",
+                             buffered=False)
+                self.assertIsNone(resp.headers.get('ETag'))
+
+                before = len(statements)
+                chunks = iter(resp.response)
+                self.assertIn(b"<html", next(chunks))
+                self.assertEqual(len(statements), before)
+
+                rest = b"".join(chunks)
+                self.assertGreater(len(statements), before)
+                self.assertIn(b'class="card-link"', rest)
+                resp.close()
+
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            with c.session_transaction() as sess:
+                self.assertIn('csrf_token', sess)
+
+    def test_flashed_page_whole(self):
+        """Test a page showing flashed messages isn't streamed, so they're
+        shown once.
+        """
+
+        app.config['STREAM_LIST_PAGES'] = True
+
+        with app.test_client() as c:
+            self.login(c)
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [("success", "Flashed!")]
+
+            resp = c.get("/users")
+            self.assertIn('Content-Length', resp.headers)
+            self.assertIn("Flashed!", resp.get_data(as_text=True))
+
+            resp = c.get("/users")
+            self.assertNotIn('Content-Length', resp.headers)
+            self.assertNotIn("Flashed!", resp.get_data(as_text=True))
+
+    def test_batches(self):
+        """Test a StreamedPage reads and prepares its rows in batches."""
+
+        page = paginate_by_key(User.query, User.id, None, 5, stream=True)
+        page.batch_size = 2
+        batches = []
+        page.prepare = lambda users: batches.append(
+            [user.id for user in users])
+
+        self.assertIsInstance(page, StreamedPage)
+        self.assertIsNone(page.next_cursor)
+        with self.assertRaises(TypeError):
+            len(page)
+
+        newest = sorted(self.ids, reverse=True)
+        self.assertEqual([user.id for user in page], newest[:5])
+        self.assertEqual(batches, [newest[:2], newest[2:4], newest[4:5]])
+        self.assertEqual(page.next_cursor, str(newest[4]))
+
+    def test_metrics_after_body(self):
+        """Test a streamed page's queries, including the list's, are
+        counted once it's sent.
+        """
+
+        app.config['STREAM_LIST_PAGES'] = True
+        labels = ('show_user_likes', 'GET')
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        before = metrics.query_count._series.get(labels)
+        before_count, before_total = (
+            (sum(before[0]), before[1]) if before else (0, 0))
+
+        with app.test_client() as c:
+            self.login(c)
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                c.get(f"/users/{self.ids[0]}/likes").close()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        counts, total = metrics.query_count._series[labels]
+        self.assertEqual(sum(counts), before_count + 1)
+        self.assertEqual(total - before_total, len(statements))
@@ -0,0 +1,183 @@
+"""Who-to-follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_suggestions.py
+
+
+import os
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+import numpy as np
+
+from app import app, CURR_USER_KEY
+from models import (
+    db, reset_db, User, Message, Follow, Like, Suggestion, SuggestionRefresh)
+from suggestions import Recommender, refresh_suggestions
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+def pairs(edges):
+    return np.array(edges, dtype=np.int32).reshape(-1, 2).T
+
+
+class RecommenderTestCase(TestCase):
+    """Tests for scoring candidates."""
+
+    def test_top(self):
+        """Test friends of friends and co-likes are scored, and followed,
+        inactive and the users themselves are left out.
+        """
+
+        # 1 follows 2 and 3, who both follow 4; 3 follows 5, who's
+        # inactive; 4 follows 1. 1 and 6 liked messages 10 and 11; 2 liked
+        # 10.
+        followers, followed = pairs([(1, 2), (1, 3), (2, 4), (3, 4), (3, 5),
+                                     (4, 1)])
+        likers, liked = pairs([(1, 10), (6, 10), (6, 11), (1, 11), (2, 10)])
+        recommender = Recommender(
+            followers, followed, likers, liked,
+            np.array([1, 2, 3, 4, 6], dtype=np.int32))
+
+        user_ids, ranks, suggested, scores = recommender.top([1, 2, 99], 3)
+
+        self.assertEqual(user_ids.tolist(), [1, 1, 2, 2])
+        self.assertEqual(ranks.tolist(), [0, 1, 0, 1])
+        self.assertEqual(suggested.tolist(), [4, 6, 1, 6])
+        self.assertEqual(scores.tolist(), [2, 1, 1.5, 0.5])
+
+    def test_top_k(self):
+        """Test only the best k are kept, ties going to the lower id."""
+
+        followers, followed = pairs([(1, 2), (2, 3), (2, 4), (2, 5)])
+        recommender = Recommender(
+            followers, followed, *pairs([]),
+            np.arange(1, 6, dtype=np.int32))
+
+        _, _, suggested, _ = recommender.top([1], 2)
+        self.assertEqual(suggested.tolist(), [3, 4])
+
+
+class SuggestionsTestCase(TestCase):
+    """Tests for storing, refreshing and showing suggestions."""
+
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(5)
+        ]
+        db.session.flush()
+
+        self.ids = [user.id for user in users]
+        u0, u1, u2, u3, u4 = self.ids
+
+        message = Message(text="hello", user_id=u4)
+        db.session.add(message)
+        db.session.flush()
+        self.message_id = message.id
+
+        # u0 follows u1, who follows u2 and u3; u3 liked u4's message.
+        db.session.add_all([
+            Follow(user_following_id=u0, user_being_followed_id=u1),
+            Follow(user_following_id=u1, user_being_followed_id=u2),
+            Follow(user_following_id=u1, user_being_followed_id=u3),
+            Like(user_id=u3, message_id=message.id),
+        ])
+        db.session.commit()
+
+        refresh_suggestions(everyone=True)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def suggested_ids(self, user_id):
+        return [user.id for user in Suggestion.users_for(user_id, 10)]
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_refresh_everyone(self):
+        u0, u1, u2, u3, u4 = self.ids
+
+        self.assertEqual(self.suggested_ids(u0), [u2, u3])
+        self.assertEqual(self.suggested_ids(u1), [])
+        self.assertEqual(self.suggested_ids(u3), [])
+
+    def test_refresh_stale(self):
+        """Test only users whose follows, followers or likes changed are
+        refreshed.
+        """
+
+        u0, u1, u2, u3, u4 = self.ids
+
+        with app.test_client() as c:
+            self.login(c, u0)
+            c.post(f"/messages/{self.message_id}/like")
+
+            self.login(c, u4)
+            c.post(f"/users/follow/{u1}")
+
+        self.assertEqual(
+            {refresh.user_id for refresh in SuggestionRefresh.query},
+            {u0, u1, u4})
+
+        self.assertEqual(refresh_suggestions(), 3)
+        self.assertEqual(SuggestionRefresh.query.count(), 0)
+
+        # u0 and u3 liked the same message, which puts u3 first; u4
+        # follows u1 now.
+        self.assertEqual(self.suggested_ids(u0), [u3, u2])
+        self.assertEqual(self.suggested_ids(u3), [])
+        self.assertEqual(self.suggested_ids(u4), [u2, u3])
+
+    def test_deactivated_hidden(self):
+        u0, u1, u2, u3, u4 = self.ids
+
+        db.session.get(User, u2).deactivated_at = db.func.now()
+        db.session.commit()
+
+        self.assertEqual(self.suggested_ids(u0), [u3])
+
+        refresh_suggestions(everyone=True)
+        self.assertEqual(
+            Suggestion.query.filter_by(suggested_user_id=u2).count(), 0)
+
+    def test_views(self):
+        """Test the sidebar and suggestions page, which leave out users
+        followed since the suggestions were computed.
+        """
+
+        u0, u1, u2, u3, u4 = self.ids
+
+        with app.test_client() as c:
+            self.login(c, u0)
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn(f'action="/users/follow/{u2}"', html)
+
+            c.post(f"/users/follow/{u2}")
+
+            html = c.get("/users/suggested").get_data(as_text=True)
+            self.assertNotIn(f'action="/users/follow/{u2}"', html)
+            self.assertIn(f'action="/users/follow/{u3}"', html)
+
+            self.login(c, u1)
+            html = c.get("/users/suggested").get_data(as_text=True)
+            self.assertIn("No suggestions yet", html)
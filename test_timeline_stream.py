@@ -0,0 +1,243 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline_stream.py
+
+
+import json
+import os
+import re
+import select
+from datetime import datetime
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from follow_graph import follow_graph
+from models import db, reset_db, User, Message, Follow, TimelineEntry
+from pagination import encode_timestamp_cursor
+from timeline_stream import NOTIFY_CHANNEL, message_event, timeline_stream
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+def cursor(message):
+    return encode_timestamp_cursor(message.timestamp, message.id)
+
+
+def event_ids(body):
+    """The message ids in a text/event-stream body, in order."""
+
+    return [json.loads(data)['id']
+            for data in re.findall(r'^data: (.*)$', body, re.MULTILINE)]
+
+
+class TimelineStreamTestCase(TestCase):
+    """Tests for NOTIFY on new messages, routing them to streams, and the
+    stream and new message views.
+    """
+
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(3)
+        ]
+        db.session.flush()
+        self.ids = [user.id for user in users]
+        u0, u1, u2 = self.ids
+
+        # u0 follows u1; u2 follows no one.
+        db.session.add(Follow(user_following_id=u0, user_being_followed_id=u1))
+        db.session.commit()
+        follow_graph.clear()
+
+        app.config['LIVE_TIMELINE'] = True
+        app.config['TIMELINE_STREAM_SECONDS'] = 0.5
+        app.config['TIMELINE_KEEPALIVE_SECONDS'] = 0.1
+
+    def tearDown(self):
+        db.session.rollback()
+        timeline_stream.close_all()
+        app.config['LIVE_TIMELINE'] = False
+        app.config['TIMELINE_STREAM_SECONDS'] = 300
+        app.config['TIMELINE_KEEPALIVE_SECONDS'] = 15
+
+    def login(self, client, index=0):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[index]
+
+    def post(self, index, text):
+        """Post a message as user `index`; return it."""
+
+        with app.test_client() as c:
+            self.login(c, index)
+            c.post("/messages/new", data={"text": text})
+
+        return Message.query.filter_by(text=text).one()
+
+    def test_notify_on_commit(self):
+        """Test posting a message notifies listeners, only when the live
+        timeline is on.
+        """
+
+        connection = db.engine.raw_connection()
+        try:
+            dbapi_connection = connection.dbapi_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cur:
+                cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+            msg = self.post(1, "live")
+            select.select([dbapi_connection], [], [], 5)
+            dbapi_connection.poll()
+            notifies = [json.loads(notify.payload)
+                        for notify in dbapi_connection.notifies]
+            self.assertEqual(notifies, [message_event(msg)])
+            self.assertEqual(notifies[0]['user_id'], self.ids[1])
+
+            del dbapi_connection.notifies[:]
+            app.config['LIVE_TIMELINE'] = False
+            self.post(1, "quiet")
+            self.assertEqual(
+                select.select([dbapi_connection], [], [], 0.5)[0], [])
+
+            with dbapi_connection.cursor() as cur:
+                cur.execute(f"UNLISTEN {NOTIFY_CHANNEL}")
+        finally:
+            connection.close()
+
+    def test_dispatch(self):
+        """Test a new message goes to the streams of its author and their
+        followers, whether there are fewer followers or streams.
+        """
+
+        u0, u1, u2 = self.ids
+        event = {'id': 1, 'user_id': u1, 'cursor': "x"}
+
+        def received(subscription):
+            return not subscription.events.empty()
+
+        for streaming in ([u0, u1, u2], [u0], [u2]):
+            subscriptions = {
+                id: timeline_stream.subscribe(id) for id in streaming}
+            try:
+                timeline_stream.dispatch(event)
+                self.assertEqual(
+                    {id: received(s) for id, s in subscriptions.items()},
+                    {id: id != u2 for id in streaming})
+            finally:
+                for subscription in subscriptions.values():
+                    timeline_stream.unsubscribe(subscription)
+
+        self.assertEqual(timeline_stream.stream_count, 0)
+
+    def test_catch_up(self):
+        """Test a stream starts with the messages after its cursor, oldest
+        first, preferring Last-Event-ID to `after`.
+        """
+
+        first = self.post(1, "first")
+        second = self.post(0, "second")
+        third = self.post(1, "third")
+        self.post(2, "not followed")
+
+        with app.test_client() as c:
+            self.login(c)
+
+            resp = c.get(f"/timeline/stream?after={cursor(first)}")
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+            body = resp.get_data(as_text=True)
+            self.assertEqual(event_ids(body), [second.id, third.id])
+            self.assertIn(f"id: {cursor(third)}\n", body)
+            self.assertIn(": keepalive\n", body)
+            resp.close()
+
+            resp = c.get(f"/timeline/stream?after={cursor(first)}",
+                         headers={'Last-Event-ID': cursor(second)})
+            self.assertEqual(
+                event_ids(resp.get_data(as_text=True)), [third.id])
+            resp.close()
+
+            resp = c.get("/timeline/stream?after=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+        self.assertEqual(timeline_stream.stream_count, 0)
+
+    def test_live(self):
+        """Test an open stream is sent messages as they're posted."""
+
+        app.config['TIMELINE_STREAM_SECONDS'] = 10
+        start = encode_timestamp_cursor(datetime.utcnow(), 0)
+
+        with app.test_client() as c:
+            self.login(c)
+            resp = c.get(f"/timeline/stream?after={start}", buffered=False)
+            chunks = iter(resp.response)
+            self.assertEqual(next(chunks), b": open\n\n")
+            self.assertEqual(timeline_stream.stream_count, 1)
+
+            msg = self.post(1, "live")
+            self.post(2, "not followed")
+
+            for chunk in chunks:
+                if chunk.startswith(b"id: "):
+                    break
+            self.assertEqual(event_ids(chunk.decode()), [msg.id])
+            resp.close()
+
+        self.assertEqual(timeline_stream.stream_count, 0)
+
+    def test_new_messages(self):
+        """Test the homepage's stream cursor and the new message cards."""
+
+        first = self.post(1, "first")
+        second = self.post(1, "second")
+        third = self.post(0, "third")
+
+        with app.test_client() as c:
+            resp = c.get(f"/timeline/new?after={cursor(first)}")
+            self.assertEqual(resp.status_code, 401)
+            resp = c.get("/timeline/stream")
+            self.assertEqual(resp.status_code, 401)
+
+            self.login(c)
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn(f'data-stream-after="{cursor(third)}"', html)
+            self.assertIn("live_timeline.js", html)
+
+            resp = c.get(f"/timeline/new?after={cursor(first)}")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(
+                re.findall(r'href="/messages/(\d+)" class="message-link"',
+                           html),
+                [str(third.id), str(second.id)])
+            self.assertEqual(resp.headers['X-Timeline-Cursor'], cursor(third))
+
+            resp = c.get(f"/timeline/new?after={cursor(third)}")
+            self.assertNotIn('X-Timeline-Cursor', resp.headers)
+
+            app.config['LIVE_TIMELINE'] = False
+            self.assertNotIn("data-stream-after",
+                             c.get("/").get_data(as_text=True))
+            resp = c.get(f"/timeline/stream?after={cursor(first)}")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(
+            len(TimelineEntry.messages_after(self.ids[0], cursor(first), 1)),
+            1)
@@ -0,0 +1,204 @@
+"""Trending message tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import math
+import os
+from datetime import datetime
+
+os.environ["DATABASE_URL"] = 'postgresql:///warbler_test'
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import (
+    db, reset_db, User, Message, Like, MessageScore, TREND_HALF_LIFE,
+    TREND_MAX_AGE, trend_exponent)
+from trending import trending
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't req CSRF for testing
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+reset_db()
+
+
+class TrendingTestCase(TestCase):
+    """Tests for trending scores and the trending pages."""
+
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(4)
+        ]
+        db.session.flush()
+        self.user_ids = [user.id for user in users]
+
+        messages = [
+            Message(text=f"message {i}", user_id=self.user_ids[0])
+            for i in range(3)
+        ]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_ids = [message.id for message in messages]
+
+        trending.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def score(self, message_id):
+        return db.session.get(MessageScore, message_id).score
+
+    def like(self, user_index, message_index):
+        Like.add(self.user_ids[user_index], self.message_ids[message_index])
+        db.session.commit()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_ids[1]
+
+    def test_score_updates(self):
+        """Test likes add their weight to the score and unlikes take it
+        back out, down to -Infinity with none left.
+        """
+
+        m0 = self.message_ids[0]
+
+        self.like(1, 0)
+        one = self.score(m0)
+        self.assertAlmostEqual(
+            one, trend_exponent(Like.query.one().timestamp), places=6)
+
+        self.like(2, 0)
+        self.assertAlmostEqual(self.score(m0), one + math.log(2), places=6)
+
+        Like.remove(self.user_ids[2], m0)
+        db.session.commit()
+        self.assertAlmostEqual(self.score(m0), one, places=6)
+
+        Like.remove(self.user_ids[1], m0)
+        db.session.commit()
+        self.assertEqual(self.score(m0), float('-inf'))
+
+        self.like(3, 0)
+        self.assertGreater(self.score(m0), one)
+
+    def test_rebuild_and_prune(self):
+        """Test rebuilding matches the incremental scores, leaving out
+        likes too old to count, and pruning drops decayed scores.
+        """
+
+        m0, m1, m2 = self.message_ids
+
+        self.like(1, 0)
+        self.like(2, 0)
+        self.like(1, 1)
+        incremental = self.score(m0)
+
+        # A like from a day ago is worth a sixteenth of one now.
+        day_ago = datetime.utcnow() - 4 * TREND_HALF_LIFE
+        db.session.add(Like(
+            user_id=self.user_ids[3], message_id=m1, timestamp=day_ago))
+        db.session.add(Like(
+            user_id=self.user_ids[3], message_id=m2,
+            timestamp=datetime.utcnow() - 2 * TREND_MAX_AGE))
+        db.session.commit()
+
+        MessageScore.rebuild()
+        db.session.commit()
+
+        self.assertAlmostEqual(self.score(m0), incremental, places=6)
+        recent = Like.query.filter_by(
+            user_id=self.user_ids[1], message_id=m1).one().timestamp
+        self.assertAlmostEqual(
+            self.score(m1) - trend_exponent(recent),
+            math.log(1 + 2 ** ((day_ago - recent) / TREND_HALF_LIFE)),
+            places=6)
+        self.assertIsNone(db.session.get(MessageScore, m2))
+
+        Like.remove(self.user_ids[1], m1)
+        Like.remove(self.user_ids[3], m1)
+        db.session.commit()
+
+        self.assertEqual(MessageScore.prune(), 1)
+        db.session.commit()
+        self.assertIsNone(db.session.get(MessageScore, m1))
+        self.assertIsNotNone(db.session.get(MessageScore, m0))
+
+    def test_pages(self):
+        """Test trending messages are paged highest score first, leaving
+        out deactivated authors.
+        """
+
+        m0, m1, m2 = self.message_ids
+
+        self.like(1, 1)
+        self.like(2, 1)
+        self.like(1, 2)
+        self.like(2, 2)
+        self.like(3, 2)
+        self.like(1, 0)
+
+        page = trending.page(None, 2)
+        self.assertEqual(page.items, [m2, m1])
+
+        page = trending.page(page.next_cursor, 2)
+        self.assertEqual(page.items, [m0])
+        self.assertIsNone(page.next_cursor)
+
+        # The list is kept until it's refreshed.
+        Like.add(self.user_ids[3], m0)
+        Like.add(self.user_ids[2], m0)
+        db.session.commit()
+        self.assertEqual(trending.page(None, 3).items, [m2, m1, m0])
+
+        trending.clear()
+        self.assertEqual(trending.page(None, 3).items, [m0, m2, m1])
+
+        db.session.get(User, self.user_ids[0]).deactivated_at = db.func.now()
+        db.session.commit()
+
+        trending.clear()
+        self.assertEqual(trending.page(None, 3).items, [])
+
+    def test_views(self):
+        """Test the trending page and API endpoint."""
+
+        m0, m1, m2 = self.message_ids
+
+        self.like(1, 1)
+        self.like(2, 1)
+        self.like(1, 0)
+
+        with app.test_client() as c:
+            resp = c.get("/trending", follow_redirects=True)
+            self.assertIn("Sign up", resp.get_data(as_text=True))
+
+            self.login(c)
+
+            html = c.get("/trending").get_data(as_text=True)
+            self.assertIn("message 1", html)
+            self.assertLess(html.index("message 1"), html.index("message 0"))
+            self.assertNotIn("message 2", html)
+
+            body = c.get("/api/v1/trending?limit=1").json
+            self.assertEqual([m["id"] for m in body["data"]], [m1])
+
+            body = c.get(
+                f"/api/v1/trending?limit=1&before={body['next_cursor']}").json
+            self.assertEqual([m["id"] for m in body["data"]], [m0])
+            self.assertIsNone(body["next_cursor"])
+
+            resp = c.get("/api/v1/trending?before=nonsense")
+            self.assertEqual(resp.status_code, 400)
@@ -10,7 +10,9 @@ from unittest import TestCase
 from flask_bcrypt import Bcrypt
 from sqlalchemy.exc import IntegrityError
 
-from models import db, User, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+from models import (
+    db, reset_db, User, Message, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL)
+from passwords import hasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -27,8 +29,7 @@ from app import app
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
-db.drop_all()
-db.create_all()
+reset_db()
 
 bcrypt = Bcrypt()
 
@@ -107,6 +108,48 @@ class UserModelTestCase(TestCase):
 
         self.assertTrue(u2.is_followed_by(u1))
 
+    def test_has_liked(self):
+        """Test like membership checks, with and without prefetching."""
+
+        u1 = db.session.get(User, self.u1_id)
+        m1 = Message(text="liked", user_id=self.u2_id)
+        m2 = Message(text="not liked", user_id=self.u2_id)
+        u1.liked_messages.append(m1)
+        db.session.add(m2)
+        db.session.commit()
+
+        self.assertTrue(u1.has_liked(m1))
+        self.assertFalse(u1.has_liked(m2))
+        self.assertEqual(u1.liked_message_ids, {m1.id})
+
+        u1.prefetch_likes([m1, m2])
+        self.assertTrue(u1.has_liked(m1))
+        self.assertFalse(u1.has_liked(m2))
+
+        # Caches are dropped when the user is expired by a commit.
+        u1.liked_messages.append(m2)
+        db.session.commit()
+        self.assertTrue(u1.has_liked(m2))
+
+    def test_reconcile_counts(self):
+        """Test rebuilding counters from the underlying tables."""
+
+        u1 = db.session.get(User, self.u1_id)
+        u2 = db.session.get(User, self.u2_id)
+        u2.followers.append(u1)
+        m1 = Message(text="text", user_id=self.u2_id)
+        u1.liked_messages.append(m1)
+        db.session.commit()
+
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u1.like_count, 1)
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(u2.message_count, 1)
+        self.assertEqual(u2.following_count, 0)
+
     def test_user_signup_success(self):
         """Test signing up a new user."""
 
@@ -212,6 +255,32 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(User.authenticate("u1","foo"))
 
+    def test_authenticate_rehashes(self):
+        """Test authentication upgrades hashes made at another cost."""
+
+        rounds = hasher.rounds
+        hasher.rounds = 4
+
+        try:
+            u1 = User.authenticate("u1", "password")
+            db.session.commit()
+
+            self.assertTrue(u1.password.startswith("$2b$04$"))
+            self.assertFalse(hasher.needs_rehash(u1.password))
+            self.assertEqual(User.authenticate("u1", "password"), u1)
+        finally:
+            hasher.rounds = rounds
+
+    def test_hasher_stats(self):
+        """Test the hasher counts completed work and drains its queue."""
+
+        completed = hasher.stats()['completed']
+        hasher.check(hasher.hash("password"), "password")
+
+        stats = hasher.stats()
+        self.assertEqual(stats['completed'], completed + 2)
+        self.assertEqual(stats['queue_depth'], 0)
+
     def test_repr(self):
         """Test __repr__ function"""
 
@@ -8,7 +8,8 @@ from flask import session
 from flask_bcrypt import Bcrypt
 
 from app import app, CURR_USER_KEY
-from models import db, User, Message, Like
+from jobs import jobs
+from models import db, reset_db, User, Message, Like, Job
 
 # This is a bit of hack, but don't use Flask DebugToolbar
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
@@ -19,14 +20,14 @@ app.config['WTF_CSRF_ENABLED'] = False
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
 
-db.drop_all()
-db.create_all()
+reset_db()
 
 bcrypt = Bcrypt()
 
 
 class UserBaseTestCase(TestCase):
     def setUp(self):
+        Job.query.delete()
         User.query.delete()
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -104,6 +105,80 @@ class UserViewsTestCase(UserBaseTestCase):
             self.assertIn("TEST: following.html", html)
             self.assertNotIn("u2", html)
 
+    def test_follow_updates_timeline(self):
+        """
+        Test the jobs queued by following backfill the timeline, and those
+        queued by unfollowing prune it.
+        """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u3_id
+
+            client.post(f'/users/follow/{self.u2_id}')
+            jobs.run_pending()
+            resp = client.get("/")
+            self.assertIn(f'href="/messages/{self.m2_id}"',
+                          resp.get_data(as_text=True))
+
+            client.post(f'/users/stop-following/{self.u2_id}')
+            jobs.run_pending()
+            resp = client.get("/")
+            self.assertNotIn(f'href="/messages/{self.m2_id}"',
+                             resp.get_data(as_text=True))
+
+    def test_follow_counts(self):
+        """
+        Test following and unfollowing keeps both users' counters current.
+        """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post(f'/users/follow/{self.u2_id}')
+            self.assertEqual(db.session.get(User, self.u1_id).following_count, 1)
+            self.assertEqual(db.session.get(User, self.u2_id).follower_count, 1)
+
+            client.post(f'/users/stop-following/{self.u2_id}')
+            self.assertEqual(db.session.get(User, self.u1_id).following_count, 0)
+            self.assertEqual(db.session.get(User, self.u2_id).follower_count, 0)
+
+    def test_follow_json(self):
+        """
+        Test following and unfollowing through the JSON endpoints, twice
+        each, changes the state and counters once.
+        """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for _ in range(2):
+                resp = client.put(f'/users/{self.u2_id}/follow')
+                self.assertEqual(resp.json, {
+                    "user_id": self.u2_id,
+                    "following": True,
+                    "follower_count": 1,
+                })
+
+            self.assertEqual(db.session.get(User, self.u1_id).following_count, 1)
+            self.assertEqual(Job.query.count(), 1)
+
+            for _ in range(2):
+                resp = client.delete(f'/users/{self.u2_id}/follow')
+                self.assertEqual(resp.json, {
+                    "user_id": self.u2_id,
+                    "following": False,
+                    "follower_count": 0,
+                })
+
+            db.session.expire_all()
+            self.assertEqual(db.session.get(User, self.u1_id).following_count, 0)
+
+            resp = client.put('/users/0/follow')
+            self.assertEqual(resp.status_code, 404)
+
     def test_followers_page(self):
         """
         Test viewing user's followers page with follower once logged in.
@@ -193,6 +268,56 @@ class UserViewsTestCase(UserBaseTestCase):
             self.assertIn("u1", html)
             self.assertNotIn("u2", html)
 
+    def test_list_users_search_ranked(self):
+        """
+        Test search matches bio and location, ranking username matches first.
+        """
+
+        u2 = db.session.get(User, self.u2_id)
+        u3 = db.session.get(User, self.u3_id)
+        u2.username = "birdwatcher"
+        u3.bio = "I love birds"
+        u3.location = "Oakland"
+        db.session.commit()
+
+        self.assertEqual(
+            [u.id for u in User.search("bird", None, 10)],
+            [self.u2_id, self.u3_id],
+        )
+        self.assertEqual(
+            [u.id for u in User.search("oak", None, 10)],
+            [self.u3_id],
+        )
+        self.assertEqual(len(User.search("?!", None, 10)), 0)
+
+    def test_list_users_search_paginated(self):
+        """
+        Test search results are paged with a `page` parameter.
+        """
+
+        app.config['USERS_PER_PAGE'] = 2
+
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                resp = client.get("/users?q=u")
+                html = resp.get_data(as_text=True)
+                self.assertIn("Load more", html)
+                self.assertIn("q=u", html)
+                self.assertIn("page=2", html)
+
+                resp = client.get("/users?q=u&page=2")
+                html = resp.get_data(as_text=True)
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn("Load more", html)
+
+                resp = client.get("/users?q=u&page=0")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['USERS_PER_PAGE'] = 60
+
     def test_list_users_unauth(self):
         """
         Test that an anon user can't access list users route.
@@ -221,6 +346,42 @@ class UserViewsTestCase(UserBaseTestCase):
             self.assertIn("TEST: user detail", html)
             self.assertIn("u2", html)
 
+    def test_show_user_paginated(self):
+        """
+        Test that a user's messages are paged with a `before` cursor.
+        """
+
+        m3 = Message(text="newer", user_id=self.u1_id)
+        db.session.add(m3)
+        db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                resp = client.get(f"/users/{self.u1_id}")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn(f'href="/messages/{m3.id}"', html)
+                self.assertNotIn(f'href="/messages/{self.m1_id}"', html)
+                self.assertIn("Load more", html)
+
+                cursor = html.split("?before=")[1].split('"')[0]
+                resp = client.get(f"/users/{self.u1_id}?before={cursor}")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn(f'href="/messages/{self.m1_id}"', html)
+                self.assertNotIn(f'href="/messages/{m3.id}"', html)
+                self.assertNotIn("Load more", html)
+
+                resp = client.get(f"/users/{self.u1_id}?before=bogus")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
     def test_show_user_unauth(self):
         """
         Test that an anon user can't see a user's details.
@@ -250,6 +411,33 @@ class UserViewsTestCase(UserBaseTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("TEST: signup.html", html)
             self.assertIn("User successfully deleted.", html)
+
+    def test_delete_user_counts(self):
+        """
+        Test deleting a user decrements the counters of users it touched.
+        """
+
+        u1 = db.session.get(User, self.u1_id)
+        u2 = db.session.get(User, self.u2_id)
+        u3 = db.session.get(User, self.u3_id)
+        u1.following.append(u2)
+        u1.followers.append(u3)
+        u3.liked_messages.append(db.session.get(Message, self.m1_id))
+        db.session.commit()
+        User.reconcile_counts()
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post("/users/delete")
+
+        u2 = db.session.get(User, self.u2_id)
+        u3 = db.session.get(User, self.u3_id)
+        self.assertEqual(u2.follower_count, 0)
+        self.assertEqual(u3.following_count, 0)
+        self.assertEqual(u3.like_count, 0)
             
 class UserProfileTestCase(UserBaseTestCase):
     def test_get_profile_page_okay(self):
@@ -420,6 +608,21 @@ class UserLikeTestCase(UserBaseTestCase):
             self.assertIn("TEST: user show_likes.html", html)
             self.assertIn("u2", html)
 
+    def test_show_liked_heart(self):
+        """
+        Test that messages the viewer liked render a filled heart.
+        """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = client.get(f"/messages/{self.m1_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f'action="/messages/{self.m1_id}/like/delete"', html)
+            self.assertIn("bi-heart-fill", html)
+
     def test_show_user_likes_unauth(self):
         """
         Test that an anon user cannot access a user's likes.
@@ -458,6 +661,7 @@ class UserLikeTestCase(UserBaseTestCase):
             
             likes = Like.query.filter(Like.message_id == self.m1_id, ).all()
             self.assertEqual(len(likes), 2)
+            self.assertEqual(db.session.get(User, self.u3_id).like_count, 1)
 
     def test_remove_like(self):
         """
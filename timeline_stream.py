@@ -0,0 +1,283 @@
+"""Live home timeline updates, as server-sent events.
+
+Posting a message sends a PostgreSQL NOTIFY on NOTIFY_CHANNEL in the same
+transaction, so it's only delivered once the message is committed. Each
+process has one thread LISTENing on a dedicated connection to the primary,
+which hands each new message to the streams open in that process of the
+author and of their followers (by the follow graph, see follow_graph.py).
+Open streams don't use the database: they wait on a queue for the ids of
+new messages, and the homepage fetches the cards when the user asks.
+
+Each event's id is the message's timeline cursor, so a browser that
+reconnects sends it back as Last-Event-ID, and the messages it missed are
+read from `timeline_entries` before it's streamed new ones. Streams close
+after TIMELINE_STREAM_SECONDS, and any that fall behind or may have missed
+a notification are closed early, to catch up the same way.
+
+An idle stream still holds its worker while it's open, so serve
+/timeline/stream from async workers (see gunicorn_stream.py).
+"""
+
+import json
+import queue
+import select
+import threading
+import time
+
+from sqlalchemy import func
+
+from follow_graph import follow_graph
+from models import db
+from pagination import encode_timestamp_cursor
+
+NOTIFY_CHANNEL = "new_messages"
+
+DEFAULT_STREAM_SECONDS = 300
+DEFAULT_KEEPALIVE_SECONDS = 15
+MAX_QUEUED_EVENTS = 100
+LISTEN_POLL_SECONDS = 5
+LISTEN_RETRY_SECONDS = 5
+
+
+def message_event(message):
+    """What a stream sends about `message`."""
+
+    return {
+        'id': message.id,
+        'user_id': message.user_id,
+        'cursor': encode_timestamp_cursor(message.timestamp, message.id),
+    }
+
+
+def format_event(event):
+    """`event` in the text/event-stream format."""
+
+    return f"id: {event['cursor']}\ndata: {json.dumps(event)}\n\n"
+
+
+class Subscription:
+    """One open stream: the user it's for, and the events waiting for it."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.events = queue.Queue(MAX_QUEUED_EVENTS)
+        self.closed = False
+
+    def send(self, event):
+        """Queue `event`, or close the stream if it's fallen behind."""
+
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.close()
+
+    def close(self):
+        self.closed = True
+
+        # Wake the stream up.
+        try:
+            self.events.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+class TimelineStream:
+    """Each process's open timeline streams and the listener feeding them."""
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('LIVE_TIMELINE', False)
+        app.config.setdefault('TIMELINE_STREAM_SECONDS',
+                              DEFAULT_STREAM_SECONDS)
+        app.config.setdefault('TIMELINE_KEEPALIVE_SECONDS',
+                              DEFAULT_KEEPALIVE_SECONDS)
+
+    @property
+    def stream_count(self):
+        return sum(map(len, self._subscriptions.values()))
+
+    def notify(self, message):
+        """Tell every process's streams about `message` once the current
+        transaction commits. The message must already be flushed.
+        """
+
+        if not self.app.config['LIVE_TIMELINE']:
+            return
+
+        db.session.execute(func.pg_notify(
+            NOTIFY_CHANNEL, json.dumps(message_event(message))).select())
+
+    def subscribe(self, user_id):
+        """Start a Subscription to new messages on `user_id`'s timeline.
+
+        Listens first, so messages read from the database after this and
+        messages sent to the subscription between them overlap rather than
+        leave a gap.
+        """
+
+        self._start_listener()
+        subscription = Subscription(user_id)
+
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def events(self, subscription, missed=()):
+        """Generate the text/event-stream body of a stream: the events for
+        `missed` messages, then those sent to `subscription`, with a
+        comment line every TIMELINE_KEEPALIVE_SECONDS to keep the
+        connection open, until TIMELINE_STREAM_SECONDS have passed or it's
+        closed.
+        """
+
+        keepalive = self.app.config['TIMELINE_KEEPALIVE_SECONDS']
+        closes_at = (time.monotonic()
+                     + self.app.config['TIMELINE_STREAM_SECONDS'])
+
+        # WSGI servers send the headers with the first of the body, so the
+        # browser knows the stream is open before anything's posted.
+        yield ": open\n\n"
+
+        for message in missed:
+            yield format_event(message_event(message))
+
+        while not subscription.closed:
+            left = closes_at - time.monotonic()
+            if left <= 0:
+                return
+
+            try:
+                event = subscription.events.get(timeout=min(keepalive, left))
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+
+            if event is not None:
+                yield format_event(event)
+
+    def close_all(self):
+        """Close every open stream, so its browser reconnects and catches
+        up from the database.
+        """
+
+        with self._lock:
+            subscriptions = [subscription
+                             for subscriptions in self._subscriptions.values()
+                             for subscription in subscriptions]
+
+        for subscription in subscriptions:
+            subscription.close()
+
+    def dispatch(self, event):
+        """Send `event`, about a new message, to the streams of its author
+        and their followers.
+        """
+
+        author_id = event['user_id']
+        graph = follow_graph.graph()
+
+        with self._lock:
+            user_ids = list(self._subscriptions)
+
+            # Whichever is smaller: the followers, or the users streaming.
+            if graph.follower_count(author_id) < len(user_ids):
+                recipients = [author_id,
+                              *graph.follower_ids(author_id).tolist()]
+            else:
+                recipients = [
+                    user_id for user_id in user_ids
+                    if user_id == author_id
+                    or graph.is_following(user_id, author_id)
+                ]
+
+            subscriptions = [subscription
+                             for user_id in recipients
+                             for subscription in self._subscriptions.get(
+                                 user_id, ())]
+
+        for subscription in subscriptions:
+            subscription.send(event)
+
+    def _start_listener(self):
+        """Start listening, if this process isn't already."""
+
+        with self._lock:
+            if self._listener is not None:
+                return
+
+            connection = self._connect()
+            self._listener = threading.Thread(
+                target=self._listen, args=(connection,), daemon=True)
+            self._listener.start()
+
+    def _connect(self):
+        """Open a connection LISTENing on NOTIFY_CHANNEL, outside the pool
+        (it's held for good) and always to the primary (notifications
+        aren't replicated).
+        """
+
+        connection = db.engine.raw_connection()
+        connection.detach()
+
+        dbapi_connection = connection.dbapi_connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+        return dbapi_connection
+
+    def _listen(self, connection):
+        with self.app.app_context():
+            while True:
+                try:
+                    self._receive(connection)
+                except Exception:
+                    self.app.logger.exception("Listening for new messages")
+
+                connection.close()
+                connection = self._reconnect()
+
+                # Notifications sent while reconnecting were lost.
+                self.close_all()
+
+    def _reconnect(self):
+        while True:
+            time.sleep(LISTEN_RETRY_SECONDS)
+            try:
+                return self._connect()
+            except Exception:
+                self.app.logger.exception(
+                    "Reconnecting to listen for new messages")
+
+    def _receive(self, connection):
+        """Dispatch notifications from `connection` until it fails."""
+
+        while True:
+            readable, _, _ = select.select(
+                [connection], [], [], LISTEN_POLL_SECONDS)
+            if not readable:
+                continue
+
+            connection.poll()
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                self.dispatch(json.loads(notify.payload))
+
+
+timeline_stream = TimelineStream()
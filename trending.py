@@ -0,0 +1,113 @@
+"""Trending messages.
+
+Liking or unliking a message updates its decayed like score in
+`message_scores` (see MessageScore) in the same transaction, so finding
+what's trending never counts likes. Each process keeps the top
+TRENDING_SIZE scores in a sorted list, refreshed from the top of the
+score index every TRENDING_REFRESH_SECONDS; pages are slices of it.
+
+Scores only change when a message is liked or unliked (they all decay at
+the same rate), so a refreshed list stays in order until the next like.
+Run `flask trending` from cron to prune scores that have decayed away.
+"""
+
+import threading
+import time
+from bisect import bisect_right
+
+from sqlalchemy import select
+from werkzeug.exceptions import BadRequest
+
+from models import db, Message, MessageScore, User
+from pagination import Page
+
+DEFAULT_SIZE = 500
+DEFAULT_REFRESH_SECONDS = 30
+
+
+def encode_score_cursor(score, message_id):
+    return f"{score!r}_{message_id}"
+
+
+def decode_score_cursor(cursor):
+    """Decode a cursor made by `encode_score_cursor`.
+
+    Raises BadRequest if the cursor is malformed.
+    """
+
+    try:
+        score, message_id = cursor.rsplit("_", 1)
+        return float(score), int(message_id)
+    except ValueError:
+        raise BadRequest("Invalid cursor.")
+
+
+class TrendingCache:
+    """Each process's list of the highest scoring messages."""
+
+    def __init__(self):
+        self._entries = []
+        self._keys = []
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('TRENDING_SIZE', DEFAULT_SIZE)
+        app.config.setdefault(
+            'TRENDING_REFRESH_SECONDS', DEFAULT_REFRESH_SECONDS)
+
+    def refresh(self):
+        """Read the top scores of active users' messages."""
+
+        rows = db.session.execute(
+            select(MessageScore.score, MessageScore.message_id)
+            .join(Message, Message.id == MessageScore.message_id)
+            .join(User, User.id == Message.user_id)
+            .where(MessageScore.score > float('-inf'),
+                   User.deactivated_at.is_(None))
+            .order_by(MessageScore.score.desc(),
+                      MessageScore.message_id.desc())
+            .limit(self.app.config['TRENDING_SIZE'])
+        ).all()
+
+        with self._lock:
+            self._entries = [tuple(row) for row in rows]
+            # Ascending, for bisect.
+            self._keys = [(-score, -id) for score, id in self._entries]
+            self._expires = (time.monotonic()
+                             + self.app.config['TRENDING_REFRESH_SECONDS'])
+
+    def clear(self):
+        """Refresh the list on next use."""
+
+        self._expires = 0
+
+    def page(self, before, per_page):
+        """Return a Page of trending message ids, highest score first.
+
+        `before` is a cursor from a previous page's `next_cursor`, or None
+        for the first page.
+        """
+
+        if time.monotonic() >= self._expires:
+            self.refresh()
+
+        with self._lock:
+            entries, keys = self._entries, self._keys
+
+        start = 0
+        if before:
+            score, id = decode_score_cursor(before)
+            start = bisect_right(keys, (-score, -id))
+
+        page = entries[start:start + per_page]
+
+        next_cursor = None
+        if start + per_page < len(entries):
+            next_cursor = encode_score_cursor(*page[-1])
+
+        return Page([id for score, id in page], next_cursor)
+
+
+trending = TrendingCache()